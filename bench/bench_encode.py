@@ -0,0 +1,44 @@
+""" Benchmark of encoding outgoing messages
+
+Usage: python bench/bench_encode.py [messages] """
+
+import sys
+import time
+import msgpack
+
+from dht3k.encoder import MessageEncoder
+from dht3k.const   import Config, Message
+from dht3k.hashing import hash_function, random_id
+
+
+def message():
+    """ A find node message """
+    return {
+        Message.MESSAGE_TYPE: Message.FIND_NODE,
+        Message.ID: random_id(),
+        Message.RPC_ID: random_id(),
+    }
+
+
+def old(message, peer_id):
+    """ Encoding as done before the MessageEncoder """
+    message[Message.PEER_ID] = peer_id
+    message[Message.NETWORK_ID] = hash_function(peer_id + Config.NETWORK_ID)
+    return msgpack.dumps(message)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    peer_id = random_id()
+    encoder = MessageEncoder(Config.NETWORK_ID)
+    messages = [message() for _ in range(count)]
+    for name, encode in (("old", old), ("encoder", encoder.encode)):
+        start = time.time()
+        for msg in messages:
+            encode(dict(msg), peer_id)
+        duration = time.time() - start
+        print("%-8s %8.0f messages/s" % (name, count / duration))
+
+
+if __name__ == "__main__":
+    main()
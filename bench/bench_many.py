@@ -0,0 +1,90 @@
+""" Benchmark of set/get in a loop against set_many/get_many on a small
+local network, get runs on a node without storage
+
+Usage: python bench/bench_many.py [keys] [nodes] """
+
+import sys
+import time
+
+from dht3k       import DHT
+from dht3k.const import Storage
+
+PORT = 4465
+
+
+def measure(name, keys, function):
+    """ Run function and print keys per second """
+    start = time.time()
+    function()
+    duration = time.time() - start
+    print("%-16s %d keys in %.3fs: %.0f keys/s" % (
+        name,
+        keys,
+        duration,
+        keys / duration,
+    ))
+
+
+def run(keys, nodes):
+    """ Boot a network and compare the loop and the batch """
+    dhts = [DHT(
+        PORT,
+        u"127.0.0.1",
+        None,
+        listen_hostv4 = u"127.0.0.1",
+        port_map      = False,
+        log           = False,
+    )]
+    try:
+        for x in range(1, nodes):
+            dhts.append(DHT(
+                PORT + x * 2,
+                u"127.0.0.1",
+                None,
+                listen_hostv4 = u"127.0.0.1",
+                boot_host     = u"127.0.0.1",
+                boot_port     = PORT,
+                port_map      = False,
+                log           = False,
+            ))
+        # Does not store values, so get has to look them up
+        dhts.append(DHT(
+            PORT + nodes * 2,
+            u"127.0.0.1",
+            None,
+            listen_hostv4 = u"127.0.0.1",
+            boot_host     = u"127.0.0.1",
+            boot_port     = PORT,
+            port_map      = False,
+            storage       = Storage.NONE,
+            log           = False,
+        ))
+        first, last = dhts[0], dhts[-1]
+
+        def set_loop():
+            """ One lookup per call """
+            for x in range(keys):
+                first.set(("loop", x), x)
+
+        def get_loop():
+            """ One lookup per call """
+            for x in range(keys):
+                last.get(("loop", x))
+
+        measure("set", keys, set_loop)
+        measure("get", keys, get_loop)
+        measure("set_many", keys, lambda: first.set_many(
+            (("many", x), x) for x in range(keys)
+        ))
+        measure("get_many", keys, lambda: last.get_many(
+            ("many", x) for x in range(keys)
+        ))
+    finally:
+        for dht in dhts:
+            dht.close()
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+    )
@@ -0,0 +1,64 @@
+""" Micro-benchmark of BucketSet.nearest_nodes
+
+Compares the bucket walk with a scan of the whole routing table.
+
+Usage: python bench/bench_nearest.py """
+
+import heapq
+import timeit
+
+from dht3k.bucketset import BucketSet
+from dht3k.peer      import Peer
+from dht3k.hashing   import random_id, bytes2int
+from dht3k.const     import Config
+
+LOOKUPS = 200
+
+
+def create_table(size):
+    """ Create a routing table with size well connected peers """
+    buckets = BucketSet(size, Config.ID_BITS, random_id())
+    for _ in range(size):
+        peer = Peer(4000, random_id(), u"127.0.0.1", well_connected=True)
+        int_id = bytes2int(peer.id)
+        buckets.buckets[buckets.bucket_index(int_id)][int_id] = peer
+    return buckets
+
+
+def full_scan(buckets, key, limit):
+    """ Scan every peer like nearest_nodes did before """
+    ikey = bytes2int(key)
+    items = (item for bucket in buckets.buckets for item in bucket.items())
+    return [peer for (_, peer) in heapq.nsmallest(
+        limit,
+        items,
+        lambda item: ikey ^ item[0],
+    )]
+
+
+def run():
+    """ Run the benchmark for growing tables """
+    for size in (1000, 10000, 100000):
+        buckets = create_table(size)
+        keys = [random_id() for _ in range(LOOKUPS)]
+        for key in keys:
+            assert (
+                buckets.nearest_nodes(key, Config.K) ==
+                full_scan(buckets, key, Config.K)
+            )
+        walk = timeit.timeit(
+            lambda: [buckets.nearest_nodes(key, Config.K) for key in keys],
+            number=1,
+        )
+        scan = timeit.timeit(
+            lambda: [full_scan(buckets, key, Config.K) for key in keys],
+            number=1,
+        )
+        print("%6d peers: walk %8.1fus, full scan %8.1fus per lookup" % (
+            size,
+            walk / LOOKUPS * 1e6,
+            scan / LOOKUPS * 1e6,
+        ))
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,71 @@
+""" Benchmark of the FOUND_NODES node encodings: size of K nodes and
+time to pack and unpack them
+
+Usage: python bench/bench_nodes.py [rounds] """
+
+import random
+import sys
+import time
+import msgpack
+
+from dht3k.encoder import pack_nodes, unpack_nodes
+from dht3k.peer    import Peer
+from dht3k.const   import Config
+from dht3k.hashing import random_id
+
+
+def peers():
+    """ K peers, a quarter of them dual stack """
+    result = []
+    for x in range(Config.K):
+        hostv4 = u"10.0.%d.%d" % (random.randint(0, 255), x)
+        hostv6 = None
+        if x % 4 == 0:
+            hostv6 = u"2001:db8::%x" % x
+        port = random.randint(1024, 65535)
+        result.append(Peer(port, random_id(), hostv4, hostv6))
+    return result
+
+
+def tuples_pack(nodes):
+    return msgpack.dumps([node.astuple(for_export=True) for node in nodes])
+
+
+def tuples_unpack(data):
+    return [Peer(*node, is_bytes=True) for node in msgpack.loads(data)]
+
+
+def compact_pack(nodes):
+    return msgpack.dumps(pack_nodes(nodes))
+
+
+def compact_unpack(data):
+    return unpack_nodes(msgpack.loads(data))
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    nodes = peers()
+    for name, pack, unpack in (
+            ("tuples", tuples_pack, tuples_unpack),
+            ("compact", compact_pack, compact_unpack),
+    ):
+        data = pack(nodes)
+        start = time.time()
+        for _ in range(rounds):
+            pack(nodes)
+        packed = time.time() - start
+        start = time.time()
+        for _ in range(rounds):
+            unpack(data)
+        unpacked = time.time() - start
+        print("%-8s %5d bytes, pack %.1fus, unpack %.1fus" % (
+            name,
+            len(data),
+            packed / rounds * 1e6,
+            unpacked / rounds * 1e6,
+        ))
+
+
+if __name__ == "__main__":
+    main()
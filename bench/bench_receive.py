@@ -0,0 +1,69 @@
+""" Benchmark of the receive path: answered PINGs per second
+
+Usage: python bench/bench_receive.py [pings] """
+
+import socket
+import sys
+import time
+import msgpack
+
+from dht3k         import DHT
+from dht3k.const   import Message
+from dht3k.hashing import hash_function, random_id
+
+PORT   = 4365
+WINDOW = 64
+
+
+def ping_message(dht, peer_id, port):
+    """ Encode a ping from peer_id """
+    return msgpack.dumps({
+        Message.MESSAGE_TYPE: Message.PING,
+        Message.ALL_ADDR: (port, peer_id, socket.inet_aton("127.0.0.1"), None),
+        Message.RPC_ID: random_id(),
+        Message.PEER_ID: peer_id,
+        Message.NETWORK_ID: hash_function(peer_id + dht.network_id),
+    })
+
+
+def run(pings):
+    """ Send pings in windows and count the pongs """
+    dht = DHT(
+        PORT,
+        u"127.0.0.1",
+        None,
+        listen_hostv4 = u"127.0.0.1",
+        port_map      = False,
+        log           = False,
+    )
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", PORT + 10))
+    sock.settimeout(1)
+    message = ping_message(dht, random_id(), PORT + 10)
+    received = 0
+    start = time.time()
+    try:
+        for _ in range(pings // WINDOW):
+            for _ in range(WINDOW):
+                sock.sendto(message, ("127.0.0.1", PORT))
+            # Every ping is answered with at least one pong
+            want = received + WINDOW
+            while received < want:
+                try:
+                    sock.recvfrom(2048)
+                except socket.timeout:
+                    break
+                received += 1
+        duration = time.time() - start
+    finally:
+        sock.close()
+        dht.close()
+    print("%d pings, %d pongs in %.3fs: %.0f pings/s" % (
+        pings,
+        received,
+        duration,
+        pings / duration,
+    ))
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,126 @@
+""" Benchmark of the rpc_states table under contention
+
+Lookup threads add and remove states like _start_rpc and
+handle_found_nodes do. Meanwhile a table with many stale states is
+cleaned up by:
+
+* scan:   one LockedDict that is scanned completely, like the old
+          run_rpc_cleanup did
+* timers: the ShardedDict, expired by the TimerHeap like
+          run_rpc_timeouts does
+
+Usage: python bench/bench_rpc_states.py [threads] [rpcs] [stale] """
+
+import sys
+import threading
+import time
+
+from dht3k.helper  import LockedDict, ShardedDict, TimerHeap
+from dht3k.hashing import rpc_id_pair
+
+TIMEOUT = 30
+
+
+class Scan(object):
+    """ One LockedDict for all states, scanned for stale states """
+
+    def __init__(self):
+        self.states = LockedDict()
+
+    def add(self, hash_id, state):
+        with self.states as states:
+            states[hash_id] = state
+
+    def remove(self, hash_id):
+        with self.states as states:
+            del states[hash_id]
+
+    def cleanup(self, now):
+        with self.states as states:
+            remove = [
+                key for key, state in states.items()
+                if (now - state[0]) > TIMEOUT
+            ]
+            for key in remove:
+                del states[key]
+
+
+class Timers(object):
+    """ ShardedDict with a TimerHeap """
+
+    def __init__(self):
+        self.states = ShardedDict()
+        self.timers = TimerHeap()
+
+    def add(self, hash_id, state):
+        with self.states.shard(hash_id) as states:
+            states[hash_id] = state
+        self.timers.schedule(state[0] + TIMEOUT, hash_id)
+
+    def remove(self, hash_id):
+        with self.states.shard(hash_id) as states:
+            del states[hash_id]
+
+    def cleanup(self, now):
+        for hash_id in self.timers.expired(now):
+            with self.states.shard(hash_id) as states:
+                states.pop(hash_id, None)
+
+
+def run(table, threads, rpcs, stale):
+    """ Returns RPCs per second, the worst latency of one RPC and the
+    longest cleanup """
+    for _ in range(stale):
+        table.add(rpc_id_pair()[1], [time.time() - TIMEOUT / 2])
+    ids = [[rpc_id_pair()[1] for _ in range(rpcs)] for _ in range(threads)]
+    worst = [0.0] * threads
+    longest = [0.0]
+    done = threading.Event()
+
+    def lookup(n):
+        """ Start and finish RPCs """
+        for hash_id in ids[n]:
+            start = time.time()
+            table.add(hash_id, [start, None])
+            table.remove(hash_id)
+            worst[n] = max(worst[n], time.time() - start)
+
+    def cleanup():
+        """ Clean up till the lookups are done """
+        while not done.wait(0.01):
+            start = time.time()
+            table.cleanup(start)
+            longest[0] = max(longest[0], time.time() - start)
+
+    cleaner = threading.Thread(target=cleanup)
+    workers = [
+        threading.Thread(target=lookup, args=(n,)) for n in range(threads)
+    ]
+    cleaner.start()
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.time() - start
+    done.set()
+    cleaner.join()
+    return threads * rpcs / duration, max(worst), longest[0]
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    rpcs    = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    stale   = int(sys.argv[3]) if len(sys.argv) > 3 else 200000
+    for name, table in (("scan", Scan()), ("timers", Timers())):
+        rate, worst, longest = run(table, threads, rpcs, stale)
+        print("%-8s %8.0f rpcs/s, worst %.1fms, cleanup %.1fms" % (
+            name,
+            rate,
+            worst * 1000,
+            longest * 1000,
+        ))
+
+
+if __name__ == "__main__":
+    main()
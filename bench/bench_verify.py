@@ -0,0 +1,100 @@
+""" Benchmark of verify_message on a mix of messages from 200 peers
+
+Usage: python bench/bench_verify.py [messages] """
+
+import random
+import sys
+import time
+
+from dht3k.server  import DHTRequestHandler, _verifier_lookup
+from dht3k.helper  import LRUCache
+from dht3k.const   import Config, Message, message_dict
+from dht3k.hashing import hash_function, random_id
+
+PEERS = 200
+
+
+def old_verify(message, network_id):
+    """ verify_message before the validators and the proof cache """
+    if message[Message.MESSAGE_TYPE] not in message_dict:
+        return False
+    for key in message.keys():
+        if key not in message_dict:
+            return False
+        try:
+            verfier = _verifier_lookup[key]
+        except KeyError:
+            continue
+        if not verfier(message[key]):
+            return False
+    try:
+        network_id = hash_function(message[Message.PEER_ID] + network_id)
+        if network_id != message[Message.NETWORK_ID]:
+            return False
+    except KeyError:
+        return False
+    return True
+
+
+def addr():
+    """ A peer tuple """
+    return (4000, random_id(), b"\x7f\x00\x00\x01", None)
+
+
+def messages(count, network_id):
+    """ Pings, pongs, finds, found nodes and stores """
+    peers = [random_id() for _ in range(PEERS)]
+    parts = [
+        (Message.PING, {Message.ALL_ADDR: addr()}),
+        (Message.PONG, {
+            Message.ALL_ADDR: addr(),
+            Message.CLI_ADDR: b"\x7f\x00\x00\x01",
+        }),
+        (Message.FIND_NODE, {Message.ID: random_id()}),
+        (Message.FIND_VALUE, {Message.ID: random_id()}),
+        (Message.FOUND_NODES, {
+            Message.VALUE: random_id(),
+            Message.NEAREST_NODES: [addr() for _ in range(Config.K)],
+        }),
+        (Message.STORE, {Message.ID: random_id(), Message.VALUE: b"x" * 100}),
+    ]
+    result = []
+    for _ in range(count):
+        peer_id = random.choice(peers)
+        message_type, message = random.choice(parts)
+        message = dict(message)
+        message[Message.MESSAGE_TYPE] = message_type
+        message[Message.RPC_ID] = random_id()
+        message[Message.PEER_ID] = peer_id
+        message[Message.NETWORK_ID] = hash_function(peer_id + network_id)
+        result.append(message)
+    return result
+
+
+class Server(object):
+    """ Just what verify_message needs """
+
+    def __init__(self):
+        self.dht        = self
+        self.network_id = Config.NETWORK_ID
+        self.proofs     = LRUCache(Config.PROOF_CACHE)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    server = Server()
+    handler = DHTRequestHandler((b"", None), ("127.0.0.1", 4000), server)
+    mix = messages(count, Config.NETWORK_ID)
+    for name, verify in (
+            ("old", lambda m: old_verify(m, Config.NETWORK_ID)),
+            ("new", handler.verify_message),
+    ):
+        start = time.time()
+        for message in mix:
+            assert verify(message)
+        duration = time.time() - start
+        print("%-4s %8.0f messages/s" % (name, count / duration))
+
+
+if __name__ == "__main__":
+    main()
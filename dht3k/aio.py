@@ -0,0 +1,663 @@
+""" asyncio interface to the DHT.
+
+The UDP protocol runs on an asyncio.DatagramProtocol, so many concurrent
+lookups can be multiplexed on one eventloop. """
+
+import asyncio
+import functools
+import socket
+import sys
+import time
+
+from .shortlist import Shortlist
+from .node      import Node, _NOT_FOUND
+from .helper    import TimerHeap
+from .peer      import ValuePointer
+from .tcp       import TCPTransfer
+from .server    import DHTRequestHandler
+from .const     import Config, Storage
+from .          import upnp
+from .log       import l
+
+__all__ = ['AsyncDHT']
+
+
+def _on_loop(loop):
+    """ Keyword arguments binding an asyncio primitive to loop. Python 3.10
+    removed the loop argument, the primitives use the running loop. """
+    if sys.version_info < (3, 10):
+        return {"loop": loop}
+    return {}
+
+
+class DHTProtocol(asyncio.DatagramProtocol):
+    """ Handles the datagrams of one address family. It is passed as
+    server to DHTRequestHandler, the transport is exposed as socket so
+    Peer can send through it. """
+
+    def __init__(self, dht):
+        self.dht    = dht
+        self.socket = None
+
+    def connection_made(self, transport):
+        self.socket = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            DHTRequestHandler((data, self.socket), addr, self).handle()
+        except:  # noqa
+            l.exception("Exception in request handler")
+
+    def error_received(self, exc):
+        l.info("Error received: %s", exc)
+
+
+class AsyncDHT(Node, TCPTransfer):
+    """ DHT with coroutine methods, needs to be started using start().
+
+    If tcp is True values larger than Config.TCP_THRESHOLD are transferred
+    over lazymq. """
+
+    def __init__(
+            self,
+            port             = Config.PORT,
+            hostv4           = None,
+            hostv6           = None,
+            id_              = None,
+            listen_hostv4    = "",
+            listen_hostv6    = "",
+            zero_config      = False,
+            default_encoding = None,
+            port_map         = True,
+            network_id       = Config.NETWORK_ID,
+            storage          = Storage.MEMORY,
+            storage_path     = None,
+            snapshot_path    = None,
+            path_cache       = False,
+            log              = True,
+            debug            = True,
+            loop             = None,
+            tcp              = False,
+    ):
+        hostv4, hostv6 = self._setup_node(
+            port,
+            hostv4,
+            hostv6,
+            id_,
+            zero_config,
+            default_encoding,
+            network_id,
+            storage,
+            storage_path,
+            snapshot_path,
+            log,
+            debug,
+        )
+        self.path_cache = path_cache
+        if not loop:
+            loop = asyncio.get_event_loop()
+        self.loop          = loop
+        self.zero_config   = zero_config
+        self.tcp           = tcp
+        self.port_map      = port_map
+        self.listen_hostv4 = listen_hostv4
+        self.listen_hostv6 = listen_hostv6
+        self._bind_hostv4  = hostv4
+        self._bind_hostv6  = hostv6
+        self._transports   = []
+        self._tasks        = []
+        self._closed       = asyncio.Event(**_on_loop(loop))
+        self.timers        = TimerHeap(asyncio.Event(**_on_loop(loop)))
+        self.pong_received = asyncio.Event(**_on_loop(loop))
+
+    def _fw_socket(self, family, listen_host):
+        """ Create the socket used to answer firewall pings """
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_INET6:
+            sock.setsockopt(
+                socket.IPPROTO_IPV6,
+                socket.IPV6_V6ONLY,
+                True,
+            )
+        sock.bind((listen_host, self.peer.port + 1))
+        return sock
+
+    @asyncio.coroutine
+    def _create_endpoint(self, family, listen_host):
+        """ Bind the DHT port and start the protocol """
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_INET6:
+            try:
+                sock.setsockopt(
+                    socket.IPPROTO_IPV6,
+                    socket.IPV6_V6ONLY,
+                    True,
+                )
+            except socket.error:
+                pass
+        sock.bind((listen_host, self.peer.port))
+        transport, protocol = yield from self.loop.create_datagram_endpoint(
+            lambda: DHTProtocol(self),
+            sock=sock,
+        )
+        self._transports.append(transport)
+        return protocol
+
+    @asyncio.coroutine
+    def start(self, boot_host=None, boot_port=None):
+        """ Bind the sockets, bootstrap and start the maintenance tasks.
+
+        This method is a coroutine. """
+        # Detecting dual_stack sockets seems not to work on some OSs
+        # so we always use two sockets
+        if self._bind_hostv6 is not None:
+            self.server6 = yield from self._create_endpoint(
+                socket.AF_INET6,
+                self.listen_hostv6,
+            )
+            self.fw_sock6 = self._fw_socket(
+                socket.AF_INET6,
+                self.listen_hostv6,
+            )
+        if self._bind_hostv4 is not None:
+            self.server4 = yield from self._create_endpoint(
+                socket.AF_INET,
+                self.listen_hostv4,
+            )
+            self.fw_sock4 = self._fw_socket(
+                socket.AF_INET,
+                self.listen_hostv4,
+            )
+        if self.tcp:
+            yield from self._start_tcp()
+            self._tasks.append(asyncio.ensure_future(
+                self._run_tcp(),
+                loop=self.loop,
+            ))
+        if self.port_map:
+            mapped = yield from self.loop.run_in_executor(
+                None,
+                upnp.try_map_port,
+                self.peer.port,
+            )
+            if not mapped:
+                l.warning("UPnP could not map port")
+        if boot_host or self.zero_config:
+            self.firewalled = True
+        self._tasks.append(asyncio.ensure_future(
+            self._run_rpc_timeouts(),
+            loop=self.loop,
+        ))
+        if self.snapshot_peers and (yield from self._warm_start()):
+            self.firewalled = True
+        elif self.zero_config:
+            yield from self._bootstrap(Config.BOOT_HOSTS)
+        elif boot_host:
+            yield from self._bootstrap([(boot_host, boot_port)])
+        for task in (
+                self._run_bucket_refresh(),
+                self._run_check_firewalled(),
+                self._run_republish(),
+                self._run_snapshot(),
+        ):
+            self._tasks.append(asyncio.ensure_future(task, loop=self.loop))
+
+    @asyncio.coroutine
+    def close(self):
+        """ Stop the tasks and close the sockets.
+
+        This method is a coroutine. """
+        self._closed.set()
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            yield from asyncio.wait(self._tasks, **_on_loop(self.loop))
+        for transport in self._transports:
+            transport.close()
+        if self.server4:
+            self.fw_sock4.close()
+        if self.server6:
+            self.fw_sock6.close()
+        self._tasks = []
+        self._transports = []
+        if self.mq is not None:
+            yield from self.mq.close()
+            self.mq = None
+        self._save_snapshot()
+        self._close_storage()
+
+    @asyncio.coroutine
+    def _wait(self, event, timeout):
+        """ Wait for an event, returns False on timeout """
+        try:
+            yield from asyncio.wait_for(
+                event.wait(),
+                timeout,
+                **_on_loop(self.loop)
+            )
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @asyncio.coroutine
+    def _lookup(self, shortlist, rpc):
+        """ Keep Config.ALPHA RPCs in flight until the lookup is complete.
+        A slot is refilled as soon as a response or a timeout arrives. """
+        while True:
+            shortlist.updated.clear()
+            if self._lookup_step(shortlist, rpc):
+                return
+            yield from self._wait(shortlist.updated, Config.LOOKUP_TIMEOUT)
+
+    @asyncio.coroutine
+    def _lookup_many(self, lookups, limit=Config.BATCH_LOOKUPS):
+        """ Drive many lookups sharing one updated event, at most limit
+        run concurrently """
+        if not lookups:
+            return
+        updated = lookups[0][0].updated
+        pending = list(reversed(lookups))
+        running = []
+        while True:
+            updated.clear()
+            running = self._lookup_window(pending, running, limit)
+            if not running:
+                return
+            yield from self._wait(updated, Config.LOOKUP_TIMEOUT)
+
+    def _shortlist(self, key):
+        """ Create a shortlist that notifies the eventloop """
+        shortlist = Shortlist(
+            Config.K,
+            key,
+            self.peer.id,
+            updated=asyncio.Event(**_on_loop(self.loop)),
+        )
+        shortlist.update(self.buckets.nearest_nodes(key))
+        return shortlist
+
+    @asyncio.coroutine
+    def iterative_find_nodes(self, key, boot_peer=None):
+        """ Find the nodes nearest to key.
+
+        This method is a coroutine. """
+        shortlist = self._shortlist(key)
+        rpc = self._find_node_rpc(key)
+        start = time.time()
+        try:
+            if boot_peer:
+                self._start_rpc(shortlist, boot_peer, rpc)
+            yield from self._lookup(shortlist, rpc)
+            return shortlist.results()
+        finally:
+            self._log_lookup("find_nodes", start, shortlist)
+
+    @asyncio.coroutine
+    def iterative_find_value(self, key, limit=None, cursor=None):
+        """ Find the value of a hashed key, raises KeyError if the value
+        is not found. If limit is given a ValuePage of up to limit values
+        of different senders is returned.
+
+        This method is a coroutine. """
+        shortlist = self._shortlist(key)
+        rpc = self._find_value_rpc(key, limit, cursor)
+        start = time.time()
+        try:
+            yield from self._lookup(shortlist, rpc)
+            value = shortlist.completion_result()
+            if isinstance(value, ValuePointer):
+                value = yield from self._fetch_value(value, key)
+            self._cache_on_path(shortlist, value)
+            return value
+        finally:
+            self._log_lookup("find_value", start, shortlist)
+
+    @asyncio.coroutine
+    def _wait_pongs(self, done, timeout):
+        """ Wait till done() returns True, returns False on timeout """
+        deadline = time.time() + timeout
+        while True:
+            self.pong_received.clear()
+            if done():
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            yield from self._wait(self.pong_received, remaining)
+
+    @asyncio.coroutine
+    def _ping_until(self, pings, done):
+        """ Send the pings till done() returns True, they are resent after
+        Config.BOOT_TIMEOUT. Returns False if all retries timed out. """
+        for _ in range(Config.BOOT_RETRIES):
+            self._send_pings(pings)
+            if (yield from self._wait_pongs(done, Config.BOOT_TIMEOUT)):
+                return True
+        return False
+
+    @asyncio.coroutine
+    def _warm_start(self):
+        """ Ping the peers of the snapshot in parallel instead of
+        bootstrapping, returns False if none of them answered """
+        pings = self._create_pings(self.snapshot_peers)
+        expected = min(Config.K, len(pings))
+        try:
+            self._send_pings(pings)
+            yield from self._wait_pongs(
+                lambda: len(self._warm_answered(pings)) >= expected,
+                Config.BOOT_TIMEOUT,
+            )
+            boot_peer = self._warm_result(pings)
+        finally:
+            self._forget_pings(pings)
+        self.snapshot_peers = []
+        if boot_peer is None:
+            l.info("No peer of the snapshot answered")
+            return False
+        self.boot_peer = boot_peer
+        yield from self.iterative_find_nodes(self.peer.id)
+        l.info("DHT is warm started")
+        return True
+
+    @asyncio.coroutine
+    def _bootstrap(self, boot_addrs):
+        """ Discover our addresses and fill the buckets. All resolved
+        addresses of the (host, port) boot_addrs are pinged in parallel,
+        the first peer answering is used. """
+        boot_peers = []
+        for boot_host, boot_port in boot_addrs:
+            try:
+                addrinfos = yield from self.loop.getaddrinfo(
+                    boot_host,
+                    boot_port,
+                    type=socket.SOCK_DGRAM,
+                )
+            except socket.gaierror:
+                l.info("Cannot resolve %s", boot_host)
+                continue
+            boot_peers.extend(self._boot_peers(addrinfos, boot_port))
+
+        pings = self._create_pings(boot_peers)
+        try:
+            yield from self._ping_until(pings, lambda: self._boot_pong(pings))
+            boot_peer = self._boot_pong(pings)
+        finally:
+            self._forget_pings(pings)
+        if boot_peer is None:
+            raise AsyncDHT.NetworkError("Cannot boot DHT")
+
+        pings = self._create_pings([boot_peer])
+        hash_id = pings[0][2]
+        try:
+            yield from self._ping_until(
+                pings,
+                lambda: self._boot_discovered(hash_id, boot_peer),
+            )
+            with self.rpc_states.shard(hash_id) as states:
+                if len(states.get(hash_id, ())) <= 1:
+                    raise AsyncDHT.NetworkError("Cannot boot DHT")
+                self._discov_result(states[hash_id])
+        finally:
+            self._forget_pings(pings)
+
+        for _ in range(2):
+            yield from self.iterative_find_nodes(
+                self.peer.id,
+                boot_peer=boot_peer,
+            )
+            if len(self.buckets):
+                break
+        else:
+            raise AsyncDHT.NetworkError("Cannot boot DHT")
+        self.boot_peer = boot_peer
+        l.info("DHT is bootstrapped")
+
+    @asyncio.coroutine
+    def get(self, key, encoding=None):
+        """ Get the value of key, raises KeyError if it is not found.
+
+        This method is a coroutine. """
+        hashed_key = self._hash_key(key)
+        res = self._get_local(hashed_key)
+        if res is None:
+            res = yield from self._find_value_once(hashed_key)
+        return self._decode(res, encoding)
+
+    @asyncio.coroutine
+    def _find_value_once(self, hashed_key):
+        """ Find the value of a hashed key using the lookup cache, tasks
+        looking up the same key at the same time share one lookup """
+        res = self._get_cached(hashed_key)
+        if res is not None:
+            return res
+        future, owner = self._join_lookup(
+            hashed_key,
+            functools.partial(asyncio.Future, loop=self.loop),
+        )
+        if not owner:
+            res = yield from asyncio.shield(future, **_on_loop(self.loop))
+            return self._joined_result(res)
+        res = _NOT_FOUND
+        complete = False
+        try:
+            res = yield from self.iterative_find_value(hashed_key)
+            complete = True
+        except KeyError:
+            complete = True
+            raise
+        finally:
+            self._end_lookup(hashed_key, future, res, complete)
+        return res
+
+    @asyncio.coroutine
+    def get_values(self, key, limit=Config.MAX_VALUES, encoding=None):
+        """ Get up to limit values stored by different senders under key,
+        the pages are requested till limit is reached. Returns an empty
+        list if the key is not found.
+
+        This method is a coroutine. """
+        hashed_key = self._hash_key(key)
+        values = []
+        cursor = None
+        while len(values) < limit:
+            try:
+                page = yield from self.iterative_find_value(
+                    hashed_key,
+                    limit - len(values),
+                    cursor,
+                )
+            except KeyError:
+                break
+            values.extend(page.values)
+            cursor = page.cursor
+            if cursor is None:
+                break
+        if not values:
+            values = self._get_local_values(hashed_key, limit)
+        return [self._decode(value, encoding) for value in values]
+
+    @asyncio.coroutine
+    def get_many(self, keys, encoding=None, default=None):
+        """ Get the values of many keys, returns a list in the order of
+        keys. default is returned for keys that are not found. The lookups
+        run concurrently and each distinct key is looked up once.
+
+        This method is a coroutine. """
+        hashed_keys = [self._hash_key(key) for key in keys]
+        values, missing = self._batch_local(hashed_keys)
+        lookups = self._batch_lookups(
+            missing,
+            self._find_value_rpc,
+            asyncio.Event(**_on_loop(self.loop)),
+        )
+        start = time.time()
+        yield from self._lookup_many(list(lookups.values()))
+        l.info("get_many: %.5fs (%d)", time.time() - start, len(lookups))
+        for hashed_key, (shortlist, _) in lookups.items():
+            try:
+                value = shortlist.completion_result()
+                if isinstance(value, ValuePointer):
+                    value = yield from self._fetch_value(value, hashed_key)
+                self._cache_on_path(shortlist, value)
+                values[hashed_key] = value
+            except KeyError:
+                pass
+            self._cache_lookup(hashed_key, values.get(hashed_key, _NOT_FOUND))
+        return self._batch_results(hashed_keys, values, encoding, default)
+
+    @asyncio.coroutine
+    def _store(self, nearest_nodes, hashed_key, value, ttl):
+        """ Store value locally and on the nearest nodes """
+        self._set_local(hashed_key, value, ttl)
+        tcp = (
+            self.mq is not None and
+            isinstance(value, bytes) and
+            len(value) > Config.TCP_THRESHOLD
+        )
+        for node in nearest_nodes:
+            if tcp and (yield from self._store_tcp(
+                    node,
+                    hashed_key,
+                    value,
+                    ttl,
+            )):
+                continue
+            node.store(
+                hashed_key,
+                value,
+                dht     = self,
+                peer_id = self.peer.id,
+                ttl     = ttl,
+            )
+
+    @asyncio.coroutine
+    def set(self, key, value, encoding=None, ttl=None):
+        """ Store value under key on the nearest nodes.
+
+        This method is a coroutine. """
+        value = self._encode(value, encoding)
+        hashed_key = self._hash_key(key)
+        nearest_nodes = yield from self.iterative_find_nodes(hashed_key)
+        yield from self._store(nearest_nodes, hashed_key, value, ttl)
+
+    @asyncio.coroutine
+    def set_many(self, items, encoding=None, ttl=None):
+        """ Store many values, items is a dict or an iterable of (key,
+        value) pairs. The lookups of the nearest nodes run concurrently.
+
+        This method is a coroutine. """
+        values = self._batch_items(items, encoding)
+        lookups = self._batch_lookups(
+            values,
+            self._find_node_rpc,
+            asyncio.Event(**_on_loop(self.loop)),
+        )
+        start = time.time()
+        yield from self._lookup_many(list(lookups.values()))
+        l.info("set_many: %.5fs (%d)", time.time() - start, len(lookups))
+        for hashed_key, (shortlist, _) in lookups.items():
+            yield from self._store(
+                shortlist.results(),
+                hashed_key,
+                values[hashed_key],
+                ttl,
+            )
+
+    @asyncio.coroutine
+    def _run_check_firewalled(self):
+        """ Check if we are still firewalled """
+        try:
+            yield from self._wait(self._closed, Config.SLEEP_WAIT)
+            while self.firewalled:
+                self.boot_peer.fw_ping(self, self.peer.id)
+                l.info("Executed firewall check")
+                if (yield from self._wait(
+                        self._closed,
+                        Config.FIREWALL_CHECK
+                )):
+                    return
+        finally:
+            l.info("run_check_firewalled ended")
+
+    @asyncio.coroutine
+    def _refresh_buckets(self):
+        """ Find nodes at a random id in the range of the buckets that were
+        not active for Config.BUCKET_REFRESH, the lookups run concurrently.
+
+        This method is a coroutine. """
+        keys = self._refresh_keys(time.time())
+        lookups = self._batch_lookups(
+            keys,
+            self._find_node_rpc,
+            asyncio.Event(**_on_loop(self.loop)),
+        )
+        yield from self._lookup_many(
+            list(lookups.values()),
+            Config.REFRESH_BATCH,
+        )
+        if keys:
+            l.info("Refreshed %d buckets", len(keys))
+
+    @asyncio.coroutine
+    def _run_bucket_refresh(self):
+        """ Refresh the stale buckets every Config.REFRESH_CHECK """
+        try:
+            while True:
+                yield from self._refresh_buckets()
+                if (yield from self._wait(
+                        self._closed,
+                        Config.REFRESH_CHECK,
+                )):
+                    return
+        finally:
+            l.info("run_bucket_refresh ended")
+
+    @asyncio.coroutine
+    def _run_republish(self):
+        """ Store the values again on the nearest nodes, so they survive
+        churn. The keys of a round are spread over Config.REPUBLISH. """
+        try:
+            while True:
+                start = time.time()
+                due = self._republish_due(start)
+                delay = self._republish_delay(len(due))
+                for key, senders in due.items():
+                    nearest_nodes = yield from self.iterative_find_nodes(key)
+                    self._republish(key, senders, nearest_nodes)
+                    if (yield from self._wait(self._closed, delay)):
+                        return
+                if due:
+                    l.info("Republished %d keys", len(due))
+                if (yield from self._wait(
+                        self._closed,
+                        max(0, start + Config.REPUBLISH - time.time()),
+                )):
+                    return
+        finally:
+            l.info("run_republish ended")
+
+    @asyncio.coroutine
+    def _run_snapshot(self):
+        """ Save the routing table snapshot every Config.SNAPSHOT_SAVE """
+        try:
+            while not (yield from self._wait(
+                    self._closed,
+                    Config.SNAPSHOT_SAVE,
+            )):
+                self._save_snapshot()
+        finally:
+            l.info("run_snapshot ended")
+
+    @asyncio.coroutine
+    def _run_rpc_timeouts(self):
+        """ Expire each RPC at its deadline """
+        try:
+            while not self._closed.is_set():
+                self.timers.changed.clear()
+                self._expire_rpcs(time.time())
+                yield from self._wait(
+                    self.timers.changed,
+                    self.timers.next_timeout(time.time()),
+                )
+        finally:
+            l.info("run_rpc_timeouts ended")
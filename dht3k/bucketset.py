@@ -1,96 +1,188 @@
 """ Handling the bucketset """
 import heapq
+import random
 import threading
 import collections
 import time
-import binascii
 
 from .peer    import Peer
 from .hashing import bytes2int, rpc_id_pair
-from .log     import l
 from .const   import Config
 
 
 def largest_differing_bit(value1, value2):
-    int1 = bytes2int(value1)
-    int2 = bytes2int(value2)
-    distance = int1 ^ int2
-    length = -1
-    while (distance):
-        distance >>= 1
-        length += 1
-    return max(0, length)
+    distance = bytes2int(value1) ^ bytes2int(value2)
+    return max(0, distance.bit_length() - 1)
 
 
 class BucketSet(object):
+    """ The routing table. Buckets map the integer id of a peer to the
+    peer, ordered from the least to the most recently seen peer.
+
+    Peers seen while their bucket is full wait in the replacement cache of
+    the bucket. They take the slot of a peer that did not answer a ping or
+    failed Config.MAX_FAILURES RPCs. """
+
     def __init__(self, bucket_size, buckets, id_):
         self.id = id_
+        self.int_id = bytes2int(id_)
         self.bucket_size = bucket_size
         self.buckets = [collections.OrderedDict() for _ in range(buckets)]
+        self.replacements = [
+            collections.OrderedDict() for _ in range(buckets)
+        ]
+        # Time of the last insert or refresh of each bucket
+        self.activity = [0.0] * buckets
+        # Integer ids of the peers pinged to check if they are alive
+        self.pinged = set()
         self.lock = threading.Lock()
 
+    def bucket_index(self, int_id):
+        """ Index of the bucket for the peer with integer id int_id """
+        return max(0, (self.int_id ^ int_id).bit_length() - 1)
+
+    def random_id(self, index):
+        """ A random id in the range of bucket index """
+        if index:
+            distance = 1 << index | random.getrandbits(index)
+        else:
+            distance = random.getrandbits(1)
+        return (self.int_id ^ distance).to_bytes(len(self.id), 'big')
+
+    def touch(self, index, now):
+        """ Mark bucket index as active """
+        self.activity[index] = now
+
+    def stale(self, before):
+        """ Indexes of the buckets not active since before. Buckets nearer
+        than the nearest non-empty bucket are skipped, the lookups of the
+        nearest bucket already cover them. """
+        with self.lock:
+            filled = [
+                index for index, bucket in enumerate(self.buckets) if bucket
+            ]
+            if not filled:
+                return []
+            return [
+                index for index in range(filled[0], len(self.buckets))
+                if self.activity[index] < before
+            ]
+
     def insert(self, peer, server, from_pong=False):
+        """ Insert a peer we received a message from. If its bucket is full
+        the peer is put in the replacement cache and the least recently
+        seen peer of the bucket is pinged. """
         assert isinstance(peer, Peer)
-        if peer.id != self.id:
-            bucket_number = largest_differing_bit(self.id, peer.id)
-            if from_pong:
-                # Almost certainly this peer is not firewalled
-                # we set the well connected flag
-                peer.well_connected = True
-            peer_tuple = peer.astuple()
-            with self.lock:
-                bucket = self.buckets[bucket_number]
-                old_peer = None
-                try:
-                    old_peer = Peer(
-                        *bucket[peer.id],
-                        is_bytes=True
-                    )
-                except KeyError:
-                    pass
-                if old_peer:
-                    del bucket[peer.id]
-                    if not peer.hostv4:
-                        peer.hostv4 = old_peer.hostv4
-                    if not peer.hostv6:
-                        peer.hostv6 = old_peer.hostv6
-                    bucket[peer.id] = peer.astuple()
-                elif len(bucket) >= self.bucket_size:
-                    if from_pong:
-                        bucket.popitem(-1)
-                        items = list(bucket.items())
-                        # Putting the pinged node in the 1/4 (%25) of the
-                        # bucket is a simple async emultion of the protocol
-                        # defined by kademlia, I hope it works ;-)
-                        items.insert(
-                            int(self.bucket_size * 0.25),
-                            (
-                                peer.id,
-                                peer_tuple
-                            )
-                        )
-                        bucket = collections.OrderedDict(items)
-                        self.buckets[bucket_number] = bucket
-                        l.debug(
-                            "Live peer reinserted: %s",
-                            binascii.hexlify(peer.id)
-                        )
-                    else:
-                        pop_peer = Peer(
-                            *bucket.popitem(0)[1],
-                            is_bytes=True
-                        )
-                        rpc_id, hash_id = rpc_id_pair()
-                        with server.dht.rpc_states as states:
-                            states[hash_id] = [time.time()]
-                        pop_peer.ping(
-                            server.dht,
-                            server.dht.peer.id,
-                            rpc_id
-                        )
-                        bucket[peer.id] = peer_tuple
-                else:
-                    bucket[peer.id] = peer_tuple
+        if peer.id == self.id:
+            return
+        peer.last_seen = time.time()
+        int_id = bytes2int(peer.id)
+        bucket_number = self.bucket_index(int_id)
+        if from_pong:
+            # Almost certainly this peer is not firewalled
+            # we set the well connected flag
+            peer.well_connected = True
+        with self.lock:
+            self.activity[bucket_number] = peer.last_seen
+            bucket = self.buckets[bucket_number]
+            old_peer = bucket.pop(int_id, None)
+            if old_peer:
+                if not peer.hostv4:
+                    peer.hostv4 = old_peer.hostv4
+                if not peer.hostv6:
+                    peer.hostv6 = old_peer.hostv6
+                peer.rtt = old_peer.rtt
+                # Moves the peer to the end, it is the most recently seen
+                bucket[int_id] = peer
+                return
+            if len(bucket) < self.bucket_size:
+                bucket[int_id] = peer
+                return
+            replacements = self.replacements[bucket_number]
+            replacements.pop(int_id, None)
+            replacements[int_id] = peer
+            if len(replacements) > Config.REPLACEMENTS:
+                replacements.popitem(last=False)
+            oldest_id, oldest = next(iter(bucket.items()))
+            if oldest_id in self.pinged:
+                return
+            self.pinged.add(oldest_id)
+        rpc_id, hash_id = rpc_id_pair()
+        server.dht.register_rpc(
+            hash_id,
+            [time.time(), oldest],
+            Config.PING_TIMEOUT,
+        )
+        oldest.ping(
+            server.dht,
+            server.dht.peer.id,
+            rpc_id
+        )
+
+    def _replace(self, bucket_number, int_id):
+        """ Remove the peer int_id from the bucket, the most recently seen
+        peer of the replacement cache takes its slot. The lock has to be
+        held. """
+        del self.buckets[bucket_number][int_id]
+        replacements = self.replacements[bucket_number]
+        if replacements:
+            new_id, new_peer = replacements.popitem()
+            self.buckets[bucket_number][new_id] = new_peer
+
+    def ping_expired(self, peer, sent):
+        """ The liveness ping sent to peer at sent expired, the peer is
+        replaced if it was not seen since """
+        int_id = bytes2int(peer.id)
+        bucket_number = self.bucket_index(int_id)
+        with self.lock:
+            self.pinged.discard(int_id)
+            current = self.buckets[bucket_number].get(int_id)
+            if current is not None and current.last_seen < sent:
+                self._replace(bucket_number, int_id)
+
+    def failed(self, peer_id):
+        """ A RPC sent to peer_id timed out, the peer is replaced after
+        Config.MAX_FAILURES timeouts if there is a replacement """
+        int_id = bytes2int(peer_id)
+        bucket_number = self.bucket_index(int_id)
+        with self.lock:
+            peer = self.buckets[bucket_number].get(int_id)
+            if peer is None:
+                return
+            peer.failures += 1
+            if (
+                    peer.failures >= Config.MAX_FAILURES and
+                    self.replacements[bucket_number]
+            ):
+                self._replace(bucket_number, int_id)
+
+    def record_rtt(self, peer_id, rtt):
+        """ Add a round trip time measured by a RPC to the exponentially
+        weighted average of peer_id """
+        int_id = bytes2int(peer_id)
+        with self.lock:
+            peer = self.buckets[self.bucket_index(int_id)].get(int_id)
+            if peer is None:
+                return
+            if peer.rtt is None:
+                peer.rtt = rtt
+            else:
+                peer.rtt += Config.RTT_WEIGHT * (rtt - peer.rtt)
+
+    def latency(self, peer_id):
+        """ Average round trip time of peer_id, None if it is unknown and
+        infinite if its last RPCs timed out """
+        int_id = bytes2int(peer_id)
+        with self.lock:
+            peer = self.buckets[self.bucket_index(int_id)].get(int_id)
+            if peer is None:
+                return None
+            if peer.failures:
+                return float("inf")
+            return peer.rtt
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
 
     def peers(self):
         return (peer for bucket in self.buckets for peer in bucket.values())
@@ -102,21 +194,45 @@ class BucketSet(object):
 
     def nearest_nodes(self, key, limit=None):
         num_results = limit if limit else self.bucket_size
+        ikey = bytes2int(key)
+        distance = self.int_id ^ ikey
+
+        def bucket_distance(index):
+            """ The peers in bucket index are at a distance to key within
+            [bucket_distance(index), bucket_distance(index) + 2 ** index) """
+            return ((distance >> index) ^ 1) << index
+
+        def keyfunction(item):
+            """ Distance to key, well connected peers are returned first and
+            peers with timed out RPCs last """
+            int_id, peer = item
+            if peer.well_connected:
+                penalty = 0
+            else:
+                # This peer is probably firewalled, return it after
+                # well connected peers
+                penalty = Config.FW_PENALTY
+            if peer.failures:
+                penalty += 2 * Config.FW_PENALTY
+            return (ikey ^ int_id) + penalty
+
         with self.lock:
-            def keyfunction(peer):
-                ikey  = bytes2int(key)
-                ipeer = bytes2int(peer[1])
-                if peer[4]:
-                    penalty = 0
-                else:
-                    # This peer is probably firewalled, return it after
-                    # well connected peers
-                    penalty = Config.FW_PENALTY
-                return (ikey ^ ipeer) + penalty
-            peers = self.peers()
-            # When sorting well connected nodes are returned first
-            best_peers = heapq.nsmallest(num_results, peers, keyfunction)
-            return [Peer(
-                *peer,
-                is_bytes=True
-            ) for peer in best_peers]
+            order = sorted(
+                [index for index, bucket in enumerate(self.buckets) if bucket],
+                key=bucket_distance,
+            )
+            # The buckets are walked from the nearest to the farthest, once
+            # we have enough well connected peers the remaining buckets can
+            # only contain peers that are farther away
+            items = []
+            connected = 0
+            for index in order:
+                bucket = self.buckets[index]
+                items.extend(bucket.items())
+                for peer in bucket.values():
+                    if peer.well_connected and not peer.failures:
+                        connected += 1
+                if connected >= num_results:
+                    break
+            best_peers = heapq.nsmallest(num_results, items, keyfunction)
+            return [peer for (_, peer) in best_peers]
@@ -15,15 +15,54 @@ class Config(object):
     """ Config constants """
     K              = 20
     ALPHA          = 3
-    FW_PENALTY     = 2 ** (ID_BITS + 1)
-    SLEEP_WAIT     = 1
     ID_BYTES       = lazyconst.Config.HASH_BYTES
     ID_BITS        = lazyconst.Config.HASH_BITS
+    FW_PENALTY     = 2 ** (ID_BITS + 1)
+    SLEEP_WAIT     = 1
+    LOOKUP_TIMEOUT = 1  # Per RPC timeout while looking up nodes/values
     BUCKET_REFRESH = 1200  # NATs should all be timeouted after that time!
+    REFRESH_CHECK  = 60  # Interval of looking for buckets to refresh
+    REFRESH_BATCH  = 4  # Bucket refresh lookups run concurrently
     FIREWALL_CHECK = 3600
     PORT           = 7339
+    BOOT_HOSTS     = (  # Boot peers used by zero_config
+        ("31.171.244.153", PORT),
+        ("2001:470:7:ab::2", PORT),
+    )
+    BOOT_TIMEOUT   = 1  # Wait for pongs before the boot pings are resent
+    BOOT_RETRIES   = 3
     RPC_TIMEOUT    = 30
+    PING_TIMEOUT   = 5  # The oldest peer of a full bucket is evicted if it
+                        # does not answer in time
+    MAX_FAILURES   = 3  # Timeouts before a peer is replaced
+    REPLACEMENTS   = 8  # Peers waiting for a free slot in a full bucket
+    RTT_WEIGHT     = 0.125  # Weight of a new sample in the RTT average
+    DEFAULT_RTT    = 0.2  # Assumed RTT of peers not measured yet
+    RTT_WINDOW     = 2  # Pending peers per free slot considered by a lookup
+    RPC_SHARDS     = 64  # Locks of the rpc_states table
+    PROOF_CACHE    = 4096  # Verified network proofs of peers
+    LOOKUP_CACHE   = 4096  # Results of value lookups
+    CACHE_TTL      = 30  # Time a found value is cached
+    NEGATIVE_TTL   = 5  # Time a missing value is cached
+    PATH_CACHE_TTL = 3600  # TTL of a path cached value, halved per peer
+                           # nearer to the key
+    FRAG_BUFFER    = 4 * 1024 ** 2  # Bytes of incomplete fragmented messages
+    FRAG_OVERHEAD  = 256  # Bytes charged per incomplete message
+    STORAGE_PATH   = "dht3k-%d.sqlite"  # Formatted with the port
+    SNAPSHOT_SAVE  = 600  # Interval of saving the routing table snapshot
+    STORAGE_LIMIT  = 64 * 1024 ** 2  # Bytes of all stored values
+    SENDER_QUOTA   = 1024 ** 2  # Bytes of the values stored by one peer
+    VALUE_TTL      = 86400  # Maximal time a value is stored
+    MAX_VALUES     = 32  # Values of different senders stored per key
+    REPUBLISH      = 3600  # Values not received for that time are stored
+                           # again on the nearest nodes
+    REPUBLISH_RATE = 20  # Maximal keys republished per second
+    EXPIRE_BATCH   = 16  # Expired values removed per store
     WORKERS        = 40
+    RECV_BATCH     = 64  # Datagrams received before select is called again
+    BATCH_LOOKUPS  = 32  # Lookups of get_many/set_many run concurrently
+    TCP_OFFSET     = 2  # The lazymq port is PORT + TCP_OFFSET
+    TCP_THRESHOLD  = 8 * 1024  # Larger values are transferred over TCP
     NETWORK_ID     = (
         b'\xc4\x82{\x0e\xf3\x99\x9f\x10.m=\x12\xef3\x19['
         b'Q\xac\x14G\xc9\x8ft\xb5\xb2z\xb6\x84\x91$\xac\x03'
@@ -41,6 +80,9 @@ class MinMax(object):
     MAX_IP_LEN     = 16
     MIN_IP_LEN     = 4
     PEER_TUPLE_LEN = 4
+    MAX_FRAGMENTS  = 64     # A value can be up to ~80KB
+    MAX_FRAG_ID    = 8
+    PAGE_SIZE      = 1200   # Bytes of values in a page of FOUND_VALUE
 
 min_max_dict = _consts_to_dict(MinMax)
 
@@ -65,10 +107,36 @@ class Message(object):
     FW_PING       = 15
     FW_PONG       = 16
     NETWORK_ID    = 17
+    TTL           = 18
+    NODE_FORMAT   = 19
+    COMPACT_NODES = 20
+    FRAGMENT      = 21
+    TCP_PORT      = 22
+    FETCH_VALUE   = 23  # Only sent over TCP
+    LIMIT         = 24
+    CURSOR        = 25
+    VALUES        = 26
+    ORIGIN        = 27  # Sender of a republished value
+    CACHED        = 28  # Store of a path cached copy
 
 message_dict = _consts_to_dict(Message)
 
 
+class PeerState(object):
+    """ State of a peer in a lookup """
+    PENDING   = 0
+    IN_FLIGHT = 1
+    RESPONDED = 2
+    FAILED    = 3
+
+
+class NodeFormat(object):
+    """ Encoding of the nodes in FOUND_NODES, a FIND_NODE/FIND_VALUE sends
+    the latest format it understands in Message.NODE_FORMAT """
+    TUPLES  = 0  # Message.NEAREST_NODES: list of peer tuples
+    COMPACT = 1  # Message.COMPACT_NODES: packed records
+
+
 class Storage(object):
     """ Storage type """
     NONE   = None
@@ -0,0 +1,217 @@
+""" Encoding of messages """
+
+import ipaddress
+import os
+import struct
+import six
+import msgpack
+
+from .hashing   import hash_function
+from .peer      import Peer
+from .const     import Message, MinMax, Config
+from .excepions import MaxSizeException
+
+_FIXMAP     = 0x80
+_FIXMAP_MAX = 15
+_BIN_HEADER = 5  # Largest msgpack header of a bytes value
+
+# Only the value of these messages can be split into fragments
+_FRAGMENTED = frozenset((
+    Message.STORE,
+    Message.FOUND_VALUE,
+))
+
+
+def _largest_parts():
+    """ Fragments of STORE and FOUND_VALUE with the largest fields and an
+    empty value. The chunks have to fit next to both, so a value that can
+    be stored can also be returned. """
+    id_ = b"\xff" * Config.ID_BYTES
+    fragment = (
+        b"\xff" * MinMax.MAX_FRAG_ID,
+        MinMax.MAX_FRAGMENTS,
+        MinMax.MAX_FRAGMENTS,
+    )
+    return (
+        {
+            Message.MESSAGE_TYPE: Message.STORE,
+            Message.ID: id_,
+            Message.VALUE: b"",
+            Message.TTL: 2 ** 64 - 1,
+            Message.ORIGIN: id_,
+            Message.CACHED: True,
+            Message.FRAGMENT: fragment,
+        },
+        {
+            Message.MESSAGE_TYPE: Message.FOUND_VALUE,
+            Message.ID: id_,
+            Message.RPC_ID: id_,
+            Message.VALUE: b"",
+            Message.FRAGMENT: fragment,
+        },
+    )
+
+
+class MessageEncoder(object):
+    """ Encodes the messages sent by a node.
+
+    The sender id and the network proof are the same in every message, so
+    they are hashed and packed once. A message is packed without them and
+    the packed header is spliced in after the map header. """
+
+    def __init__(self, network_id):
+        self.network_id = network_id
+        self.proofs     = {}
+        self.headers    = {}
+        self.chunks     = {}
+
+    def proof(self, peer_id):
+        """ Network proof of peer_id """
+        try:
+            return self.proofs[peer_id]
+        except KeyError:
+            proof = hash_function(peer_id + self.network_id)
+            self.proofs[peer_id] = proof
+            return proof
+
+    def header(self, peer_id):
+        """ Packed sender id and network proof of peer_id """
+        try:
+            return self.headers[peer_id]
+        except KeyError:
+            header = b"".join((
+                msgpack.dumps(Message.PEER_ID),
+                msgpack.dumps(peer_id),
+                msgpack.dumps(Message.NETWORK_ID),
+                msgpack.dumps(self.proof(peer_id)),
+            ))
+            self.headers[peer_id] = header
+            return header
+
+    def encode(self, message, peer_id):
+        """ Pack message sent by peer_id """
+        size = len(message) + 2
+        if size > _FIXMAP_MAX or Message.PEER_ID in message:
+            message = dict(message)
+            message[Message.PEER_ID] = peer_id
+            message[Message.NETWORK_ID] = self.proof(peer_id)
+            return msgpack.dumps(message)
+        # A map with less than 16 items has a one byte header
+        return b"".join((
+            six.int2byte(_FIXMAP | size),
+            self.header(peer_id),
+            msgpack.dumps(message)[1:],
+        ))
+
+    def chunk_size(self, peer_id):
+        """ Bytes of the value in one fragment sent by peer_id, the same
+        for STORE and FOUND_VALUE """
+        try:
+            return self.chunks[peer_id]
+        except KeyError:
+            overhead = max(
+                len(self.encode(part, peer_id)) for part in _largest_parts()
+            )
+            chunk = MinMax.MAX_MSG_SIZE - overhead - _BIN_HEADER
+            self.chunks[peer_id] = chunk
+            return chunk
+
+    def max_value_size(self, peer_id):
+        """ Largest value peer_id can send in fragments """
+        return self.chunk_size(peer_id) * MinMax.MAX_FRAGMENTS
+
+    def datagrams(self, message, peer_id):
+        """ Pack message sent by peer_id into datagrams. STORE and
+        FOUND_VALUE messages with a large value are split into fragments,
+        other messages have to fit into one datagram. """
+        encoded = self.encode(message, peer_id)
+        if len(encoded) <= MinMax.MAX_MSG_SIZE:
+            return [encoded]
+        value = message.get(Message.VALUE)
+        if (
+                message[Message.MESSAGE_TYPE] not in _FRAGMENTED or
+                not isinstance(value, bytes)
+        ):
+            raise MaxSizeException(
+                "Message size max not exceed %d bytes" % MinMax.MAX_MSG_SIZE
+            )
+        frag_id = os.urandom(MinMax.MAX_FRAG_ID)
+        part = dict(message)
+        part[Message.VALUE] = b""
+        part[Message.FRAGMENT] = (
+            frag_id,
+            MinMax.MAX_FRAGMENTS,
+            MinMax.MAX_FRAGMENTS,
+        )
+        chunk = min(
+            self.chunk_size(peer_id),
+            MinMax.MAX_MSG_SIZE - len(self.encode(part, peer_id)) -
+            _BIN_HEADER,
+        )
+        count = (len(value) + chunk - 1) // chunk
+        if count > MinMax.MAX_FRAGMENTS:
+            raise MaxSizeException(
+                "Value size max not exceed %d fragments" % (
+                    MinMax.MAX_FRAGMENTS
+                )
+            )
+        datagrams = []
+        for index in range(count):
+            part[Message.VALUE] = value[index * chunk:(index + 1) * chunk]
+            part[Message.FRAGMENT] = (frag_id, index, count)
+            datagrams.append(self.encode(part, peer_id))
+        return datagrams
+
+
+# Compact node record: id, port, flags followed by the packed IPv4 address
+# if flags & _HAS_V4 and the packed IPv6 address if flags & _HAS_V6
+_NODE    = struct.Struct("!%dsHB" % Config.ID_BYTES)
+_HAS_V4  = 1
+_HAS_V6  = 2
+_V4_SIZE = 4
+_V6_SIZE = 16
+
+
+def pack_nodes(peers):
+    """ Pack peers into compact node records """
+    parts = []
+    for peer in peers:
+        flags = 0
+        if peer.hostv4:
+            flags |= _HAS_V4
+        if peer.hostv6:
+            flags |= _HAS_V6
+        parts.append(_NODE.pack(peer.id, peer.port, flags))
+        if peer.hostv4:
+            parts.append(peer.hostv4.packed)
+        if peer.hostv6:
+            parts.append(peer.hostv6.packed)
+    return b"".join(parts)
+
+
+def unpack_nodes(data):
+    """ Unpack compact node records into peers, raises ValueError if the
+    records are malformed """
+    view  = memoryview(data)
+    end   = len(view)
+    pos   = 0
+    peers = []
+    while pos < end:
+        if pos + _NODE.size > end:
+            raise ValueError("Truncated node record")
+        id_, port, flags = _NODE.unpack_from(view, pos)
+        pos += _NODE.size
+        if port < 1024:
+            raise ValueError("Ports below 1024 are not allowed")
+        hostv4 = None
+        hostv6 = None
+        if flags & _HAS_V4:
+            hostv4 = ipaddress.IPv4Address(view[pos:pos + _V4_SIZE].tobytes())
+            pos += _V4_SIZE
+        if flags & _HAS_V6:
+            hostv6 = ipaddress.IPv6Address(view[pos:pos + _V6_SIZE].tobytes())
+            pos += _V6_SIZE
+        if pos > end:
+            raise ValueError("Truncated node record")
+        peers.append(Peer(port, id_, hostv4, hostv6))
+    return peers
@@ -0,0 +1,97 @@
+""" Reassembly of fragmented messages
+
+STORE and FOUND_VALUE messages with a value larger than one datagram are
+sent as fragments, see MessageEncoder.datagrams(). Each fragment is the
+original message with a chunk of the value and Message.FRAGMENT set to
+(fragment id, index, count). """
+
+import collections
+import threading
+import time
+
+from .const import Message, Config
+
+
+class Buffer(object):
+    """ The fragments of one message received so far """
+    __slots__ = (
+        'start',
+        'count',
+        'parts',
+        'size',
+    )
+
+    def __init__(self, start, count):
+        self.start = start
+        self.count = count
+        self.parts = {}
+        self.size  = 0
+
+
+class Reassembly(object):
+    """ Buffers fragments by sender and fragment id till all parts of a
+    message arrived. At most limit bytes are buffered, every message is
+    charged overhead bytes besides its chunks. If more arrive the oldest
+    messages are dropped. Incomplete messages are dropped after timeout.
+    """
+
+    def __init__(
+            self,
+            limit    = Config.FRAG_BUFFER,
+            timeout  = Config.RPC_TIMEOUT,
+            overhead = Config.FRAG_OVERHEAD,
+    ):
+        self.limit    = limit
+        self.timeout  = timeout
+        self.overhead = overhead
+        self.size     = 0
+        self.buffers  = collections.OrderedDict()
+        self.lock     = threading.Lock()
+
+    def _drop_oldest(self):
+        """ Drop the oldest incomplete message """
+        buf = self.buffers.popitem(False)[1]
+        self.size -= buf.size
+
+    def _expire(self, now):
+        """ Drop the incomplete messages older than timeout """
+        while self.buffers:
+            oldest = next(iter(self.buffers.values()))
+            if oldest.start + self.timeout > now:
+                return
+            self._drop_oldest()
+
+    def add(self, message, now=None):
+        """ Add a fragment, returns the reassembled message when all
+        fragments arrived, else None """
+        if now is None:
+            now = time.time()
+        frag_id, index, count = message.pop(Message.FRAGMENT)
+        key   = (message[Message.PEER_ID], frag_id)
+        chunk = message[Message.VALUE]
+        with self.lock:
+            self._expire(now)
+            buf = self.buffers.get(key)
+            if buf is None:
+                buf = Buffer(now, count)
+                buf.size = self.overhead
+                self.size += self.overhead
+                self.buffers[key] = buf
+            if buf.count != count or index in buf.parts:
+                return None
+            buf.parts[index] = chunk
+            buf.size  += len(chunk)
+            self.size += len(chunk)
+            if len(buf.parts) < count:
+                while self.size > self.limit:
+                    self._drop_oldest()
+                return None
+            del self.buffers[key]
+            self.size -= buf.size
+        message[Message.VALUE] = b"".join(
+            buf.parts[x] for x in range(count)
+        )
+        return message
+
+    def __len__(self):
+        return len(self.buffers)
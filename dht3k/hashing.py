@@ -1,7 +1,7 @@
 # pylint: disable=wildcard-import,unused-wildcard-import
 """ Hashing has been moved to lazymq """
-from .const         import Config
 from lazymq.hashing import *
+from .const         import Config
 
 def rpc_to_hash_id(rpc_id):
     return hash_function(rpc_id + Config.NETWORK_ID)
@@ -1,7 +1,12 @@
 """ Helpers """
 
+import collections
+import heapq
 import six
 import threading
+import time
+
+from .const import Config
 
 if six.PY3:
     def sixunicode(data, is_bytes=False):
@@ -27,3 +32,112 @@ class LockedDict(object):
     def __exit__(self, type_, value, traceback):
         """ Unlock after ids are used """
         self.lock.release()
+
+
+class LRUCache(object):
+    """ Dict holding at most size items, the least recently used item is
+    removed first """
+    def __init__(self, size):
+        self.size  = size
+        self.dict_ = collections.OrderedDict()
+        self.lock  = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Get the value of key and mark it as recently used """
+        with self.lock:
+            try:
+                value = self.dict_.pop(key)
+            except KeyError:
+                return default
+            self.dict_[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.dict_.pop(key, None)
+            self.dict_[key] = value
+            if len(self.dict_) > self.size:
+                self.dict_.popitem(False)
+
+    def __len__(self):
+        return len(self.dict_)
+
+
+class TTLCache(LRUCache):
+    """ LRUCache whose items expire """
+
+    def get(self, key, default=None):
+        """ Get the value of key if it has not expired """
+        item = LRUCache.get(self, key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires <= time.time():
+            self.discard(key)
+            return default
+        return value
+
+    def set(self, key, value, ttl):
+        """ Set the value of key for ttl seconds """
+        self[key] = (time.time() + ttl, value)
+
+    def discard(self, key):
+        """ Remove key if it exists """
+        with self.lock:
+            self.dict_.pop(key, None)
+
+
+class ShardedDict(object):
+    """ Dict split into shards with a LockedDict each, so threads working
+    on different keys do not wait for each other. The keys (hash_ids) are
+    random, so they spread evenly over the shards. """
+    def __init__(self, shards=Config.RPC_SHARDS):
+        self.shards = [LockedDict() for _ in range(shards)]
+
+    def shard(self, key):
+        """ Get the LockedDict holding key """
+        return self.shards[hash(key) % len(self.shards)]
+
+    def __len__(self):
+        return sum(len(shard.dict_) for shard in self.shards)
+
+
+class TimerHeap(object):
+    """ Deadlines of RPCs in a heap. changed is set if a new deadline is the
+    earliest, so the waiting task can shorten its timeout. AsyncDHT passes
+    an asyncio.Event.
+
+    Entries of answered RPCs are not removed, they are dropped when their
+    deadline passes, so the heap holds at most the RPCs of one timeout. """
+    def __init__(self, changed=None):
+        self.heap = []
+        self.lock = threading.Lock()
+        if changed is None:
+            changed = threading.Event()
+        self.changed = changed
+
+    def schedule(self, deadline, key):
+        """ Add the deadline of key """
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, key))
+            earliest = self.heap[0][1] == key
+        if earliest:
+            self.changed.set()
+
+    def expired(self, now):
+        """ Remove and return the keys that passed their deadline """
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expired.append(heapq.heappop(self.heap)[1])
+        return expired
+
+    def next_timeout(self, now):
+        """ Time until the next deadline """
+        with self.lock:
+            if not self.heap:
+                return Config.RPC_TIMEOUT
+            return max(0, self.heap[0][0] - now)
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,584 @@
+""" Parts of a DHT node shared by the threaded and the asyncio interface """
+
+import collections
+import ipaddress
+import socket
+import threading
+import time
+import msgpack
+
+from .bucketset import BucketSet
+from .hashing   import hash_function, rpc_id_pair, random_id
+from .peer      import Peer, ValuePage, ValuePointer
+from .shortlist import Shortlist
+from .helper    import ShardedDict, TimerHeap, LRUCache, TTLCache
+from .helper    import LockedDict, sixunicode
+from .storage   import create_storage
+from .encoder   import MessageEncoder
+from .fragment  import Reassembly
+from .const     import Message, Config
+from .          import excepions
+from .          import snapshot
+from .log       import log_to_stderr, l
+
+# Cached and passed to the waiting callers if a value lookup failed
+_NOT_FOUND = object()
+
+
+class Node(object):
+    """ Partial class for a DHT node, holds the state and everything that
+    does not block.
+
+    Needs to be inherited by DHT and AsyncDHT. """
+
+    MaxSizeException = excepions.MaxSizeException
+    NetworkError     = excepions.NetworkError
+
+    def _setup_node(
+            self,
+            port,
+            hostv4,
+            hostv6,
+            id_,
+            zero_config,
+            default_encoding,
+            network_id,
+            storage,
+            storage_path,
+            snapshot_path,
+            log,
+            debug,
+    ):
+        """ Setup the state of the node, returns hostv4 and hostv6. If they
+        are not None sockets should be bound for the protocol. """
+        if log:
+            log_to_stderr(debug)
+        self.snapshot_path = snapshot_path
+        self.snapshot_peers = []
+        if snapshot_path:
+            snap_id, self.snapshot_peers = snapshot.load(
+                snapshot_path,
+                network_id,
+            )
+            if not id_:
+                id_ = snap_id
+        if not id_:
+            id_ = random_id()
+        if port < 1024:
+            raise Node.NetworkError("Ports below 1024 are not allowed")
+        self.firewalled = False
+        self.encoding = default_encoding
+        self.peer = Peer(port, id_, hostv4, hostv6)
+        self.data = create_storage(storage, port, storage_path)
+        self.buckets = BucketSet(Config.K, Config.ID_BITS, self.peer.id)
+        self.rpc_states = ShardedDict()
+        self.timers = TimerHeap()
+        self.pong_received = threading.Event()
+        self.server4 = None
+        self.server6 = None
+        self.boot_peer = None
+        self.network_id = network_id
+        self.encoder = MessageEncoder(network_id)
+        self.proofs = LRUCache(Config.PROOF_CACHE)
+        self.lookup_cache = TTLCache(Config.LOOKUP_CACHE)
+        self.flights = LockedDict()
+        self.fragments = Reassembly()
+        self.mq = None
+        if not hostv4:
+            if zero_config:
+                hostv4 = ""
+            self.hostv4 = hostv4
+        else:
+            self.hostv4  = ipaddress.ip_address(hostv4)
+        if not hostv6:
+            if zero_config:
+                hostv6 = ""
+            self.hostv6 = hostv6
+        else:
+            self.hostv6  = ipaddress.ip_address(hostv6)
+        return hostv4, hostv6
+
+    def register_rpc(self, hash_id, state, timeout):
+        """ Add the state of a RPC, it is removed after timeout. The first
+        item of state is the start time, lookups add their shortlist. """
+        with self.rpc_states.shard(hash_id) as states:
+            states[hash_id] = state
+        self.timers.schedule(state[0] + timeout, hash_id)
+
+    def _expire_rpcs(self, now):
+        """ Remove the RPCs that passed their deadline, the lookups waiting
+        for them and the routing table are notified. Returns the number of
+        expired RPCs. """
+        expired = 0
+        for hash_id in self.timers.expired(now):
+            with self.rpc_states.shard(hash_id) as states:
+                state = states.pop(hash_id, None)
+            if state is None:
+                continue
+            expired += 1
+            if len(state) < 2:
+                continue
+            if isinstance(state[1], Shortlist):
+                peer_id = state[1].fail(hash_id)
+                if peer_id is not None:
+                    self.buckets.failed(peer_id)
+            elif isinstance(state[1], Peer):
+                # Liveness ping of BucketSet.insert
+                self.buckets.ping_expired(state[1], state[0])
+        return expired
+
+    def _start_rpc(self, shortlist, peer, rpc):
+        """ Send a lookup RPC to peer and track it in the shortlist """
+        rpc_id, hash_id = rpc_id_pair()
+        shortlist.start(peer, hash_id)
+        self.register_rpc(
+            hash_id,
+            [time.time(), shortlist],
+            Config.LOOKUP_TIMEOUT,
+        )
+        rpc(peer, rpc_id)
+
+    def _lookup_step(self, shortlist, rpc):
+        """ Fill the free slots of Config.ALPHA. Returns True if the lookup
+        is complete. The caller has to clear shortlist.updated before
+        calling. """
+        if shortlist.complete():
+            return True
+        for peer in shortlist.get_next_iteration(
+                Config.ALPHA,
+                self.buckets.latency,
+        ):
+            self._start_rpc(shortlist, peer, rpc)
+        return False
+
+    def _get_cached(self, hashed_key):
+        """ Return the cached result of a value lookup or None, raises
+        KeyError if the value was not found recently """
+        value = self.lookup_cache.get(hashed_key)
+        if value is _NOT_FOUND:
+            raise KeyError("Not found")
+        return value
+
+    def _cache_lookup(self, hashed_key, value):
+        """ Cache the result of a value lookup, misses (_NOT_FOUND) are
+        cached for a shorter time """
+        if value is _NOT_FOUND:
+            self.lookup_cache.set(hashed_key, value, Config.NEGATIVE_TTL)
+        else:
+            self.lookup_cache.set(hashed_key, value, Config.CACHE_TTL)
+
+    def _join_lookup(self, hashed_key, future_class):
+        """ Returns the future of the value lookup of hashed_key in flight
+        and False. If there is none a new future is registered and
+        returned with True, the caller has to do the lookup and call
+        _end_lookup. """
+        with self.flights as flights:
+            future = flights.get(hashed_key)
+            if future is not None:
+                return future, False
+            future = flights[hashed_key] = future_class()
+            return future, True
+
+    def _end_lookup(self, hashed_key, future, value, complete):
+        """ Cache the result of a complete lookup and pass it to the
+        callers waiting on future """
+        if complete:
+            self._cache_lookup(hashed_key, value)
+        with self.flights as flights:
+            del flights[hashed_key]
+        future.set_result(value)
+
+    def _joined_result(self, value):
+        """ Raise KeyError if a joined lookup did not find the value """
+        if value is _NOT_FOUND:
+            raise KeyError("Not found")
+        return value
+
+    def _cache_on_path(self, shortlist, value):
+        """ If path caching is enabled store a found value at the nearest
+        peer that answered with nodes. The TTL is halved for every peer
+        nearer to the key, so the copy expires faster the farther it is
+        from the key. """
+        if not self.path_cache:
+            return
+        if isinstance(value, (ValuePage, ValuePointer)):
+            return
+        peer, nearer = shortlist.nearest_responded()
+        if peer is None:
+            return
+        ttl = Config.PATH_CACHE_TTL >> nearer
+        if not ttl:
+            return
+        try:
+            peer.store(
+                shortlist.key,
+                value,
+                dht     = self,
+                peer_id = self.peer.id,
+                ttl     = ttl,
+                cached  = True,
+            )
+        except Node.MaxSizeException:
+            pass
+
+    def _republish_due(self, now):
+        """ Returns the keys to republish mapped to the senders of their
+        values. Values received within Config.REPUBLISH were republished
+        by another node, they are skipped. """
+        due = collections.OrderedDict()
+        if self.data is not None:
+            for key, sender in self.data.due(now - Config.REPUBLISH):
+                due.setdefault(key, []).append(sender)
+        return due
+
+    def _republish_delay(self, keys):
+        """ Delay between the keys of a round, so the round is spread over
+        Config.REPUBLISH without exceeding Config.REPUBLISH_RATE """
+        return max(
+            float(Config.REPUBLISH) / max(keys, 1),
+            1.0 / Config.REPUBLISH_RATE,
+        )
+
+    def _republish(self, key, senders, nearest_nodes):
+        """ Store the values of senders again on the nearest nodes, they
+        keep their remaining TTL """
+        now = time.time()
+        for sender in senders:
+            try:
+                value, expires = self.data.entry(key, sender)
+            except KeyError:
+                continue
+            ttl = int(expires - now)
+            if ttl < 1:
+                continue
+            try:
+                for node in nearest_nodes:
+                    node.store(
+                        key,
+                        value,
+                        dht     = self,
+                        peer_id = self.peer.id,
+                        ttl     = ttl,
+                        origin  = sender or None,
+                    )
+            except Node.MaxSizeException:
+                l.info("Value too large to republish")
+
+    def _batch_lookups(self, hashed_keys, rpc_factory, updated):
+        """ Create one lookup (shortlist, rpc) per distinct key. The
+        shortlists share the event updated, so one waiter can drive all
+        lookups. """
+        lookups = collections.OrderedDict()
+        for hashed_key in hashed_keys:
+            if hashed_key in lookups:
+                continue
+            shortlist = Shortlist(
+                Config.K,
+                hashed_key,
+                self.peer.id,
+                updated=updated,
+            )
+            shortlist.update(self.buckets.nearest_nodes(hashed_key))
+            lookups[hashed_key] = (shortlist, rpc_factory(hashed_key))
+        return lookups
+
+    def _lookup_window(self, pending, running, limit):
+        """ Step the running lookups and start pending lookups while less
+        than limit are running. Returns the lookups still running, none are
+        left if the batch is complete. The caller has to clear the shared
+        updated event before calling. """
+        running = [
+            lookup for lookup in running
+            if not self._lookup_step(*lookup)
+        ]
+        while pending and len(running) < limit:
+            lookup = pending.pop()
+            if not self._lookup_step(*lookup):
+                running.append(lookup)
+        return running
+
+    def _refresh_keys(self, now):
+        """ Random ids in the range of the buckets that were not active for
+        Config.BUCKET_REFRESH, the buckets are marked as refreshed """
+        if self.firewalled:
+            f = 20
+        else:
+            f = 1
+        indexes = self.buckets.stale(now - Config.BUCKET_REFRESH * f)
+        for index in indexes:
+            self.buckets.touch(index, now)
+        return [self.buckets.random_id(index) for index in indexes]
+
+    def _batch_items(self, items, encoding=None):
+        """ Encode and hash the items of set_many, a later value of the same
+        key replaces the earlier one """
+        if isinstance(items, dict):
+            items = items.items()
+        values = collections.OrderedDict()
+        for key, value in items:
+            values[self._hash_key(key)] = self._encode(value, encoding)
+        return values
+
+    def _batch_local(self, hashed_keys):
+        """ Returns the values stored locally or cached and the keys that
+        have to be looked up """
+        values = {}
+        missing = []
+        for hashed_key in hashed_keys:
+            if hashed_key in values:
+                continue
+            res = self._get_local(hashed_key)
+            if res is None:
+                try:
+                    res = self._get_cached(hashed_key)
+                except KeyError:
+                    continue
+            if res is None:
+                missing.append(hashed_key)
+            else:
+                values[hashed_key] = res
+        return values, missing
+
+    def _batch_results(self, hashed_keys, values, encoding, default):
+        """ Decode the values found by get_many in the order of keys """
+        return [
+            self._decode(values[hashed_key], encoding)
+            if hashed_key in values else default
+            for hashed_key in hashed_keys
+        ]
+
+    def _find_node_rpc(self, key):
+        """ Create a function sending find node """
+
+        def rpc(peer, rpc_id):
+            """ Send find node """
+            peer.find_node(key, rpc_id, dht=self, peer_id=self.peer.id)
+
+        return rpc
+
+    def _find_value_rpc(self, key, limit=None, cursor=None):
+        """ Create a function sending find value """
+
+        def rpc(peer, rpc_id):
+            """ Send find value """
+            peer.find_value(
+                key,
+                rpc_id,
+                dht     = self,
+                peer_id = self.peer.id,
+                limit   = limit,
+                cursor  = cursor,
+            )
+
+        return rpc
+
+    def _log_lookup(self, name, start, shortlist):
+        """ Log statistics of a lookup """
+        l.info(
+            "%s: %.5fs (%d, %d, %d)",
+            name,
+            (time.time() - start),
+            len(shortlist.list),
+            shortlist.responded(),
+            len(self.buckets),
+        )
+
+    def _boot_peer_from_addr(self, addr, boot_port):
+        """ Create the initial boot peer from a resolved address """
+        ipaddr = ipaddress.ip_address(addr)
+        if isinstance(ipaddr, ipaddress.IPv6Address):
+            return Peer(boot_port, 0, hostv6=str(ipaddr))
+        else:
+            return Peer(boot_port, 0, hostv4=str(ipaddr))
+
+    def _save_snapshot(self):
+        """ Save the routing table and our id if a snapshot path is set """
+        if not self.snapshot_path:
+            return
+        try:
+            snapshot.save(
+                self.snapshot_path,
+                self.network_id,
+                self.peer.id,
+                self.buckets.peerslist(),
+            )
+        except (IOError, OSError):
+            l.exception("Could not save snapshot")
+
+    def _warm_answered(self, pings):
+        """ Returns the peers of the pings that answered """
+        return [
+            peer for peer, _, hash_id in pings if self._pongs(hash_id)
+        ]
+
+    def _warm_result(self, pings):
+        """ Learn our addresses from the pongs of a warm start, returns
+        the peer that answered first or None """
+        answered = self._warm_answered(pings)
+        for _, _, hash_id in pings:
+            with self.rpc_states.shard(hash_id) as states:
+                state = states.get(hash_id)
+                if state and len(state) > 1:
+                    self._discov_result(state)
+        if answered:
+            return answered[0]
+        return None
+
+    def _boot_peers(self, addrinfos, boot_port):
+        """ Create a boot peer for every resolved address we can reach """
+        boot_peers = []
+        seen = set()
+        for family, _, _, _, sockaddr in addrinfos:
+            if family == socket.AF_INET and not self.server4:
+                continue
+            if family == socket.AF_INET6 and not self.server6:
+                continue
+            addr = sixunicode(sockaddr[0])
+            if addr in seen:
+                continue
+            seen.add(addr)
+            try:
+                boot_peers.append(self._boot_peer_from_addr(addr, boot_port))
+            except ValueError:
+                # Scoped IPv6 addresses are not supported
+                pass
+        return boot_peers
+
+    def _create_pings(self, peers):
+        """ Register a ping RPC for each peer, returns (peer, rpc_id,
+        hash_id) tuples for _send_pings """
+        pings = []
+        for peer in peers:
+            rpc_id, hash_id = rpc_id_pair()
+            self.register_rpc(hash_id, [time.time()], Config.RPC_TIMEOUT)
+            pings.append((peer, rpc_id, hash_id))
+        return pings
+
+    def _send_pings(self, pings):
+        """ Send or resend the pings, the RTT is measured from the latest
+        send """
+        for peer, rpc_id, hash_id in pings:
+            with self.rpc_states.shard(hash_id) as states:
+                state = states.get(hash_id)
+                if state is not None:
+                    state[0] = time.time()
+            peer.ping(self, self.peer.id, rpc_id = rpc_id)
+
+    def _forget_pings(self, pings):
+        """ Remove the states of the pings """
+        for _, _, hash_id in pings:
+            with self.rpc_states.shard(hash_id) as states:
+                states.pop(hash_id, None)
+
+    def _pongs(self, hash_id):
+        """ The pongs received for the ping hash_id """
+        with self.rpc_states.shard(hash_id) as states:
+            return list(states.get(hash_id, [None])[1:])
+
+    def _boot_pong(self, pings):
+        """ Returns the peer that answered first with its complete
+        address, None if no pong arrived yet """
+        for _, _, hash_id in pings:
+            for message in self._pongs(hash_id):
+                try:
+                    return Peer(*message[Message.ALL_ADDR], is_bytes=True)
+                except KeyError:
+                    pass
+        return None
+
+    def _boot_discovered(self, hash_id, boot_peer):
+        """ True if the pongs of hash_id contain our address for every
+        address family we share with boot_peer """
+        missing = set()
+        if self.server4 and boot_peer.hostv4:
+            missing.add(4)
+        if self.server6 and boot_peer.hostv6:
+            missing.add(6)
+        for message in self._pongs(hash_id):
+            try:
+                me_peer = Peer(*message[Message.CLI_ADDR], is_bytes=True)
+            except (KeyError, TypeError):
+                continue
+            if me_peer.hostv4:
+                missing.discard(4)
+            if me_peer.hostv6:
+                missing.discard(6)
+        return not missing
+
+    def _discov_warning(self, found, defined):
+        """ Log a warning about wrong public address """
+        # TODO: To logging
+        l.warn(  # noqa
+"Warning: defined public address (%s) does not match the\n"  # noqa
+"address found by the bootstap peer (%s). We will use the\n"  # noqa
+"defined address. IPv4/6 convergence will not be optimal!",  # noqa
+defined,  # noqa
+found     # noqa
+        )
+
+    def _discov_result(self, res):
+        """ Set the discover result in the client """
+        for me_msg in res[1:]:
+            try:
+                me_tuple = me_msg[Message.CLI_ADDR]
+                me_peer = Peer(*me_tuple, is_bytes=True)
+                if me_peer.hostv4:
+                    if not self.hostv4:
+                        self.peer.hostv4 = me_peer.hostv4
+                    elif me_peer.hostv4 != self.hostv4:
+                        self._discov_warning(me_peer.hostv4, self.hostv4)
+                if me_peer.hostv6:
+                    if not self.hostv6:
+                        self.peer.hostv6 = me_peer.hostv6
+                    elif me_peer.hostv6 != self.hostv6:
+                        self._discov_warning(me_peer.hostv6, self.hostv6)
+            except TypeError:
+                pass
+
+    def _hash_key(self, key):
+        """ Keys are hashed to get the location in the DHT """
+        return hash_function(msgpack.dumps(key))
+
+    def _get_local(self, hashed_key):
+        """ Return the value if we store it locally, else None """
+        if self.data is not None:
+            try:
+                return self.data[hashed_key]
+            except KeyError:
+                pass
+        return None
+
+    def _get_local_values(self, hashed_key, limit):
+        """ Return up to limit values of different senders stored
+        locally """
+        if self.data is not None:
+            return [value for _, value in self.data.values(hashed_key, limit)]
+        return []
+
+    def _set_local(self, hashed_key, value, ttl=None):
+        """ Store a value locally, it is not counted against a quota. A
+        cached lookup result of the key is dropped. """
+        self.lookup_cache.discard(hashed_key)
+        if self.data is not None:
+            self.data.store(hashed_key, value, ttl=ttl)
+
+    def _close_storage(self):
+        """ Close the storage backend """
+        if self.data is not None:
+            self.data.close()
+
+    def _decode(self, value, encoding=None):
+        """ Decode a value using encoding or the default encoding """
+        if not encoding:
+            encoding = self.encoding
+        if encoding:
+            value = msgpack.loads(value, encoding=encoding)
+        return value
+
+    def _encode(self, value, encoding=None):
+        """ Encode a value using encoding or the default encoding """
+        if not encoding:
+            encoding = self.encoding
+        if encoding:
+            value = msgpack.dumps(value, encoding=encoding)
+        return value
@@ -1,16 +1,26 @@
-import msgpack
 import ipaddress
 import six
 
-from .hashing   import hash_function
-from .const     import Message, MinMax
+from .const     import Message, NodeFormat
 from .helper    import sixunicode
-from .excepions import MaxSizeException
 from .log       import l
 
 
 class Peer(object):
     ''' DHT Peer Information'''
+    __slots__ = (
+        '_hostv4',
+        '_hostv6',
+        '_addressv4',
+        '_addressv6',
+        'port',
+        'id',
+        'well_connected',
+        'last_seen',
+        'failures',
+        'rtt',
+    )
+
     def __init__(
             self,
             port,
@@ -20,21 +30,49 @@ class Peer(object):
             well_connected = False,
             is_bytes       = False
     ):
-        if hostv4:
+        self.port = port
+        # Addresses that are already parsed are not parsed again
+        if isinstance(hostv4, ipaddress.IPv4Address):
+            self.hostv4 = hostv4
+        elif hostv4:
             self.hostv4 = ipaddress.ip_address(
                 sixunicode(hostv4, is_bytes)
             )
         else:
             self.hostv4 = None
-        if hostv6:
+        if isinstance(hostv6, ipaddress.IPv6Address):
+            self.hostv6 = hostv6
+        elif hostv6:
             self.hostv6 = ipaddress.ip_address(
                 sixunicode(hostv6, is_bytes)
             )
         else:
             self.hostv6 = None
-        self.port = port
         self.id = id_
         self.well_connected = well_connected
+        self.last_seen = 0
+        self.failures = 0  # RPCs timed out since the peer was last seen
+        self.rtt = None  # Average round trip time of RPCs to the peer
+
+    # The address tuples used for sending are cached with the hosts
+
+    @property
+    def hostv4(self):
+        return self._hostv4
+
+    @hostv4.setter
+    def hostv4(self, host):
+        self._hostv4 = host
+        self._addressv4 = (str(host), self.port)
+
+    @property
+    def hostv6(self):
+        return self._hostv6
+
+    @hostv6.setter
+    def hostv6(self, host):
+        self._hostv6 = host
+        self._addressv6 = (str(host), self.port)
 
     def astuple(self, for_export=False):
         if self.hostv4:
@@ -62,29 +100,24 @@ class Peer(object):
             )
 
     def addressv4(self):
-        return (str(self.hostv4), self.port)
+        return self._addressv4
 
     def addressv6(self):
-        return (str(self.hostv6), self.port)
+        return self._addressv6
 
     def __repr__(self):
         return repr(self.astuple())
 
     def _sendmessage(self, message, dht, peer_id):
-        message[Message.PEER_ID] = peer_id  # more like sender_id
-        message[Message.NETWORK_ID] = hash_function(
-            peer_id + dht.network_id
-        )
-        encoded = msgpack.dumps(message)
-        if len(encoded) > MinMax.MAX_MSG_SIZE:
-            raise MaxSizeException(
-                "Message size max not exceed %d bytes" % MinMax.MAX_MSG_SIZE
-            )
+        for encoded in dht.encoder.datagrams(message, peer_id):
+            self._senddatagram(encoded, dht)
+
+    def _senddatagram(self, encoded, dht):
         if self.hostv4 and dht.server4:
             try:
                 dht.server4.socket.sendto(
                     encoded,
-                    (str(self.hostv4), self.port)
+                    self._addressv4
                 )
             except OSError:
                 l.info("Could not send to %s", self.hostv4)
@@ -92,30 +125,22 @@ class Peer(object):
             try:
                 dht.server6.socket.sendto(
                     encoded,
-                    (str(self.hostv6), self.port)
+                    self._addressv6
                 )
             except OSError:
                 l.info("Could not send to %s", self.hostv6)
 
     def _fw_sendmessage(self, message, dht, peer_id):
-        message[Message.PEER_ID] = peer_id  # more like sender_id
-        message[Message.NETWORK_ID] = hash_function(
-            peer_id + dht.network_id
-        )
-        encoded = msgpack.dumps(message)
-        if len(encoded) > MinMax.MAX_MSG_SIZE:
-            raise MaxSizeException(
-                "Message size max not exceed %d bytes" % MinMax.MAX_MSG_SIZE
-            )
+        encoded, = dht.encoder.datagrams(message, peer_id)
         if self.hostv4 and dht.server4:
             dht.fw_sock4.sendto(
                 encoded,
-                (str(self.hostv4), self.port)
+                self._addressv4
             )
         if self.hostv6 and dht.server6:
             dht.fw_sock6.sendto(
                 encoded,
-                (str(self.hostv6), self.port)
+                self._addressv6
             )
 
     def ping(self, dht, peer_id, rpc_id=None):
@@ -156,44 +181,128 @@ class Peer(object):
         }
         self._fw_sendmessage(message, dht, peer_id=peer_id)
 
-    def store(self, key, value, dht, peer_id):
+    def store(
+            self,
+            key,
+            value,
+            dht,
+            peer_id,
+            ttl=None,
+            origin=None,
+            cached=False,
+    ):
+        """ If origin is given the value is republished for that peer, if
+        cached is set it is a path cached copy """
         message = {
             Message.MESSAGE_TYPE: Message.STORE,
             Message.ID: key,
             Message.VALUE: value
         }
+        if ttl:
+            message[Message.TTL] = ttl
+        if origin:
+            message[Message.ORIGIN] = origin
+        if cached:
+            message[Message.CACHED] = True
         self._sendmessage(message, dht, peer_id=peer_id)
 
     def find_node(self, id_, rpc_id, dht, peer_id):
         message = {
             Message.MESSAGE_TYPE: Message.FIND_NODE,
             Message.ID: id_,
-            Message.RPC_ID: rpc_id
+            Message.RPC_ID: rpc_id,
+            Message.NODE_FORMAT: NodeFormat.COMPACT,
         }
         self._sendmessage(message, dht, peer_id=peer_id)
 
-    def found_nodes(self, id_, nearest_nodes, rpc_id, dht, peer_id):
+    def found_nodes(
+            self,
+            id_,
+            nearest_nodes,
+            rpc_id,
+            dht,
+            peer_id,
+            compact=False,
+    ):
+        """ nearest_nodes are peer tuples or, if compact, packed records """
         message = {
             Message.MESSAGE_TYPE: Message.FOUND_NODES,
             Message.VALUE: id_,
-            Message.NEAREST_NODES: nearest_nodes,
             Message.RPC_ID: rpc_id
         }
+        if compact:
+            message[Message.COMPACT_NODES] = nearest_nodes
+        else:
+            message[Message.NEAREST_NODES] = nearest_nodes
         self._sendmessage(message, dht, peer_id=peer_id)
 
-    def find_value(self, id_, rpc_id, dht, peer_id):
+    def find_value(self, id_, rpc_id, dht, peer_id, limit=None, cursor=None):
+        """ If limit is given, a page of up to limit values of different
+        senders starting after cursor is requested """
         message = {
             Message.MESSAGE_TYPE: Message.FIND_VALUE,
             Message.ID: id_,
-            Message.RPC_ID: rpc_id
+            Message.RPC_ID: rpc_id,
+            Message.NODE_FORMAT: NodeFormat.COMPACT,
         }
+        if limit:
+            message[Message.LIMIT] = limit
+            if cursor is not None:
+                message[Message.CURSOR] = cursor
+        # We can fetch large values over TCP
+        elif dht.mq is not None:
+            message[Message.TCP_PORT] = dht.mq.port
         self._sendmessage(message, dht, peer_id=peer_id)
 
-    def found_value(self, id_, value, rpc_id, dht, peer_id):
+    def found_value(self, id_, value, rpc_id, dht, peer_id, tcp_port=None):
+        """ If tcp_port is given the value is not sent, it has to be
+        fetched over TCP """
         message = {
             Message.MESSAGE_TYPE: Message.FOUND_VALUE,
             Message.ID: id_,
-            Message.VALUE: value,
             Message.RPC_ID: rpc_id
         }
+        if tcp_port:
+            message[Message.TCP_PORT] = tcp_port
+        else:
+            message[Message.VALUE] = value
         self._sendmessage(message, dht, peer_id=peer_id)
+
+
+    def found_values(self, id_, values, cursor, rpc_id, dht, peer_id):
+        """ Send a page of values, cursor is None on the last page """
+        message = {
+            Message.MESSAGE_TYPE: Message.FOUND_VALUE,
+            Message.ID: id_,
+            Message.RPC_ID: rpc_id,
+            Message.VALUES: values,
+        }
+        if cursor is not None:
+            message[Message.CURSOR] = cursor
+        self._sendmessage(message, dht, peer_id=peer_id)
+
+
+class ValuePage(object):
+    """ Result of a lookup with a limit, cursor is None on the last
+    page """
+    __slots__ = (
+        'values',
+        'cursor',
+    )
+
+    def __init__(self, values, cursor):
+        self.values = values
+        self.cursor = cursor
+
+
+class ValuePointer(object):
+    """ Result of a lookup if the value has to be fetched from peer using
+    the TCP port """
+    __slots__ = (
+        'peer',
+        'port',
+    )
+
+    def __init__(self, peer, port):
+        self.peer = peer
+        self.port = port
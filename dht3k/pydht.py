@@ -1,40 +1,23 @@
 """ Main module containing the API """
 
-import msgpack
 import socket
-import ipaddress
 import threading
 import time
+import concurrent.futures as futures
 
-from .bucketset import BucketSet
-from .hashing   import hash_function, rpc_id_pair, random_id
-from .peer      import Peer
 from .shortlist import Shortlist
-from .helper    import sixunicode, LockedDict
+from .node      import Node, _NOT_FOUND
 from .server    import DHTServer, DHTRequestHandler
-from .const     import Message, Config, Storage
+from .const     import Config, Storage
 from .          import upnp
-from .          import excepions
 from .          import threads
-from .log       import log_to_stderr, l
+from .log       import l
 
 
-# TODO: idea storage limit per peer
-# TODO: local peer id to storage (sqlite)
-# TODO: no republish (write docu why)
-# TODO: multi-value (per client GC)
-# TODO: get with value-limit
-# TODO: tcp (lazymq)
-# TODO: storage limit
-# TODO: check if we have a RPC state leak
-# TODO: keep the same id (if port/IPs are the same??)
-# TODO: data to disk (optional)
-# TODO: async interface (futures)
 # TODO: more/better unittest + 100% coverage
 # TODO: what about IP changes?
 # 1. Is there a binding problem?
 # 2. Refactor address discover and make maint-thread
-# TODO: Consider sending multiple answers (split!) if EMSGSIZE occurs
 # TODO: pep8
 # TODO: lint
 # TODO: documentaion
@@ -44,11 +27,9 @@ from .log       import log_to_stderr, l
 __all__ = ['DHT']
 
 
-class DHT(object):
+class DHT(Node):
 
     _log_enabled = False
-    MaxSizeException = excepions.MaxSizeException
-    NetworkError     = excepions.NetworkError
 
     def __init__(
             self,
@@ -65,44 +46,31 @@ class DHT(object):
             port_map         = True,
             network_id       = Config.NETWORK_ID,
             storage          = Storage.MEMORY,
+            storage_path     = None,
+            snapshot_path    = None,
+            path_cache       = False,
             log              = True,
             debug            = True,
     ):
-        if log:
-            log_to_stderr(debug)
-        if not id_:
-            id_ = random_id()
-        if port < 1024:
-            raise DHT.NetworkError("Ports below 1024 are not allowed")
+        hostv4, hostv6 = self._setup_node(
+            port,
+            hostv4,
+            hostv6,
+            id_,
+            zero_config,
+            default_encoding,
+            network_id,
+            storage,
+            storage_path,
+            snapshot_path,
+            log,
+            debug,
+        )
+        self.path_cache = path_cache
         if boot_host or zero_config:
             self.firewalled = True
-        else:
-            self.firewalled = False
         self.stop = threading.Event()
-        self.encoding = default_encoding
-        self.peer = Peer(port, id_, hostv4, hostv6)
-        if storage == Storage.NONE:
-            self.data = None
-        else:
-            self.data = LockedDict()
-        self.buckets = BucketSet(Config.K, Config.ID_BITS, self.peer.id)
-        self.rpc_states = LockedDict()
-        self.server4 = None
-        self.server6 = None
-        self.boot_peer = None
-        self.network_id = network_id
-        if not hostv4:
-            if zero_config:
-                hostv4 = ""
-            self.hostv4 = hostv4
-        else:
-            self.hostv4  = ipaddress.ip_address(hostv4)
-        if not hostv6:
-            if zero_config:
-                hostv6 = ""
-            self.hostv6 = hostv6
-        else:
-            self.hostv6  = ipaddress.ip_address(hostv6)
+        self.rpc_timeouts = threads.run_rpc_timeouts(self)
         # Detecting dual_stack sockets seems not to work on some OSs
         # so we always use two sockets
         if hostv6 is not None:
@@ -147,238 +115,314 @@ class DHT(object):
         if port_map:
             if not upnp.try_map_port(port):
                 l.warning("UPnP could not map port")
-        if zero_config:
-            try:
-                self._bootstrap("31.171.244.153", Config.PORT)
-            except DHT.NetworkError:
-                self._bootstrap("2001:470:7:ab::2", Config.PORT)
-        else:
-            if boot_host:
-                self._bootstrap(boot_host, boot_port)
+        if self.snapshot_peers and self._warm_start():
+            self.firewalled = True
+        elif zero_config:
+            self._bootstrap(Config.BOOT_HOSTS)
+        elif boot_host:
+            self._bootstrap([(boot_host, boot_port)])
         self.bucket_refrsh  = threads.run_bucket_refresh(self)
         self.check_firewall = threads.run_check_firewalled(self)
-        self.rpc_cleanup    = threads.run_rpc_cleanup(self)
+        self.republish      = threads.run_republish(self)
+        self.snapshot       = threads.run_snapshot(self)
 
     def close(self):
         self.stop.set()
+        self.timers.changed.set()
         self.bucket_refrsh.join()
         self.check_firewall.join()
-        self.rpc_cleanup.join()
-        if self.server4:
-            self.server4.shutdown()
-            self.server4.server_close()
-        if self.server6:
-            self.server6.shutdown()
-            self.server6.server_close()
-        self.server4.idle.wait()
-        self.server6.idle.wait()
+        self.republish.join()
+        self.snapshot.join()
+        self.rpc_timeouts.join()
+        for server in (self.server4, self.server6):
+            if server:
+                server.shutdown()
+                server.server_close()
+        for server in (self.server4, self.server6):
+            if server:
+                server.idle.wait()
         if self.server4:
             self.fw_sock4.close()
         if self.server6:
             self.fw_sock6.close()
+        self._save_snapshot()
+        self._close_storage()
+
+    def _lookup(self, shortlist, rpc):
+        """ Keep Config.ALPHA RPCs in flight until the lookup is complete.
+        A slot is refilled as soon as a response or a timeout arrives. """
+        while True:
+            shortlist.updated.clear()
+            if self._lookup_step(shortlist, rpc):
+                return
+            shortlist.updated.wait(Config.LOOKUP_TIMEOUT)
+
+    def _lookup_many(self, lookups, limit=Config.BATCH_LOOKUPS):
+        """ Drive many lookups sharing one updated event, at most limit
+        run concurrently """
+        if not lookups:
+            return
+        updated = lookups[0][0].updated
+        pending = list(reversed(lookups))
+        running = []
+        while True:
+            updated.clear()
+            running = self._lookup_window(pending, running, limit)
+            if not running:
+                return
+            updated.wait(Config.LOOKUP_TIMEOUT)
+
+    def _refresh_buckets(self):
+        """ Find nodes at a random id in the range of the buckets that were
+        not active for Config.BUCKET_REFRESH, the lookups run concurrently
+        """
+        keys = self._refresh_keys(time.time())
+        lookups = self._batch_lookups(
+            keys,
+            self._find_node_rpc,
+            threading.Event(),
+        )
+        self._lookup_many(list(lookups.values()), Config.REFRESH_BATCH)
+        if keys:
+            l.info("Refreshed %d buckets", len(keys))
 
     def iterative_find_nodes(self, key, boot_peer=None):
         shortlist = Shortlist(Config.K, key, self.peer.id)
         shortlist.update(self.buckets.nearest_nodes(key))
-        if boot_peer:
-            rpc_id, hash_id = rpc_id_pair()
-            with self.rpc_states as states:
-                states[hash_id] = [time.time(), shortlist]
-            shortlist.updated.clear()
-            boot_peer.find_node(key, rpc_id, dht=self, peer_id=self.peer.id)
-            shortlist.updated.wait(Config.SLEEP_WAIT)
+        rpc = self._find_node_rpc(key)
         start = time.time()
         try:
-            while (not shortlist.complete()):
-                nearest_nodes = shortlist.get_next_iteration(Config.ALPHA)
-                for peer in nearest_nodes:
-                    shortlist.mark(peer)
-                    rpc_id, hash_id = rpc_id_pair()
-                    with self.rpc_states as states:
-                        states[hash_id] = [time.time(), shortlist]
-                    shortlist.updated.clear()
-                    peer.find_node(key, rpc_id, dht=self, peer_id=self.peer.id)
-                shortlist.updated.wait(Config.SLEEP_WAIT)
+            if boot_peer:
+                self._start_rpc(shortlist, boot_peer, rpc)
+            self._lookup(shortlist, rpc)
             return shortlist.results()
         finally:
-            end = time.time()
-            # Convert to logging
-            l.info(
-                "find_nodes: %.5fs (%d, %d, %d)",
-                (end - start),
-                len(shortlist.list),
-                len([it for it in shortlist.list if it[1]]),
-                len(self.buckets.peerslist()),
-            )
+            self._log_lookup("find_nodes", start, shortlist)
 
-    def iterative_find_value(self, key):
+    def iterative_find_value(self, key, limit=None, cursor=None):
+        """ Find the value of a hashed key. If limit is given a ValuePage
+        of up to limit values of different senders is returned. """
         shortlist = Shortlist(Config.K, key, self.peer.id)
         shortlist.update(self.buckets.nearest_nodes(key))
+        rpc = self._find_value_rpc(key, limit, cursor)
         start = time.time()
         try:
-            while (not shortlist.complete()):
-                nearest_nodes = shortlist.get_next_iteration(Config.ALPHA)
-                for peer in nearest_nodes:
-                    shortlist.mark(peer)
-                    rpc_id, hash_id = rpc_id_pair()
-                    with self.rpc_states as states:
-                        states[hash_id] = [time.time(), shortlist]
-                    shortlist.updated.clear()
-                    peer.find_value(
-                        key,
-                        rpc_id,
-                        dht=self,
-                        peer_id=self.peer.id
-                    )
-                shortlist.updated.wait(Config.SLEEP_WAIT)
-                if shortlist.completion_value.done():
-                    return shortlist.completion_result()
-            return shortlist.completion_result()
+            self._lookup(shortlist, rpc)
+            value = shortlist.completion_result()
+            self._cache_on_path(shortlist, value)
+            return value
         finally:
-            end = time.time()
-            # Convert to logging
-            l.info(
-                "find_value: %.5fs (%d, %d, %d)",
-                (end - start),
-                len(shortlist.list),
-                len([it for it in shortlist.list if it[1]]),
-                len(self.buckets.peerslist()),
-            )
+            self._log_lookup("find_value", start, shortlist)
 
-    def _discov_warning(self, found, defined):
-        """ Log a warning about wrong public address """
-        # TODO: To logging
-        l.warn(  # noqa
-"Warning: defined public address (%s) does not match the\n"  # noqa
-"address found by the bootstap peer (%s). We will use the\n"  # noqa
-"defined address. IPv4/6 convergence will not be optimal!",  # noqa
-defined,  # noqa
-found     # noqa
-        )
+    def _wait_pongs(self, done, timeout):
+        """ Wait till done() returns True, returns False on timeout """
+        deadline = time.time() + timeout
+        while True:
+            self.pong_received.clear()
+            if done():
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.pong_received.wait(remaining)
 
-    def _discov_result(self, res):
-        """ Set the discover result in the client """
-        for me_msg in res[1:]:
-            try:
-                me_tuple = me_msg[Message.CLI_ADDR]
-                me_peer = Peer(*me_tuple, is_bytes=True)
-                if me_peer.hostv4:
-                    if not self.hostv4:
-                        self.peer.hostv4 = me_peer.hostv4
-                    elif me_peer.hostv4 != self.hostv4:
-                        self._discov_warning(me_peer.hostv4, self.hostv4)
-                if me_peer.hostv6:
-                    if not self.hostv6:
-                        self.peer.hostv6 = me_peer.hostv6
-                    elif me_peer.hostv6 != self.hostv6:
-                        self._discov_warning(me_peer.hostv6, self.hostv6)
-            except TypeError:
-                pass
+    def _ping_until(self, pings, done):
+        """ Send the pings till done() returns True, they are resent after
+        Config.BOOT_TIMEOUT. Returns False if all retries timed out. """
+        for _ in range(Config.BOOT_RETRIES):
+            self._send_pings(pings)
+            if self._wait_pongs(done, Config.BOOT_TIMEOUT):
+                return True
+        return False
 
-    def _len_states(self, hash_id):
-        """ Return length of rpc states """
-        with self.rpc_states as states:
-            return len(states[hash_id])
-
-    def _bootstrap(self, boot_host, boot_port):
-        addr = socket.getaddrinfo(boot_host, boot_port)[0][4][0]
-        ipaddr = ipaddress.ip_address(sixunicode(addr))
-        if isinstance(ipaddr, ipaddress.IPv6Address):
-            boot_peer = Peer(boot_port, 0, hostv6=str(ipaddr))
-        else:
-            boot_peer = Peer(boot_port, 0, hostv4=str(ipaddr))
-
-        rpc_id, hash_id = rpc_id_pair()
-        with self.rpc_states as states:
-            states[hash_id] = [time.time()]
-        boot_peer.ping(self, self.peer.id, rpc_id = rpc_id)
-        time.sleep(Config.SLEEP_WAIT)
-
-        peer_found = False
+    def _warm_start(self):
+        """ Ping the peers of the snapshot in parallel instead of
+        bootstrapping, returns False if none of them answered """
+        pings = self._create_pings(self.snapshot_peers)
+        expected = min(Config.K, len(pings))
+        try:
+            self._send_pings(pings)
+            self._wait_pongs(
+                lambda: len(self._warm_answered(pings)) >= expected,
+                Config.BOOT_TIMEOUT,
+            )
+            boot_peer = self._warm_result(pings)
+        finally:
+            self._forget_pings(pings)
+        self.snapshot_peers = []
+        if boot_peer is None:
+            l.info("No peer of the snapshot answered")
+            return False
+        self.boot_peer = boot_peer
+        self.iterative_find_nodes(self.peer.id)
+        l.info("DHT is warm started")
+        return True
 
-        if self._len_states(hash_id) > 1:
+    def _bootstrap(self, boot_addrs):
+        """ Discover our addresses and fill the buckets. All resolved
+        addresses of the (host, port) boot_addrs are pinged in parallel,
+        the first peer answering is used. """
+        boot_peers = []
+        for boot_host, boot_port in boot_addrs:
             try:
-                with self.rpc_states as states:
-                    message = states[hash_id][1]
-                boot_peer = Peer(*message[Message.ALL_ADDR], is_bytes=True)
-                peer_found = True
-            except KeyError:
-                with self.rpc_states as states:
-                    states[hash_id].pop(1)
-        if not peer_found:
-            time.sleep(Config.SLEEP_WAIT * 3)
-            boot_peer.ping(self, self.peer.id, rpc_id = rpc_id)
-            time.sleep(Config.SLEEP_WAIT)
-            if self._len_states(hash_id) > 1:
-                with self.rpc_states as states:
-                    self._discov_result(states[hash_id])
-            else:
-                raise DHT.NetworkError("Cannot boot DHT")
-        with self.rpc_states as states:
-            del states[hash_id]
-
-        rpc_id, hash_id = rpc_id_pair()
+                addrinfos = socket.getaddrinfo(
+                    boot_host,
+                    boot_port,
+                    0,
+                    socket.SOCK_DGRAM,
+                )
+            except socket.gaierror:
+                l.info("Cannot resolve %s", boot_host)
+                continue
+            boot_peers.extend(self._boot_peers(addrinfos, boot_port))
 
-        with self.rpc_states as states:
-            states[hash_id] = [time.time()]
-        boot_peer.ping(self, self.peer.id, rpc_id = rpc_id)
-        time.sleep(Config.SLEEP_WAIT)
+        pings = self._create_pings(boot_peers)
+        try:
+            self._ping_until(pings, lambda: self._boot_pong(pings))
+            boot_peer = self._boot_pong(pings)
+        finally:
+            self._forget_pings(pings)
+        if boot_peer is None:
+            raise DHT.NetworkError("Cannot boot DHT")
 
-        if self._len_states(hash_id) > 2:
-            with self.rpc_states as states:
+        pings = self._create_pings([boot_peer])
+        hash_id = pings[0][2]
+        try:
+            self._ping_until(
+                pings,
+                lambda: self._boot_discovered(hash_id, boot_peer),
+            )
+            with self.rpc_states.shard(hash_id) as states:
+                if len(states.get(hash_id, ())) <= 1:
+                    raise DHT.NetworkError("Cannot boot DHT")
                 self._discov_result(states[hash_id])
-        else:
-            time.sleep(Config.SLEEP_WAIT * 3)
-            boot_peer.ping(self, self.peer.id, rpc_id = rpc_id)
-            time.sleep(Config.SLEEP_WAIT)
-            if self._len_states(hash_id) > 1:
-                with self.rpc_states as states:
-                    self._discov_result(states[hash_id])
-            else:
-                raise DHT.NetworkError("Cannot boot DHT")
-        with self.rpc_states as states:
-            del states[hash_id]
+        finally:
+            self._forget_pings(pings)
 
-        self.iterative_find_nodes(random_id(), boot_peer=boot_peer)
-        if len(self.buckets.nearest_nodes(self.peer.id)) < 1:
-            time.sleep(Config.SLEEP_WAIT * 3)
-            self.iterative_find_nodes(random_id(), boot_peer=boot_peer)
-            time.sleep(Config.SLEEP_WAIT)
-            if len(self.buckets.nearest_nodes(self.peer.id)) < 1:
-                raise DHT.NetworkError("Cannot boot DHT")
+        for _ in range(2):
+            self.iterative_find_nodes(self.peer.id, boot_peer=boot_peer)
+            if len(self.buckets):
+                break
+        else:
+            raise DHT.NetworkError("Cannot boot DHT")
         self.boot_peer = boot_peer
         l.info("DHT is bootstrapped")
 
     def get(self, key, encoding=None):
-        if not encoding:
-            encoding = self.encoding
-        hashed_key = hash_function(msgpack.dumps(key))
-        res = None
-        if self.data:
-            with self.data as data:
-                if hashed_key in data:
-                    res = data[hashed_key]
+        hashed_key = self._hash_key(key)
+        res = self._get_local(hashed_key)
         if res is None:
+            res = self._find_value_once(hashed_key)
+        return self._decode(res, encoding)
+
+    def _find_value_once(self, hashed_key):
+        """ Find the value of a hashed key using the lookup cache, callers
+        looking up the same key at the same time share one lookup """
+        res = self._get_cached(hashed_key)
+        if res is not None:
+            return res
+        future, owner = self._join_lookup(hashed_key, futures.Future)
+        if not owner:
+            return self._joined_result(future.result())
+        res = _NOT_FOUND
+        complete = False
+        try:
             res = self.iterative_find_value(hashed_key)
-        if encoding:
-            res = msgpack.loads(res, encoding=encoding)
+            complete = True
+        except KeyError:
+            complete = True
+            raise
+        finally:
+            self._end_lookup(hashed_key, future, res, complete)
         return res
 
     def __getitem__(self, key):
         return self.get(key)
 
-    def set(self, key, value, encoding=None):
-        if not encoding:
-            encoding = self.encoding
-        if encoding:
-            value = msgpack.dumps(value, encoding=encoding)
-        hashed_key = hash_function(msgpack.dumps(key))
+    def get_values(self, key, limit=Config.MAX_VALUES, encoding=None):
+        """ Get up to limit values stored by different senders under key,
+        the pages are requested till limit is reached. Returns an empty
+        list if the key is not found. """
+        hashed_key = self._hash_key(key)
+        values = []
+        cursor = None
+        while len(values) < limit:
+            try:
+                page = self.iterative_find_value(
+                    hashed_key,
+                    limit - len(values),
+                    cursor,
+                )
+            except KeyError:
+                break
+            values.extend(page.values)
+            cursor = page.cursor
+            if cursor is None:
+                break
+        if not values:
+            values = self._get_local_values(hashed_key, limit)
+        return [self._decode(value, encoding) for value in values]
+
+    def get_many(self, keys, encoding=None, default=None):
+        """ Get the values of many keys, returns a list in the order of
+        keys. default is returned for keys that are not found. The lookups
+        run concurrently and each distinct key is looked up once. """
+        hashed_keys = [self._hash_key(key) for key in keys]
+        values, missing = self._batch_local(hashed_keys)
+        lookups = self._batch_lookups(
+            missing,
+            self._find_value_rpc,
+            threading.Event(),
+        )
+        start = time.time()
+        self._lookup_many(list(lookups.values()))
+        l.info("get_many: %.5fs (%d)", time.time() - start, len(lookups))
+        for hashed_key, (shortlist, _) in lookups.items():
+            try:
+                values[hashed_key] = shortlist.completion_result()
+                self._cache_on_path(shortlist, values[hashed_key])
+            except KeyError:
+                pass
+            self._cache_lookup(hashed_key, values.get(hashed_key, _NOT_FOUND))
+        return self._batch_results(hashed_keys, values, encoding, default)
+
+    def set(self, key, value, encoding=None, ttl=None):
+        value = self._encode(value, encoding)
+        hashed_key = self._hash_key(key)
         nearest_nodes = self.iterative_find_nodes(hashed_key)
-        if self.data:
-            with self.data as data:
-                data[hashed_key] = value
+        self._set_local(hashed_key, value, ttl)
         for node in nearest_nodes:
-            node.store(hashed_key, value, dht=self, peer_id=self.peer.id)
+            node.store(
+                hashed_key,
+                value,
+                dht     = self,
+                peer_id = self.peer.id,
+                ttl     = ttl,
+            )
 
     def __setitem__(self, key, value):
         self.set(key, value)
+
+    def set_many(self, items, encoding=None, ttl=None):
+        """ Store many values, items is a dict or an iterable of (key,
+        value) pairs. The lookups of the nearest nodes run concurrently. """
+        values = self._batch_items(items, encoding)
+        lookups = self._batch_lookups(
+            values,
+            self._find_node_rpc,
+            threading.Event(),
+        )
+        start = time.time()
+        self._lookup_many(list(lookups.values()))
+        l.info("set_many: %.5fs (%d)", time.time() - start, len(lookups))
+        for hashed_key, (shortlist, _) in lookups.items():
+            value = values[hashed_key]
+            self._set_local(hashed_key, value, ttl)
+            for node in shortlist.results():
+                node.store(
+                    hashed_key,
+                    value,
+                    dht     = self,
+                    peer_id = self.peer.id,
+                    ttl     = ttl,
+                )
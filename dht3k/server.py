@@ -4,16 +4,21 @@ try:
 except ImportError:
     import SocketServer as socketserver
 import socket
+import select
 import threading
+import time
 import msgpack
 import ipaddress
+import six
 
-from .const     import Message, MinMax, Config, message_dict
+from .const     import Message, MinMax, Config, NodeFormat, message_dict
 from .helper    import sixunicode
-from .peer      import Peer
+from .peer      import Peer, ValuePointer, ValuePage
+from .encoder   import pack_nodes, unpack_nodes
 from .threads   import ThreadPoolMixIn
 from .log       import l
 from .hashing   import hash_function, rpc_to_hash_id
+from .storage   import CACHED
 
 
 def _get_lookup():
@@ -66,6 +71,19 @@ def _get_lookup():
             return False
         return True
 
+    def verify_fragment(fragment):
+        """ Check the fragment id, index and count """
+        if not isinstance(fragment, (list, tuple)) or len(fragment) != 3:
+            return False
+        frag_id, index, count = fragment
+        return (
+            isinstance(frag_id, bytes) and
+            len(frag_id) <= MinMax.MAX_FRAG_ID and
+            isinstance(index, six.integer_types) and
+            isinstance(count, six.integer_types) and
+            0 <= index < count <= MinMax.MAX_FRAGMENTS
+        )
+
     def verify_nodes(nodes):
         """ Check if all nodes kann be peers """
         for node in nodes:
@@ -81,64 +99,215 @@ def _get_lookup():
         Message.CLI_ADDR: verify_ip,
         Message.ALL_ADDR: verify_boot_peer,
         Message.NEAREST_NODES: verify_nodes,
+        Message.TTL: lambda x: isinstance(x, six.integer_types) and x > 0,
+        Message.NODE_FORMAT: lambda x: (
+            isinstance(x, six.integer_types) and x >= 0
+        ),
+        Message.COMPACT_NODES: lambda x: isinstance(x, bytes),
+        Message.FRAGMENT: verify_fragment,
+        Message.TCP_PORT: lambda x: (
+            isinstance(x, six.integer_types) and 1024 <= x < 2 ** 16
+        ),
+        Message.LIMIT: lambda x: isinstance(x, six.integer_types) and x > 0,
+        Message.CURSOR: lambda x: (
+            isinstance(x, bytes) and len(x) in (0, Config.ID_BYTES)
+        ),
+        Message.VALUES: lambda x: isinstance(x, (list, tuple)),
+        Message.ORIGIN: lambda x: len(x) == Config.ID_BYTES,
+        Message.CACHED: lambda x: x is True,
     }
 
 _verifier_lookup = _get_lookup()
 
 
-class DHTRequestHandler(socketserver.BaseRequestHandler):
+def _get_validators():
+    """ Create the validator of each message type: it maps the keys
+    allowed in the message to their verifier or None """
+    common = (
+        Message.MESSAGE_TYPE,
+        Message.PEER_ID,
+        Message.NETWORK_ID,
+        Message.RPC_ID,
+    )
+    parts = {
+        Message.PING:        (Message.ALL_ADDR,),
+        Message.PONG:        (Message.ALL_ADDR, Message.CLI_ADDR),
+        Message.FW_PING:     (),
+        Message.FW_PONG:     (Message.ID,),
+        Message.FIND_NODE:   (Message.ID, Message.NODE_FORMAT),
+        Message.FIND_VALUE:  (
+            Message.ID,
+            Message.NODE_FORMAT,
+            Message.TCP_PORT,
+            Message.LIMIT,
+            Message.CURSOR,
+        ),
+        Message.FOUND_NODES: (
+            Message.VALUE,
+            Message.NEAREST_NODES,
+            Message.COMPACT_NODES,
+        ),
+        Message.FOUND_VALUE: (
+            Message.ID,
+            Message.VALUE,
+            Message.FRAGMENT,
+            Message.TCP_PORT,
+            Message.VALUES,
+            Message.CURSOR,
+        ),
+        Message.STORE:       (
+            Message.ID,
+            Message.VALUE,
+            Message.TTL,
+            Message.FRAGMENT,
+            Message.ORIGIN,
+            Message.CACHED,
+        ),
+        Message.FETCH_VALUE: (Message.ID,),
+    }
+    validators = {}
+    for message_type, keys in parts.items():
+        validators[message_type] = dict(
+            (key, _verifier_lookup.get(key)) for key in common + keys
+        )
+    return validators
+
+_validators = _get_validators()
+
+
+def _page(entries, limit):
+    """ Take up to limit values of the (sender, value) entries that fit
+    into MinMax.PAGE_SIZE, entries has to contain one more entry if there
+    is a next page. Returns the values and the cursor of the next page,
+    which is None on the last page. A value too large for a page is
+    skipped, it can only be found without a limit. """
+    values = []
+    size = 0
+    cursor = None
+    for sender, value in entries:
+        if len(values) >= limit:
+            return values, cursor
+        value_size = len(msgpack.dumps(value))
+        if value_size > MinMax.PAGE_SIZE:
+            cursor = sender
+            continue
+        size += value_size
+        if size > MinMax.PAGE_SIZE:
+            return values, cursor
+        values.append(value)
+        cursor = sender
+    if len(entries) > limit:
+        return values, cursor
+    return values, None
+
+# Pings and responses are cheap to handle, they are handled by the receiving
+# thread. Finding nodes and storing is done in the thread pool.
+_inline_messages = frozenset((
+    Message.PING,
+    Message.FW_PING,
+    Message.PONG,
+    Message.FW_PONG,
+    Message.FOUND_NODES,
+    Message.FOUND_VALUE,
+))
+
+_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+class DHTRequestHandler(object):
+    """ Handles one datagram. The server calls decode() and then handle()
+    either inline or in the thread pool. """
+
+    def __init__(self, request, client_address, server):
+        self.request        = request
+        self.client_address = client_address
+        self.server         = server
 
     def verify_message(self, message):
-        if message[Message.MESSAGE_TYPE] not in message_dict:
+        """ Check every part of the message in one pass and the network
+        proof. Verified proofs are cached, so known peers are not hashed
+        again. """
+        try:
+            validator = _validators[message[Message.MESSAGE_TYPE]]
+        except KeyError:
             l.warn("Unknown message type, ignoring message")
             return False
-        for key in message.keys():
-            if key not in message_dict:
-                l.warn("Unknown message part, ignoring message")
-                return False
+        for key, value in message.items():
             try:
-                verfier = _verifier_lookup[key]
+                verifier = validator[key]
             except KeyError:
-                continue
-            if not verfier(message[key]):
+                l.warn("Unknown message part, ignoring message")
+                return False
+            if verifier is not None and not verifier(value):
                 l.warn(
                     "Unable to verify: %s, ignoring message", (
                         message_dict[key]
                     )
                 )
                 return False
+        # Only bytes values are split into fragments, chunks are not empty
+        chunk = message.get(Message.VALUE)
+        if Message.FRAGMENT in message and (
+                not isinstance(chunk, bytes) or not chunk
+        ):
+            l.warn("Unable to verify: FRAGMENT, ignoring message")
+            return False
         try:
-            network_id = hash_function(
-                message[Message.PEER_ID] + self.server.dht.network_id
-            )
-            if network_id != message[Message.NETWORK_ID]:
-                l.warn("Message from different network, ignoring")
-                return False
+            peer_id = message[Message.PEER_ID]
+            proof   = message[Message.NETWORK_ID]
         except KeyError:
             l.warn("Incomplete message, ignoring")
             return False
+        dht = self.server.dht
+        if dht.proofs.get(peer_id) != proof:
+            if hash_function(peer_id + dht.network_id) != proof:
+                l.warn("Message from different network, ignoring")
+                return False
+            dht.proofs[peer_id] = proof
         return True
 
-    def handle(self):
+    def decode(self):
+        """ Decode and verify the datagram, returns None if the message is
+        not valid """
+        data = self.request[0]
+        if len(data) > MinMax.MAX_MSG_SIZE:
+            l.warn("Message size too large, ignoring message")
+            return None
+        try:
+            message = msgpack.loads(data)
+        except msgpack.UnpackValueError:
+            return None
+        if not isinstance(message, dict):
+            return None
         try:
-            data         = self.request[0].strip()
-            if len(data) > MinMax.MAX_MSG_SIZE:
-                l.warn("Message size too large, ignoring message")
-                return
-            message      = msgpack.loads(
-                data,
-            )
             if not self.verify_message(message):
-                return
+                return None
+        except KeyError:
+            return None
+        return message
+
+    def handle(self, message=None):
+        """ Handle a message, if message is None the datagram is decoded
+        first """
+        try:
+            if message is None:
+                message = self.decode()
+                if message is None:
+                    return
+            if Message.FRAGMENT in message:
+                message = self.server.dht.fragments.add(message)
+                if message is None:
+                    return
             message_type = message[Message.MESSAGE_TYPE]
             is_pong      = False
             is_rpc_ping  = False
+            rtt          = None  # Round trip time of our RPC answered
 
             if message_type == Message.PING:
                 self.handle_ping(message)
             elif message_type == Message.PONG:
                 is_pong = True
-                is_rpc_ping = self.handle_pong(message)
+                is_rpc_ping, rtt = self.handle_pong(message)
             elif message_type == Message.FW_PING:
                 self.handle_fw_ping(message)
             elif message_type == Message.FIND_NODE:
@@ -146,9 +315,9 @@ class DHTRequestHandler(socketserver.BaseRequestHandler):
             elif message_type == Message.FIND_VALUE:
                 self.handle_find(message, find_value=True)
             elif message_type == Message.FOUND_NODES:
-                self.handle_found_nodes(message)
+                rtt = self.handle_found_nodes(message)
             elif message_type == Message.FOUND_VALUE:
-                self.handle_found_value(message)
+                rtt = self.handle_found_value(message)
             elif message_type == Message.STORE:
                 self.handle_store(message)
             elif message_type == Message.FW_PONG:
@@ -157,6 +326,9 @@ class DHTRequestHandler(socketserver.BaseRequestHandler):
             # Prevent DoS attack: flushing of bucket
             if is_pong and not is_rpc_ping:
                 return
+            # Sent from the firewall check socket, not the port of the peer
+            if message_type == Message.FW_PONG:
+                return
             new_peer = self.peer_from_client_address(
                 self.client_address,
                 peer_id
@@ -166,10 +338,10 @@ class DHTRequestHandler(socketserver.BaseRequestHandler):
                 self.server,
                 is_pong
             )
+            if rtt is not None:
+                self.server.dht.buckets.record_rtt(peer_id, rtt)
         except KeyError:
             pass
-        except msgpack.UnpackValueError:
-            pass
 
     def peer_from_client_address(self, client_address, id_):
         ipaddr = ipaddress.ip_address(
@@ -222,43 +394,93 @@ class DHTRequestHandler(socketserver.BaseRequestHandler):
             l.info("Nolonger marked as firewalled")
 
     def handle_pong(self, message):
+        """ Returns if we sent the ping and its round trip time. A ping
+        goes to the advertised and the client address, only the first pong
+        is measured, the RTT of the others is None. """
         try:
             hash_id = message[Message.RPC_ID]
-            with self.server.dht.rpc_states as states:
-                states[hash_id].append(
+            with self.server.dht.rpc_states.shard(hash_id) as states:
+                state = states[hash_id]
+                # The state holds the send time, maybe a peer and the pongs
+                first = not isinstance(state[-1], dict)
+                state.append(
                     message
                 )
-            return True
+                rtt = time.time() - state[0]
+            self.server.dht.pong_received.set()
+            if first:
+                return True, rtt
+            return True, None
         except KeyError:
-            return False
+            return False, None
 
     def handle_find(self, message, find_value=False):
         key = message[Message.ID]
         id_ = message[Message.PEER_ID]
         peer = self.peer_from_client_address(self.client_address, id_)
-        response_socket = self.request[1]
-        if self.server.dht.data:
-            with self.server.dht.data as data:
-                if find_value and (key in data):
-                    value = data[key]
-                    peer.found_value(
-                        id_,
-                        value,
-                        rpc_to_hash_id(
-                            message[Message.RPC_ID]
-                        ),
-                        dht=self.server.dht,
-                        peer_id=self.server.dht.peer.id,
-                    )
-                    return
+        data = self.server.dht.data
+        if find_value and data is not None and Message.LIMIT in message:
+            limit = min(message[Message.LIMIT], Config.MAX_VALUES)
+            # One more to know if there is a next page
+            entries = data.values(
+                key,
+                limit + 1,
+                message.get(Message.CURSOR),
+            )
+            if entries or key in data:
+                values, cursor = _page(entries, limit)
+                peer.found_values(
+                    id_,
+                    values,
+                    cursor,
+                    rpc_to_hash_id(
+                        message[Message.RPC_ID]
+                    ),
+                    dht=self.server.dht,
+                    peer_id=self.server.dht.peer.id,
+                )
+                return
+        elif find_value and data is not None:
+            try:
+                value = data[key]
+            except KeyError:
+                pass
+            else:
+                tcp_port = None
+                mq = self.server.dht.mq
+                if (
+                        mq is not None and
+                        Message.TCP_PORT in message and
+                        isinstance(value, bytes) and
+                        len(value) > Config.TCP_THRESHOLD
+                ):
+                    tcp_port = mq.port
+                peer.found_value(
+                    id_,
+                    value,
+                    rpc_to_hash_id(
+                        message[Message.RPC_ID]
+                    ),
+                    dht=self.server.dht,
+                    peer_id=self.server.dht.peer.id,
+                    tcp_port=tcp_port,
+                )
+                return
         nearest_nodes = self.server.dht.buckets.nearest_nodes(id_)
         if not nearest_nodes:
             nearest_nodes.append(self.server.dht.peer)
-        nearest_nodes = [
-            nearest_peer.astuple(
-                for_export=True
-            ) for nearest_peer in nearest_nodes
-        ]
+        compact = message.get(
+            Message.NODE_FORMAT,
+            NodeFormat.TUPLES,
+        ) >= NodeFormat.COMPACT
+        if compact:
+            nearest_nodes = pack_nodes(nearest_nodes)
+        else:
+            nearest_nodes = [
+                nearest_peer.astuple(
+                    for_export=True
+                ) for nearest_peer in nearest_nodes
+            ]
         peer.found_nodes(
             id_,
             nearest_nodes,
@@ -267,34 +489,76 @@ class DHTRequestHandler(socketserver.BaseRequestHandler):
             ),
             dht=self.server.dht,
             peer_id=self.server.dht.peer.id,
+            compact=compact,
         )
 
     def handle_found_nodes(self, message):
         hash_id = message[Message.RPC_ID]
-        with self.server.dht.rpc_states as states:
-            shortlist = states[hash_id][1]
-            del states[hash_id]
+        if Message.COMPACT_NODES in message:
+            try:
+                nearest_nodes = unpack_nodes(message[Message.COMPACT_NODES])
+            except ValueError:
+                l.warn("Malformed compact nodes, ignoring message")
+                return
+        else:
             nearest_nodes = [Peer(
                 *peer,
                 is_bytes=True
             ) for peer in message[Message.NEAREST_NODES]]
-            shortlist.update(nearest_nodes)
+        with self.server.dht.rpc_states.shard(hash_id) as states:
+            start, shortlist = states[hash_id][:2]
+            del states[hash_id]
+            shortlist.update(nearest_nodes, hash_id)
+        return time.time() - start
 
     def handle_found_value(self, message):
         hash_id = message[Message.RPC_ID]
-        with self.server.dht.rpc_states as states:
-            shortlist = states[hash_id][1]
+        if Message.VALUES in message:
+            value = ValuePage(
+                message[Message.VALUES],
+                message.get(Message.CURSOR),
+            )
+        elif Message.TCP_PORT in message:
+            value = ValuePointer(
+                self.peer_from_client_address(
+                    self.client_address,
+                    message[Message.PEER_ID],
+                ),
+                message[Message.TCP_PORT],
+            )
+        else:
+            value = message[Message.VALUE]
+        with self.server.dht.rpc_states.shard(hash_id) as states:
+            start, shortlist = states[hash_id][:2]
             del states[hash_id]
-            shortlist.set_complete(message[Message.VALUE])
+            shortlist.set_complete(value)
+        return time.time() - start
 
     def handle_store(self, message):
         key = message[Message.ID]
-        if self.server.dht.data:
-            with self.server.dht.data as data:
-                data[key] = message[Message.VALUE]
+        data = self.server.dht.data
+        # A republished value is kept under the peer that stored it first,
+        # ORIGIN is not authenticated so the sender pays for it and it
+        # never replaces a value of the origin
+        sender = message.get(Message.ORIGIN, message[Message.PEER_ID])
+        payer = message[Message.PEER_ID]
+        if Message.CACHED in message:
+            # A path cached copy is kept apart from the values of senders
+            sender = payer = CACHED
+        if data is not None and sender != self.server.dht.peer.id:
+            data.store(
+                key,
+                message[Message.VALUE],
+                sender = sender,
+                ttl    = message.get(Message.TTL),
+                payer  = payer,
+            )
 
 
 class DHTServer(ThreadPoolMixIn, socketserver.UDPServer):
+    """ Receives datagrams in batches. Cheap messages are handled inline by
+    the receiving thread, the rest is handed to the thread pool. """
+
     def __init__(self, host_address, handler_cls, is_v6=False):
         if is_v6:
             socketserver.UDPServer.address_family = socket.AF_INET6
@@ -319,3 +583,59 @@ class DHTServer(ThreadPoolMixIn, socketserver.UDPServer):
         self.server_bind()
         self.server_activate()
         self.send_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        """ Receive until shutdown() is called """
+        self.is_shut_down.clear()
+        try:
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select(
+                    [self.socket],
+                    [],
+                    [],
+                    poll_interval,
+                )
+                if readable:
+                    self.receive_batch()
+        finally:
+            self.is_shut_down.set()
+
+    def shutdown(self):
+        """ Stop serve_forever and wait till it has stopped """
+        self._stop_event.set()
+        self.is_shut_down.wait()
+
+    def receive_batch(self):
+        """ Drain up to Config.RECV_BATCH datagrams from the socket """
+        for _ in range(Config.RECV_BATCH):
+            try:
+                data, client_address = self.socket.recvfrom(
+                    self.max_packet_size,
+                    _DONTWAIT,
+                )
+            except socket.error:
+                return
+            try:
+                self.dispatch(data, client_address)
+            except:  # noqa
+                l.exception("Exception in request handler")
+            if not _DONTWAIT:
+                # Without MSG_DONTWAIT the next recvfrom could block
+                return
+
+    def dispatch(self, data, client_address):
+        """ Decode a datagram and handle it inline or in the pool """
+        handler = self.RequestHandlerClass(
+            (data, self.socket),
+            client_address,
+            self,
+        )
+        message = handler.decode()
+        if message is None:
+            return
+        if message[Message.MESSAGE_TYPE] in _inline_messages:
+            handler.handle(message)
+        else:
+            self.process_message(handler, message)
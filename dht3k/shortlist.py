@@ -1,94 +1,198 @@
 import threading
 import concurrent.futures as futures
-import collections
+import bisect
 
-from .peer    import Peer
 from .hashing import bytes2int
-from .const   import Config
+from .const   import PeerState, Config
+
+
+class Entry(object):
+    """ A peer in the shortlist """
+    __slots__ = (
+        'peer',
+        'distance',
+        'state',
+    )
+
+    def __init__(self, peer, distance):
+        self.peer     = peer
+        self.distance = distance
+        self.state    = PeerState.PENDING
 
 
 class Shortlist(object):
+    """ The k nearest peers known in a lookup, sorted by distance to key.
 
-    def __init__(self, k, key, my_id):
+    The entries are indexed by peer id and RPCs in flight by hash_id. """
+
+    def __init__(self, k, key, my_id, updated=None):
         self.k                = k
         self.key              = key
+        self.ikey             = bytes2int(key)
         self.my_id            = my_id
         self.list             = list()
+        self.distances        = list()
+        self.index            = {}
+        self.failed           = set()
+        self.in_flight        = {}
+        self.num_responded    = 0
         self.lock             = threading.Lock()
         self.completion_value = futures.Future()
         self.completion_value.set_running_or_notify_cancel()
-        self.updated          = threading.Event()
+        # AsyncDHT passes an asyncio.Event
+        if updated is None:
+            updated = threading.Event()
+        self.updated          = updated
 
     def set_complete(self, value):
+        with self.lock:
+            # More than one peer can answer with the value
+            if not self.completion_value.done():
+                self.completion_value.set_result(value)
         self.updated.set()
-        self.completion_value.set_result(value)
 
     def completion_result(self):
-        try:
-            return self.completion_value.result(Config.SLEEP_WAIT)
-        except futures.TimeoutError:
-            raise KeyError("Not found due network timeout")
+        if not self.completion_value.done():
+            raise KeyError("Not found")
+        return self.completion_value.result()
 
-    def update(self, nodes):
-        for node in nodes:
-            self._update_one(node)
+    def update(self, nodes, hash_id=None):
+        """ Merge nodes into the list. If hash_id is given the nodes are the
+        response to that RPC and the peer it was sent to is marked as
+        responded """
+        with self.lock:
+            if hash_id is not None:
+                self._set_state(hash_id, PeerState.RESPONDED)
+            if not self.completion_value.done():
+                for node in nodes:
+                    self._update_one(node)
         self.updated.set()
 
     def _update_one(self, node):
+        id_ = node.id
         if (
-                node.id == self.key or
-                node.id == self.my_id or
-                self.completion_value.done()
+                id_ in self.index or
+                id_ == self.key or
+                id_ == self.my_id or
+                id_ in self.failed
         ):
             return
+        distance = bytes2int(id_) ^ self.ikey
+        if len(self.list) >= self.k and distance > self.distances[-1]:
+            return
+        pos = bisect.bisect(self.distances, distance)
+        entry = Entry(node, distance)
+        self.distances.insert(pos, distance)
+        self.list.insert(pos, entry)
+        self.index[id_] = entry
+        if len(self.list) > self.k:
+            self._remove(len(self.list) - 1)
+
+    def _remove(self, pos):
+        """ Remove the entry at pos """
+        entry = self.list.pop(pos)
+        del self.distances[pos]
+        del self.index[entry.peer.id]
+        if entry.state == PeerState.RESPONDED:
+            self.num_responded -= 1
+
+    def _set_state(self, hash_id, state):
+        """ Finish the RPC hash_id, the peer it was sent to gets state """
+        try:
+            peer_id = self.in_flight.pop(hash_id)
+        except KeyError:
+            return
+        try:
+            entry = self.index[peer_id]
+        except KeyError:
+            return
+        if entry.state != PeerState.IN_FLIGHT:
+            return
+        if state == PeerState.FAILED:
+            self._remove(bisect.bisect_left(self.distances, entry.distance))
+            self.failed.add(peer_id)
+        else:
+            entry.state = state
+            self.num_responded += 1
+
+    def start(self, node, hash_id):
+        """ Record that a RPC (hash_id) has been sent to node """
         with self.lock:
-            for i in range(len(self.list)):
-                if node.id == self.list[i][0][1]:
-                    break
-                iid   = bytes2int(node.id)
-                ikey  = bytes2int(self.key)
-                ilist = bytes2int(self.list[i][0][1])
-                if iid ^ ikey < ilist ^ ikey:
-                    self.list.insert(i, (node.astuple(), False))
-                    self.list = self.list[:self.k]
-                    break
-            else:
-                # Executed if we hit no break above which means
-                # 1. The new node isn't duplicated
-                # 2. The new node is not nearer than any other nodes
-                if len(self.list) < self.k:
-                    self.list.append((node.astuple(), False))
-
-    def mark(self, node):
+            self.in_flight[hash_id] = node.id
+            try:
+                self.index[node.id].state = PeerState.IN_FLIGHT
+            except KeyError:
+                pass
+
+    def fail(self, hash_id):
+        """ The RPC hash_id failed, the peer is removed from the lookup.
+        Returns the id of the peer or None if the RPC was finished. """
         with self.lock:
-            for i in range(len(self.list)):
-                if node.id == self.list[i][0][1]:
-                    self.list[i] = (node.astuple(), True)
+            peer_id = self.in_flight.get(hash_id)
+            self._set_state(hash_id, PeerState.FAILED)
+        self.updated.set()
+        return peer_id
 
     def complete(self):
+        """ The lookup is complete when the value was found or the k closest
+        peers known have all responded """
         if self.completion_value.done():
             return True
         with self.lock:
-            for node, completed in self.list:
-                if not completed:
-                    return False
-            return True
+            if self.num_responded < len(self.list):
+                return False
+            # An empty list is only complete if no RPC can fill it anymore
+            return bool(self.list) or not self.in_flight
+
+    def get_next_iteration(self, alpha, latency=None):
+        """ Return pending peers to fill the free slots of alpha.
 
-    def get_next_iteration(self, alpha):
+        If latency is given it returns the average RTT of a peer id, None
+        if it is unknown or infinite if it timed out. Out of the
+        Config.RTT_WINDOW nearest pending peers per free slot the peers at
+        the same log distance to key are ordered by latency. Peers that
+        timed out are only returned if there are no other peers. """
         if self.completion_value.done():
             return []
-        next_iteration = []
         with self.lock:
-            for node, completed in self.list:
-                if not completed:
-                    next_iteration.append(Peer(*node, is_bytes=True))
-                    if len(next_iteration) >= alpha:
-                        break
-        return next_iteration
+            free = alpha - len(self.in_flight)
+            if free <= 0:
+                return []
+            pending = [
+                entry for entry in self.list
+                if entry.state == PeerState.PENDING
+            ]
+        if latency is None:
+            return [entry.peer for entry in pending[:free]]
+        window = []
+        failed = []
+        for entry in pending:
+            rtt = latency(entry.peer.id)
+            if rtt is None:
+                rtt = Config.DEFAULT_RTT
+            if rtt == float("inf"):
+                failed.append(entry.peer)
+                continue
+            window.append(((entry.distance.bit_length(), rtt), entry.peer))
+            if len(window) >= free * Config.RTT_WINDOW:
+                break
+        # Log distance, then latency
+        window.sort(key=lambda item: item[0])
+        return ([peer for _, peer in window] + failed)[:free]
+
+    def nearest_responded(self):
+        """ Returns the nearest peer that responded with nodes and the
+        number of peers in the list nearer to key, or (None, 0) """
+        with self.lock:
+            for pos, entry in enumerate(self.list):
+                if entry.state == PeerState.RESPONDED:
+                    return entry.peer, pos
+        return None, 0
+
+    def responded(self):
+        """ Number of peers that have responded """
+        return self.num_responded
 
     def results(self):
         with self.lock:
-            return [Peer(
-                *node,
-                is_bytes=True
-            ) for (node, completed) in self.list]
+            return [entry.peer for entry in self.list]
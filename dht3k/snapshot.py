@@ -0,0 +1,85 @@
+""" Snapshot of the routing table and the node id.
+
+A restarted node keeps its id and pings the peers of the snapshot instead
+of bootstrapping. The snapshot is a msgpack list: version, network id,
+node id and the peers as (port, id, hostv4, hostv6, well_connected,
+last_seen) with packed addresses. """
+
+import os
+import msgpack
+
+from .peer  import Peer
+from .const import Config
+from .log   import l
+
+VERSION = 1
+
+_replace = getattr(os, "replace", os.rename)
+
+
+def save(path, network_id, id_, peers):
+    """ Write the snapshot atomically """
+    data = msgpack.dumps((
+        VERSION,
+        network_id,
+        id_,
+        [peer.astuple() + (peer.last_seen,) for peer in peers],
+    ))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    _replace(tmp_path, path)
+
+
+def _peer(record):
+    """ Create a peer from a record, returns None if it is not valid """
+    port, id_, hostv4, hostv6, well_connected, last_seen = record
+    if not 1024 <= port < 2 ** 16 or len(id_) != Config.ID_BYTES:
+        return None
+    peer = Peer(
+        port,
+        id_,
+        hostv4,
+        hostv6,
+        well_connected = well_connected,
+        is_bytes       = True,
+    )
+    peer.last_seen = float(last_seen)
+    return peer
+
+
+def _parse(data, network_id):
+    """ Returns the node id and the peers of a packed snapshot, raises
+    ValueError or TypeError if it is broken """
+    version, snap_network_id, id_, records = msgpack.loads(data)
+    if (
+            version != VERSION or
+            snap_network_id != network_id or
+            not isinstance(id_, bytes) or
+            len(id_) != Config.ID_BYTES
+    ):
+        raise ValueError("Snapshot of another version or network")
+    peers = []
+    for record in records:
+        try:
+            peer = _peer(record)
+        except (ValueError, TypeError):
+            continue
+        if peer is not None:
+            peers.append(peer)
+    return id_, peers
+
+
+def load(path, network_id):
+    """ Returns the node id and the peers of the snapshot. The id is None
+    if there is no valid snapshot for network_id. """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None, []
+    try:
+        return _parse(data, network_id)
+    except (ValueError, TypeError, msgpack.UnpackValueError):
+        l.warning("Snapshot %s is broken, ignoring it", path)
+        return None, []
@@ -0,0 +1,634 @@
+""" Storage backends for the values stored in the DHT
+
+A backend maps hashed keys to values and has to be thread-safe:
+__getitem__ raises KeyError for missing keys, store() takes the peer id
+of the sender and a TTL. A republished value is stored under the peer that
+stored it first, but charged to the peer that sent it (the payer) and it
+never replaces a value of that sender.
+
+A key holds one value per sender, so writers do not overwrite each other.
+__getitem__ returns the value stored last, values() returns a page of the
+values ordered by sender. Local values are stored with the sender b"".
+Path cached copies are stored with the sender CACHED, they share its quota
+and are neither paged by values() nor republished. At most
+Config.MAX_VALUES senders are kept per key, the oldest value of the key is
+dropped first. due() and entry() are used to republish the values
+that were not received recently.
+
+Every value expires after its TTL (at most Config.VALUE_TTL). The sum of
+the sizes of all values is limited to Config.STORAGE_LIMIT and the values
+of a single sender to Config.SENDER_QUOTA. If a limit is reached, the
+least recently used values are evicted. Expired values are removed
+lazily, at most Config.EXPIRE_BATCH per store, so no full sweep is
+needed. """
+
+import bisect
+import collections
+import heapq
+import sqlite3
+import threading
+import time
+import msgpack
+
+from .const import Storage, Config
+
+CACHED = b"\x00"  # Sender of path cached copies, no peer id has this length
+
+
+def _ttl(ttl):
+    """ Limit the TTL to Config.VALUE_TTL """
+    if not ttl or ttl > Config.VALUE_TTL:
+        return Config.VALUE_TTL
+    return ttl
+
+
+class Item(object):
+    """ A value stored in memory """
+    __slots__ = (
+        'value',
+        'size',
+        'expires',
+        'payer',
+        'received',
+    )
+
+    def __init__(self, value, size, expires, payer, received):
+        self.value    = value
+        self.size     = size
+        self.expires  = expires
+        self.payer    = payer  # The quota of payer is charged
+        self.received = received
+
+
+class MemoryStorage(object):
+    """ Keeps the values in a dict indexed by (key, sender). The dict and
+    the entries charged to each payer are ordered by last use, so the first
+    item is evicted first. The senders of each key are ordered by store. """
+
+    def __init__(
+            self,
+            limit = Config.STORAGE_LIMIT,
+            quota = Config.SENDER_QUOTA,
+    ):
+        self.limit   = limit
+        self.quota   = quota
+        self.size    = 0
+        self.data    = collections.OrderedDict()
+        self.entries = {}
+        self.expiry  = []
+        self.senders = {}
+        self.used    = {}
+        self.lock    = threading.Lock()
+
+    def _forget(self, entry, item):
+        """ Update the bookkeeping for an item removed from data """
+        self.size -= item.size
+        key, sender = entry
+        senders = self.entries[key]
+        del senders[sender]
+        if not senders:
+            del self.entries[key]
+        if item.payer is not None:
+            entries = self.senders[item.payer]
+            del entries[entry]
+            if entries:
+                self.used[item.payer] -= item.size
+            else:
+                del self.senders[item.payer]
+                del self.used[item.payer]
+
+    def _expire(self, now):
+        """ Remove up to Config.EXPIRE_BATCH expired items """
+        for _ in range(Config.EXPIRE_BATCH):
+            if not self.expiry or self.expiry[0][0] > now:
+                break
+            expires, entry = heapq.heappop(self.expiry)
+            item = self.data.get(entry)
+            # The heap entry is stale if the key was stored again
+            if item is not None and item.expires == expires:
+                del self.data[entry]
+                self._forget(entry, item)
+        if len(self.expiry) > 2 * len(self.data) + Config.EXPIRE_BATCH:
+            self.expiry = [
+                (item.expires, entry) for entry, item in self.data.items()
+            ]
+            heapq.heapify(self.expiry)
+
+    def _evict(self, max_size):
+        """ Evict the least recently used items till size <= max_size """
+        while self.size > max_size:
+            entry, item = self.data.popitem(False)
+            self._forget(entry, item)
+
+    def _evict_sender(self, sender, max_size):
+        """ Evict the least recently used items of sender till they fit
+        into max_size """
+        while self.used.get(sender, 0) > max_size:
+            entry = next(iter(self.senders[sender]))
+            self._forget(entry, self.data.pop(entry))
+
+    def _get(self, entry, now):
+        """ Get a item and mark it as recently used """
+        item = self.data.pop(entry)
+        if item.expires <= now:
+            self._forget(entry, item)
+            raise KeyError(entry[0])
+        self.data[entry] = item
+        if item.payer is not None:
+            entries = self.senders[item.payer]
+            del entries[entry]
+            entries[entry] = None
+        return item
+
+    def _latest(self, key, now):
+        """ Get the item of key stored last """
+        senders = self.entries.get(key)
+        while senders:
+            try:
+                return self._get((key, next(reversed(senders))), now)
+            except KeyError:
+                # Expired, _get removed it from senders
+                pass
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self._latest(key, time.time()).value
+
+    def values(self, key, limit, cursor=None):
+        """ Returns up to limit (sender, value) pairs of key ordered by
+        sender, starting after the sender cursor """
+        now = time.time()
+        with self.lock:
+            senders = sorted(self.entries.get(key, ()))
+            if cursor is not None:
+                senders = senders[bisect.bisect_right(senders, cursor):]
+            page = []
+            for sender in senders:
+                if len(page) >= limit:
+                    break
+                if sender == CACHED:
+                    continue
+                try:
+                    item = self._get((key, sender), now)
+                except KeyError:
+                    continue
+                page.append((sender, item.value))
+            return page
+
+    def due(self, before):
+        """ Returns the (key, sender) of the values received before
+        before, for republishing """
+        now = time.time()
+        with self.lock:
+            return [
+                entry for entry, item in self.data.items()
+                if item.received <= before and item.expires > now
+                and entry[1] != CACHED
+            ]
+
+    def entry(self, key, sender):
+        """ Returns the value and the expiry time of the value of sender,
+        it is not marked as used """
+        with self.lock:
+            item = self.data.get((key, sender))
+            if item is None or item.expires <= time.time():
+                raise KeyError(key)
+            return item.value, item.expires
+
+    def store(self, key, value, sender=None, ttl=None, payer=None):
+        """ Store a value, returns False if it does not fit. The size is
+        charged to payer, which defaults to sender. If payer is not the
+        sender an existing value of sender is kept, it is only marked as
+        received so it is not republished again. """
+        size = len(key) + len(msgpack.dumps(value))
+        entry = (key, sender or b"")
+        if payer is None:
+            payer = sender
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            old = self.data.get(entry)
+            if old is not None:
+                if payer != sender and old.expires > now:
+                    old.received = now
+                    return False
+                del self.data[entry]
+                self._forget(entry, old)
+            if size > self.limit:
+                return False
+            if payer is not None:
+                if size > self.quota:
+                    return False
+                self._evict_sender(payer, self.quota - size)
+            senders = self.entries.get(key)
+            if senders and len(senders) >= Config.MAX_VALUES:
+                oldest = (key, next(iter(senders)))
+                self._forget(oldest, self.data.pop(oldest))
+            self._evict(self.limit - size)
+            item = Item(value, size, now + _ttl(ttl), payer, now)
+            self.data[entry] = item
+            self.entries.setdefault(
+                key,
+                collections.OrderedDict(),
+            )[entry[1]] = None
+            heapq.heappush(self.expiry, (item.expires, entry))
+            self.size += size
+            if payer is not None:
+                self.senders.setdefault(
+                    payer,
+                    collections.OrderedDict(),
+                )[entry] = None
+                self.used[payer] = self.used.get(payer, 0) + size
+            return True
+
+    def __setitem__(self, key, value):
+        self.store(key, value)
+
+    def __delitem__(self, key):
+        """ Delete the values of all senders """
+        with self.lock:
+            for sender in list(self.entries[key]):
+                entry = (key, sender)
+                self._forget(entry, self.data.pop(entry))
+
+    def __contains__(self, key):
+        with self.lock:
+            try:
+                self._latest(key, time.time())
+                return True
+            except KeyError:
+                return False
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+    def keys(self):
+        """ Returns a list of all keys that have not expired """
+        now = time.time()
+        with self.lock:
+            return list(collections.OrderedDict.fromkeys(
+                entry[0] for entry, item in self.data.items()
+                if item.expires > now
+            ))
+
+    def close(self):
+        """ Nothing to close """
+        pass
+
+
+class DiskStorage(object):
+    """ Keeps the values in a sqlite database in WAL mode, so the values
+    survive a restart and do not need to fit in memory. A counter is used
+    as access time for LRU eviction and as store time. """
+
+    def __init__(
+            self,
+            path,
+            limit = Config.STORAGE_LIMIT,
+            quota = Config.SENDER_QUOTA,
+    ):
+        self.path  = path
+        self.limit = limit
+        self.quota = quota
+        self.lock  = threading.Lock()
+        self.conn  = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key BLOB NOT NULL, "
+            "sender BLOB NOT NULL, "
+            "value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "expires REAL NOT NULL, "
+            "atime INTEGER NOT NULL, "
+            "stime INTEGER NOT NULL, "
+            "received REAL NOT NULL DEFAULT 0, "
+            "payer BLOB, "
+            "PRIMARY KEY (key, sender))"
+        )
+        columns = [row[1] for row in self.conn.execute(
+            "PRAGMA table_info(entries)"
+        )]
+        if "received" not in columns:
+            self.conn.execute(
+                "ALTER TABLE entries "
+                "ADD COLUMN received REAL NOT NULL DEFAULT 0"
+            )
+        if "payer" not in columns:
+            self.conn.execute("ALTER TABLE entries ADD COLUMN payer BLOB")
+            self.conn.execute(
+                "UPDATE entries SET payer = sender WHERE sender != X''"
+            )
+            self.conn.execute("DROP INDEX IF EXISTS entries_sender")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_payer "
+            "ON entries (payer, atime)"
+        )
+        self._migrate()
+        self.size, self.clock = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0), "
+            "COALESCE(MAX(MAX(atime), MAX(stime)), 0) "
+            "FROM entries"
+        ).fetchone()
+
+    def _migrate(self):
+        """ Move the values of the single value table to entries. The first
+        version of the table only had the key and value columns, these
+        values are kept as local values for Config.VALUE_TTL. """
+        columns = [row[1] for row in self.conn.execute(
+            "PRAGMA table_info(data)"
+        )]
+        if not columns:
+            return
+        self.conn.execute("BEGIN")
+        if "expires" in columns:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO entries "
+                "(key, sender, value, size, expires, atime, stime, payer) "
+                "SELECT key, COALESCE(sender, X''), value, size, expires, "
+                "atime, atime, sender FROM data"
+            )
+        else:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO entries "
+                "(key, sender, value, size, expires, atime, stime) "
+                "SELECT key, X'', value, LENGTH(key) + LENGTH(value), ?, "
+                "rowid, rowid FROM data",
+                (time.time() + Config.VALUE_TTL,),
+            )
+        self.conn.execute("DROP TABLE data")
+        self.conn.execute("COMMIT")
+
+    def _tick(self):
+        """ Next access time """
+        self.clock += 1
+        return self.clock
+
+    def _delete_rows(self, rows):
+        """ Delete (key, sender, size) rows """
+        for key, sender, size in rows:
+            self.conn.execute(
+                "DELETE FROM entries WHERE key = ? AND sender = ?",
+                (key, sender),
+            )
+            self.size -= size
+
+    def _delete(self, key, sender):
+        """ Delete an entry, returns False if it does not exist """
+        rows = self.conn.execute(
+            "SELECT key, sender, size FROM entries "
+            "WHERE key = ? AND sender = ?",
+            (key, sender),
+        ).fetchall()
+        self._delete_rows(rows)
+        return bool(rows)
+
+    def _expire(self, now):
+        """ Remove up to Config.EXPIRE_BATCH expired items """
+        self._delete_rows(self.conn.execute(
+            "SELECT key, sender, size FROM entries "
+            "WHERE expires <= ? LIMIT ?",
+            (now, Config.EXPIRE_BATCH),
+        ).fetchall())
+
+    def _evict(self, max_size):
+        """ Evict the least recently used items till size <= max_size """
+        while self.size > max_size:
+            self._delete_rows(self.conn.execute(
+                "SELECT key, sender, size FROM entries "
+                "ORDER BY atime LIMIT 1"
+            ).fetchall())
+
+    def _evict_sender(self, payer, max_size):
+        """ Evict the least recently used items charged to payer till they
+        fit into max_size """
+        while self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries "
+                "WHERE payer = ?",
+                (payer,),
+        ).fetchone()[0] > max_size:
+            self._delete_rows(self.conn.execute(
+                "SELECT key, sender, size FROM entries WHERE payer = ? "
+                "ORDER BY atime LIMIT 1",
+                (payer,),
+            ).fetchall())
+
+    def _limit_key(self, key):
+        """ Drop the oldest values of key till a new sender fits into
+        Config.MAX_VALUES """
+        count, = self.conn.execute(
+            "SELECT COUNT(*) FROM entries WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if count >= Config.MAX_VALUES:
+            self._delete_rows(self.conn.execute(
+                "SELECT key, sender, size FROM entries WHERE key = ? "
+                "ORDER BY stime LIMIT ?",
+                (key, count - Config.MAX_VALUES + 1),
+            ).fetchall())
+
+    def _touch(self, key, sender):
+        """ Mark an entry as recently used """
+        self.conn.execute(
+            "UPDATE entries SET atime = ? WHERE key = ? AND sender = ?",
+            (self._tick(), key, sender),
+        )
+
+    def _latest(self, key, now):
+        """ Get the value of key stored last and mark it as recently
+        used """
+        row = self.conn.execute(
+            "SELECT sender, value FROM entries "
+            "WHERE key = ? AND expires > ? "
+            "ORDER BY stime DESC LIMIT 1",
+            (sqlite3.Binary(key), now),
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        self._touch(sqlite3.Binary(key), row[0])
+        return row[1]
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self._latest(key, time.time())
+        return msgpack.loads(bytes(value))
+
+    def values(self, key, limit, cursor=None):
+        """ Returns up to limit (sender, value) pairs of key ordered by
+        sender, starting after the sender cursor """
+        key = sqlite3.Binary(key)
+        if cursor is None:
+            cursor = -1
+        else:
+            cursor = sqlite3.Binary(cursor)
+        with self.lock:
+            # Integers sort before blobs in sqlite
+            rows = self.conn.execute(
+                "SELECT sender, value FROM entries "
+                "WHERE key = ? AND sender > ? AND sender != ? "
+                "AND expires > ? ORDER BY sender LIMIT ?",
+                (key, cursor, sqlite3.Binary(CACHED), time.time(), limit),
+            ).fetchall()
+            for sender, _ in rows:
+                self._touch(key, sender)
+        return [
+            (bytes(sender), msgpack.loads(bytes(value)))
+            for sender, value in rows
+        ]
+
+    def due(self, before):
+        """ Returns the (key, sender) of the values received before
+        before, for republishing """
+        with self.lock:
+            return [
+                (bytes(key), bytes(sender))
+                for key, sender in self.conn.execute(
+                    "SELECT key, sender FROM entries "
+                    "WHERE received <= ? AND expires > ? AND sender != ?",
+                    (before, time.time(), sqlite3.Binary(CACHED)),
+                )
+            ]
+
+    def entry(self, key, sender):
+        """ Returns the value and the expiry time of the value of sender,
+        it is not marked as used """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, expires FROM entries "
+                "WHERE key = ? AND sender = ? AND expires > ?",
+                (sqlite3.Binary(key), sqlite3.Binary(sender), time.time()),
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return msgpack.loads(bytes(row[0])), row[1]
+
+    def store(self, key, value, sender=None, ttl=None, payer=None):
+        """ Store a value, returns False if it does not fit. The size is
+        charged to payer, which defaults to sender. If payer is not the
+        sender an existing value of sender is kept, it is only marked as
+        received so it is not republished again. """
+        value = msgpack.dumps(value)
+        size = len(key) + len(value)
+        key = sqlite3.Binary(key)
+        if payer is None:
+            payer = sender
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self._expire(now)
+                if payer != sender and self.conn.execute(
+                        "UPDATE entries SET received = ? "
+                        "WHERE key = ? AND sender = ? AND expires > ?",
+                        (now, key, sqlite3.Binary(sender or b""), now),
+                ).rowcount:
+                    self.conn.execute("COMMIT")
+                    return False
+                self._delete(key, sqlite3.Binary(sender or b""))
+                if size > self.limit or (
+                        payer is not None and size > self.quota
+                ):
+                    self.conn.execute("COMMIT")
+                    return False
+                if payer is not None:
+                    self._evict_sender(
+                        sqlite3.Binary(payer),
+                        self.quota - size,
+                    )
+                self._limit_key(key)
+                self._evict(self.limit - size)
+                tick = self._tick()
+                self.conn.execute(
+                    "INSERT INTO entries "
+                    "(key, sender, value, size, expires, atime, stime, "
+                    "received, payer) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        sqlite3.Binary(sender or b""),
+                        sqlite3.Binary(value),
+                        size,
+                        now + _ttl(ttl),
+                        tick,
+                        tick,
+                        now,
+                        payer and sqlite3.Binary(payer),
+                    ),
+                )
+                self.size += size
+                self.conn.execute("COMMIT")
+                return True
+            except:  # noqa
+                self.conn.execute("ROLLBACK")
+                self.size = self.conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM entries"
+                ).fetchone()[0]
+                raise
+
+    def __setitem__(self, key, value):
+        self.store(key, value)
+
+    def __delitem__(self, key):
+        """ Delete the values of all senders """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, sender, size FROM entries WHERE key = ?",
+                (sqlite3.Binary(key),),
+            ).fetchall()
+            if not rows:
+                raise KeyError(key)
+            self._delete_rows(rows)
+
+    def __contains__(self, key):
+        with self.lock:
+            try:
+                self._latest(key, time.time())
+                return True
+            except KeyError:
+                return False
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM entries"
+            ).fetchone()[0]
+
+    def keys(self):
+        """ Returns a list of all keys that have not expired """
+        with self.lock:
+            return [bytes(row[0]) for row in self.conn.execute(
+                "SELECT DISTINCT key FROM entries WHERE expires > ?",
+                (time.time(),),
+            )]
+
+    def close(self):
+        """ Close the database """
+        with self.lock:
+            self.conn.close()
+
+
+def create_storage(storage, port, path=None):
+    """ Create the backend for the storage type, returns None for
+    Storage.NONE """
+    if storage == Storage.NONE:
+        return None
+    elif storage == Storage.MEMORY:
+        return MemoryStorage()
+    elif storage == Storage.DISK:
+        if not path:
+            path = Config.STORAGE_PATH % port
+        return DiskStorage(path)
+    raise ValueError("Unknown storage type: %s" % storage)
@@ -0,0 +1,160 @@
+""" Transfer of large values over lazymq (TCP), routing stays on UDP.
+
+A FIND_VALUE with Message.TCP_PORT tells the peer that we can fetch large
+values over TCP. It answers with a FOUND_VALUE containing its TCP port
+instead of the value, so the lookup returns a ValuePointer and we fetch
+the value with a FETCH_VALUE over the pooled lazymq connection. Large
+values are stored with a STORE over TCP, if the peer cannot be reached
+the UDP fragments are used. """
+
+import asyncio
+
+from .server import DHTRequestHandler
+from .const  import Message, Config
+from .log    import l
+
+
+class TCPTransfer(object):
+    """ Partial class for AsyncDHT, needs mq, loop, server4/server6,
+    encoder and the Node methods """
+
+    @asyncio.coroutine
+    def _start_tcp(self):
+        """ Start lazymq on PORT + Config.TCP_OFFSET """
+        import lazymq
+        protocols = 0
+        if self.server4:
+            protocols |= lazymq.const.Protocols.IPV4
+        if self.server6:
+            protocols |= lazymq.const.Protocols.IPV6
+        self.mq = lazymq.LazyMQ(
+            port         = self.peer.port + Config.TCP_OFFSET,
+            ip_protocols = protocols,
+            bind_v4      = self.listen_hostv4,
+            bind_v6      = self.listen_hostv6,
+            loop         = self.loop,
+        )
+        yield from self.mq.start()
+
+    def _tcp_message(self, peer, port, message):
+        """ Create a lazymq message to peer, it carries the same sender
+        id and network proof as a datagram """
+        import lazymq
+        message[Message.PEER_ID] = self.peer.id
+        message[Message.NETWORK_ID] = self.encoder.proof(self.peer.id)
+        tcp_message = lazymq.Message(data=message, port=port)
+        if peer.hostv6 and self.server6:
+            tcp_message.address_v6 = str(peer.hostv6)
+        if peer.hostv4 and self.server4:
+            tcp_message.address_v4 = str(peer.hostv4)
+        return tcp_message
+
+    def _tcp_handler(self, tcp_message):
+        """ Create a request handler to verify and handle a message
+        received over TCP """
+        if tcp_message.address_v6:
+            address = (tcp_message.address_v6, tcp_message.port)
+        else:
+            address = (tcp_message.address_v4, tcp_message.port)
+        return DHTRequestHandler(
+            (None, None),
+            address,
+            self.server4 or self.server6,
+        )
+
+    @asyncio.coroutine
+    def _fetch_value(self, pointer, key):
+        """ Fetch the value of key from the peer of pointer, raises
+        KeyError if it cannot be fetched """
+        try:
+            reply = yield from self.mq.communicate(self._tcp_message(
+                pointer.peer,
+                pointer.port,
+                {
+                    Message.MESSAGE_TYPE: Message.FETCH_VALUE,
+                    Message.ID: key,
+                },
+            ))
+        except (OSError, asyncio.TimeoutError):
+            l.info("Could not fetch value from %s", pointer.peer)
+            raise KeyError("Not found")
+        message = reply.data
+        if (
+                not isinstance(message, dict) or
+                not self._tcp_handler(reply).verify_message(message) or
+                message[Message.MESSAGE_TYPE] != Message.FOUND_VALUE or
+                Message.VALUE not in message
+        ):
+            raise KeyError("Not found")
+        return message[Message.VALUE]
+
+    @asyncio.coroutine
+    def _store_tcp(self, node, key, value, ttl):
+        """ Store a value over TCP, returns False if node cannot be
+        reached """
+        message = {
+            Message.MESSAGE_TYPE: Message.STORE,
+            Message.ID: key,
+            Message.VALUE: value,
+        }
+        if ttl:
+            message[Message.TTL] = ttl
+        try:
+            yield from self.mq.deliver(self._tcp_message(
+                node,
+                node.port + Config.TCP_OFFSET,
+                message,
+            ))
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+    @asyncio.coroutine
+    def _run_tcp(self):
+        """ Handle the messages received over TCP """
+        try:
+            while True:
+                tcp_message = yield from self.mq.receive()
+                message = tcp_message.data
+                if not isinstance(message, dict):
+                    continue
+                handler = self._tcp_handler(tcp_message)
+                try:
+                    if not handler.verify_message(message):
+                        continue
+                    message_type = message[Message.MESSAGE_TYPE]
+                    if message_type == Message.STORE:
+                        handler.handle_store(message)
+                    elif message_type == Message.FETCH_VALUE:
+                        yield from self._handle_fetch(tcp_message)
+                    # FOUND_VALUE is consumed by communicate()
+                except (KeyError, TypeError):
+                    l.info("Bad message over TCP, ignoring")
+        finally:
+            l.info("run_tcp ended")
+
+    @asyncio.coroutine
+    def _handle_fetch(self, tcp_message):
+        """ Answer a FETCH_VALUE through the same connection """
+        import lazymq
+        reply = {
+            Message.MESSAGE_TYPE: Message.FOUND_VALUE,
+            Message.ID: tcp_message.data[Message.ID],
+            Message.PEER_ID: self.peer.id,
+            Message.NETWORK_ID: self.encoder.proof(self.peer.id),
+        }
+        value = self._get_local(tcp_message.data[Message.ID])
+        if value is not None:
+            reply[Message.VALUE] = value
+        tcp_reply = lazymq.Message(
+            identity   = tcp_message.identity,
+            data       = reply,
+            address_v4 = tcp_message.address_v4,
+            address_v6 = tcp_message.address_v6,
+            port       = tcp_message.port,
+        )
+        tcp_reply.active_port = tcp_message.active_port
+        try:
+            yield from self.mq.deliver(tcp_reply)
+        except (OSError, asyncio.TimeoutError):
+            l.info("Could not answer fetch")
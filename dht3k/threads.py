@@ -5,41 +5,30 @@ import time
 
 from .const   import Config
 from .log     import l
-from .hashing import int2bytes
 
 pool = ThreadPoolExecutor(max_workers=Config.WORKERS)
 
 
 class ThreadPoolMixIn:
-    """Mix-in class to handle each request in a new thread."""
-
-    # Decides how threads will act upon termination of the
-    # main process
-    daemon_threads = False
+    """Mix-in class to handle messages in the thread pool."""
 
     def __init__(self):
         self.idle = threading.Event()
+        self.idle.set()
 
-    def process_request_thread(self, request, client_address):
-        """Same as in BaseServer but as a thread.
-
-        In addition, exception handling is done here.
-
-        """
+    def process_message_thread(self, handler, message):
+        """Handle the message, exception handling is done here."""
         try:
             self.idle.clear()
-            self.finish_request(request, client_address)
-            self.shutdown_request(request)
+            handler.handle(message)
         except:  # noqa
             l.exception("Exception in request handler")
-            self.handle_error(request, client_address)
-            self.shutdown_request(request)
         finally:
             self.idle.set()
 
-    def process_request(self, request, client_address):
-        """Submit a new job to process the request."""
-        pool.submit(self.process_request_thread, request, client_address)
+    def process_message(self, handler, message):
+        """Submit a new job to handle the message."""
+        pool.submit(self.process_message_thread, handler, message)
 
 
 def run_check_firewalled(dht):
@@ -66,26 +55,16 @@ def run_check_firewalled(dht):
     return t
 
 def run_bucket_refresh(dht):  # noqa
-    """ Refresh the buckets by finding nodes near that bucket """
-
-    def refresh_bucket(x):
-        """ Refresh a single bucket """
-        id_ = int2bytes(2 ** x)
-        dht.iterative_find_nodes(id_)
+    """ Refresh the buckets by finding nodes at a random id in the range of
+    each bucket that was not active for Config.BUCKET_REFRESH """
 
     def task():
         """ Run the task """
         try:
             while True:
-                for x in range(Config.ID_BITS):
-                    refresh_bucket(x)
-                    l.info("Refreshed bucket %d", x)
-                    if dht.firewalled:
-                        f = 20
-                    else:
-                        f = 1
-                    if dht.stop.wait(Config.BUCKET_REFRESH * f):
-                        return
+                dht._refresh_buckets()
+                if dht.stop.wait(Config.REFRESH_CHECK):
+                    return
         except:  # noqa
             l.exception("run_bucket_refresh failed")
             raise
@@ -98,31 +77,85 @@ def run_bucket_refresh(dht):  # noqa
     return t
 
 
-def run_rpc_cleanup(dht):
-    """ Remove stale RPC from rpc_states dict """
+def run_republish(dht):
+    """ Store the values again on the nearest nodes, so they survive churn.
+    The keys of a round are spread over Config.REPUBLISH. """
+
+    def task():
+        """ Run the task """
+        try:
+            while True:
+                start = time.time()
+                due = dht._republish_due(start)
+                delay = dht._republish_delay(len(due))
+                for key, senders in due.items():
+                    dht._republish(
+                        key,
+                        senders,
+                        dht.iterative_find_nodes(key),
+                    )
+                    if dht.stop.wait(delay):
+                        return
+                if due:
+                    l.info("Republished %d keys", len(due))
+                if dht.stop.wait(
+                        max(0, start + Config.REPUBLISH - time.time())
+                ):
+                    return
+        except:  # noqa
+            l.exception("run_republish failed")
+            raise
+        finally:
+            l.info("run_republish ended")
+
+    t = threading.Thread(target=task)
+    t.setDaemon(True)
+    t.start()
+    return t
+
+
+def run_rpc_timeouts(dht):
+    """ Expire each RPC at its deadline """
 
     def task():
         """ Run the task """
         try:
             while True:
-                dht.stop.wait(Config.RPC_TIMEOUT)
-                with dht.rpc_states as states:
-                    now = time.time()
-                    remove = []
-                    for key in states.keys():
-                        start = states[key][0]
-                        if (now - start) > Config.RPC_TIMEOUT:
-                            remove.append(key)
-                    l.info("Found %d stale rpc states", len(remove))
-                    for key in remove:
-                        del states[key]
+                dht.timers.changed.clear()
+                # close() sets changed after stop
                 if dht.stop.is_set():
                     return
+                expired = dht._expire_rpcs(time.time())
+                if expired:
+                    l.debug("Expired %d rpc states", expired)
+                dht.timers.changed.wait(
+                    dht.timers.next_timeout(time.time())
+                )
+        except:  # noqa
+            l.exception("run_rpc_timeouts failed")
+            raise
+        finally:
+            l.info("run_rpc_timeouts ended")
+
+    t = threading.Thread(target=task)
+    t.setDaemon(True)
+    t.start()
+    return t
+
+
+def run_snapshot(dht):
+    """ Save the routing table snapshot every Config.SNAPSHOT_SAVE """
+
+    def task():
+        """ Run the task """
+        try:
+            while not dht.stop.wait(Config.SNAPSHOT_SAVE):
+                dht._save_snapshot()
         except:  # noqa
-            l.exception("run_rpc_cleanup failed")
+            l.exception("run_snapshot failed")
             raise
         finally:
-            l.info("run_rpc_cleanup ended")
+            l.info("run_snapshot ended")
 
     t = threading.Thread(target=task)
     t.setDaemon(True)
@@ -0,0 +1,239 @@
+"""
+Integration tests for the asyncio interface
+"""
+
+import asyncio
+import os
+import pytest
+import shutil
+import tempfile
+
+try:
+    import unittest.mock   as mock
+except ImportError:
+    import mock
+
+from dht3k.aio   import AsyncDHT
+from dht3k.const import Config
+
+
+class TestAsyncDht(object):
+    """ Testing the AsyncDHT """
+
+    def setup(self):
+        """ Setup """
+        self.loop = asyncio.get_event_loop()
+        self.dht1 = AsyncDHT(
+            4265,
+            u"127.0.0.1",
+            u"::1",
+            listen_hostv4 = u"127.0.0.1",
+            listen_hostv6 = u"::1",
+            port_map      = False,
+        )
+        self.dht2 = AsyncDHT(
+            4267,
+            u"127.0.0.1",
+            u"::1",
+            listen_hostv4 = u"127.0.0.1",
+            listen_hostv6 = u"::1",
+            port_map      = False,
+        )
+        self.loop.run_until_complete(self.dht1.start())
+        self.loop.run_until_complete(self.dht2.start(u"::1", 4265))
+
+    def teardown(self):
+        """ Teardown """
+        self.loop.run_until_complete(self.dht1.close())
+        self.loop.run_until_complete(self.dht2.close())
+
+    def test_find_set(self):
+        """ Testing set and get """
+        @asyncio.coroutine
+        def run():
+            """ Testrunner """
+            yield from self.dht1.set(b"huhu", b"haha")
+            yield from asyncio.sleep(0.1)
+            return (yield from self.dht2.get(b"huhu"))
+        assert self.loop.run_until_complete(run()) == b"haha"
+
+    def test_concurrent(self):
+        """ Testing many concurrent lookups on one loop """
+        @asyncio.coroutine
+        def run():
+            """ Testrunner """
+            yield from asyncio.gather(*[
+                self.dht1.set(x, x) for x in range(20)
+            ])
+            yield from asyncio.sleep(0.1)
+            return (yield from asyncio.gather(*[
+                self.dht2.get(x) for x in range(20)
+            ]))
+        assert self.loop.run_until_complete(run()) == list(range(20))
+
+    def test_many(self):
+        """ Testing set_many and get_many """
+        @asyncio.coroutine
+        def run():
+            """ Testrunner """
+            yield from self.dht1.set_many({x: x for x in range(50)})
+            yield from asyncio.sleep(0.1)
+            return (yield from self.dht2.get_many(
+                list(range(50)) + [3, b"missing"],
+                default=-1,
+            ))
+        assert self.loop.run_until_complete(run()) == (
+            list(range(50)) + [3, -1]
+        )
+
+    def test_single_flight(self):
+        """ Testing concurrent gets of one key share one lookup """
+        dht = self.dht2
+        dht.data = None
+
+        @asyncio.coroutine
+        def run():
+            """ Testrunner """
+            yield from self.dht1.set(b"hot", b"value")
+            yield from asyncio.sleep(0.1)
+            return (yield from asyncio.gather(*[
+                dht.get(b"hot") for _ in range(10)
+            ]))
+        with mock.patch.object(
+            dht,
+            'iterative_find_value',
+            wraps=dht.iterative_find_value,
+        ) as find:
+            assert self.loop.run_until_complete(run()) == [b"value"] * 10
+            assert find.call_count == 1
+
+    def test_warm_start(self):
+        """ Testing a restarted node keeps its id and pings the peers of
+        the snapshot instead of bootstrapping """
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "snapshot")
+
+        def create():
+            """ Create the node using the snapshot """
+            return AsyncDHT(
+                4269,
+                u"127.0.0.1",
+                u"::1",
+                listen_hostv4 = u"127.0.0.1",
+                listen_hostv6 = u"::1",
+                snapshot_path = path,
+                port_map      = False,
+            )
+        try:
+            dht = create()
+            self.loop.run_until_complete(dht.start(u"::1", 4265))
+            id_ = dht.peer.id
+            self.loop.run_until_complete(dht.close())
+            dht = create()
+            self.loop.run_until_complete(dht.start())
+            try:
+                assert dht.peer.id == id_
+                assert dht.boot_peer is not None
+                assert dht.boot_peer.port in (4265, 4267)
+            finally:
+                self.loop.run_until_complete(dht.close())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_not_find(self):
+        """ Testing a missing key """
+        with pytest.raises(KeyError):
+            self.loop.run_until_complete(self.dht2.get(b"blau"))
+
+
+class TestAsyncDhtLoop(object):
+    """ Testing the loop argument """
+
+    def test_own_loop(self):
+        """ Testing a DHT on a loop that is not the default loop """
+        loop = asyncio.new_event_loop()
+        dht1 = AsyncDHT(
+            4275,
+            u"127.0.0.1",
+            None,
+            listen_hostv4 = u"127.0.0.1",
+            port_map      = False,
+            loop          = loop,
+        )
+        dht2 = AsyncDHT(
+            4277,
+            u"127.0.0.1",
+            None,
+            listen_hostv4 = u"127.0.0.1",
+            port_map      = False,
+            loop          = loop,
+        )
+
+        @asyncio.coroutine
+        def run():
+            """ Testrunner """
+            yield from dht1.start()
+            yield from dht2.start(u"127.0.0.1", 4275)
+            try:
+                yield from dht1.set(b"own", b"loop")
+                yield from asyncio.sleep(0.1)
+                return (yield from asyncio.gather(
+                    dht2.get(b"own"),
+                    dht2.get(b"own"),
+                ))
+            finally:
+                yield from dht1.close()
+                yield from dht2.close()
+        try:
+            assert loop.run_until_complete(run()) == [b"loop", b"loop"]
+        finally:
+            loop.close()
+
+
+class TestAsyncDhtTcp(object):
+    """ Testing the transfer of large values over lazymq """
+
+    def setup(self):
+        """ Setup """
+        self.loop = asyncio.get_event_loop()
+        self.dht1 = AsyncDHT(
+            4285,
+            u"127.0.0.1",
+            u"::1",
+            listen_hostv4 = u"127.0.0.1",
+            listen_hostv6 = u"::1",
+            port_map      = False,
+            tcp           = True,
+        )
+        self.dht2 = AsyncDHT(
+            4289,
+            u"127.0.0.1",
+            u"::1",
+            listen_hostv4 = u"127.0.0.1",
+            listen_hostv6 = u"::1",
+            port_map      = False,
+            tcp           = True,
+        )
+        self.loop.run_until_complete(self.dht1.start())
+        self.loop.run_until_complete(self.dht2.start(u"::1", 4285))
+
+    def teardown(self):
+        """ Teardown """
+        self.loop.run_until_complete(self.dht1.close())
+        self.loop.run_until_complete(self.dht2.close())
+
+    def test_large_value(self):
+        """ Testing store and fetch over TCP """
+        value = os.urandom(Config.TCP_THRESHOLD * 10)
+
+        @asyncio.coroutine
+        def run():
+            """ Testrunner """
+            yield from self.dht1.set(b"large", value)
+            yield from asyncio.sleep(0.5)
+            hashed_key = self.dht2._hash_key(b"large")
+            assert self.dht2.data[hashed_key] == value
+            hashed_key = self.dht1._hash_key(b"other")
+            self.dht1._set_local(hashed_key, value)
+            return (yield from self.dht2.iterative_find_value(hashed_key))
+        assert self.loop.run_until_complete(run()) == value
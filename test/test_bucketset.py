@@ -3,6 +3,8 @@
 Testing the bucketset
 """
 
+import time
+
 try:
     import unittest.mock   as mock
 except ImportError:
@@ -10,7 +12,8 @@ except ImportError:
 
 import dht3k.bucketset     as bucketset
 import dht3k.peer          as peer
-import dht3k.helper        as helper
+import dht3k.hashing       as hashing
+from dht3k.const           import Config
 
 
 class TestBucketset(object):
@@ -27,7 +30,6 @@ class TestBucketset(object):
         bs = bucketset.BucketSet(4, 32, b"aaaa")
         server = mock.Mock()
         server.dht = mock.Mock()
-        server.dht.rpc_states = helper.LockedDict()
         server.dht.peer = mock.Mock()
         server.dht.peer.id = b"aaaa"
         with mock.patch.object(
@@ -81,6 +83,106 @@ class TestBucketset(object):
                        None,
                        False)}
         )
-        assert bs.buckets[25] == res
+        assert dict(
+            (p.id, p.astuple()) for p in bs.buckets[25].values()
+        ) == res
+        assert list(bs.buckets[25].keys()) == [
+            bucketset.bytes2int(p.id) for p in bs.buckets[25].values()
+        ]
+        assert bs.bucket_index(bucketset.bytes2int(b"caaa")) == 25
+        assert bs.bucket_index(bucketset.bytes2int(b"aaab")) == 1
+        assert bs.bucket_index(bucketset.bytes2int(b"aaa`")) == 0
         assert mock_ping.called
         assert mock_ping.call_args[0][1] == b"aaaa"
+
+    def test_nearest_nodes(self):
+        """ Walking the buckets returns the same as sorting all peers """
+        bs = bucketset.BucketSet(8, 256, hashing.random_id())
+        peers = []
+        for x in range(200):
+            new = peer.Peer(2000, hashing.random_id(), well_connected=x % 3)
+            int_id = hashing.bytes2int(new.id)
+            bucket = bs.buckets[bs.bucket_index(int_id)]
+            if len(bucket) < bs.bucket_size:
+                bucket[int_id] = new
+                peers.append(new)
+        for _ in range(20):
+            key = hashing.random_id()
+            ikey = hashing.bytes2int(key)
+            res = sorted(peers, key=lambda p: (
+                not p.well_connected,
+                hashing.bytes2int(p.id) ^ ikey,
+            ))
+            assert bs.nearest_nodes(key) == res[:8]
+            assert bs.nearest_nodes(key, 30) == res[:30]
+
+    def test_refresh(self):
+        """ Testing random ids and stale buckets """
+        bs = bucketset.BucketSet(8, 256, hashing.random_id())
+        for index in (0, 1, 100, 255):
+            for _ in range(10):
+                int_id = hashing.bytes2int(bs.random_id(index))
+                assert bs.bucket_index(int_id) == index
+        assert bs.stale(10) == []
+        server = mock.Mock()
+        new = peer.Peer(2000, bs.random_id(250))
+        with mock.patch("time.time", return_value=20):
+            bs.insert(new, server)
+        assert bs.stale(10) == list(range(251, 256))
+        assert bs.stale(30) == list(range(250, 256))
+        bs.touch(255, 40)
+        assert bs.stale(30) == list(range(250, 255))
+
+    def test_replacement(self):
+        """ Testing peers are only replaced after a ping timed out or
+        too many failures """
+        bs = bucketset.BucketSet(2, 32, b"aaaa")
+        server = mock.Mock()
+        server.dht.peer.id = b"aaaa"
+        with mock.patch.object(
+            peer.Peer, 'ping', return_value=None
+        ) as mock_ping:
+            for id_ in (b"caaa", b"caab", b"caac", b"caad"):
+                bs.insert(peer.Peer(2, id_), server)
+        bucket = bs.buckets[25]
+        assert [p.id for p in bucket.values()] == [b"caaa", b"caab"]
+        assert list(bs.replacements[25].values())[-1].id == b"caad"
+        # The oldest peer is only pinged once
+        assert mock_ping.call_count == 1
+        state = server.dht.register_rpc.call_args[0][1]
+        assert state[1].id == b"caaa"
+        # Seen again after the ping, it stays and becomes the newest
+        bs.insert(peer.Peer(2, b"caaa"), server, True)
+        bs.ping_expired(state[1], state[0])
+        assert [p.id for p in bucket.values()] == [b"caab", b"caaa"]
+        # Not seen after the ping, the newest replacement takes the slot
+        bs.ping_expired(bucket[bucketset.bytes2int(b"caab")], time.time())
+        assert [p.id for p in bucket.values()] == [b"caaa", b"caad"]
+        for _ in range(Config.MAX_FAILURES):
+            bs.failed(b"caaa")
+        assert [p.id for p in bucket.values()] == [b"caad", b"caac"]
+        # Without replacements the peer is kept
+        for _ in range(Config.MAX_FAILURES):
+            bs.failed(b"caad")
+        assert [p.id for p in bucket.values()] == [b"caad", b"caac"]
+
+    def test_latency(self):
+        """ Testing the RTT average and the penalty of failing peers """
+        bs = bucketset.BucketSet(2, 32, b"aaaa")
+        server = mock.Mock()
+        bs.insert(peer.Peer(2, b"caaa"), server)
+        bs.insert(peer.Peer(2, b"caab", well_connected=True), server)
+        assert bs.latency(b"caaa") is None
+        assert bs.latency(b"daaa") is None
+        bs.record_rtt(b"caaa", 0.1)
+        bs.record_rtt(b"caaa", 0.9)
+        assert bs.latency(b"caaa") == 0.1 + Config.RTT_WEIGHT * 0.8
+        # The average is kept when the peer is seen again
+        bs.insert(peer.Peer(2, b"caaa"), server)
+        assert bs.latency(b"caaa") == 0.1 + Config.RTT_WEIGHT * 0.8
+        bs.failed(b"caab")
+        assert bs.latency(b"caab") == float("inf")
+        assert [p.id for p in bs.nearest_nodes(b"caab")] == [
+            b"caaa",
+            b"caab",
+        ]
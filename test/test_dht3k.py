@@ -2,13 +2,24 @@
 Integration tests for pydht
 """
 
+import os
 import pytest
+import shutil
+import tempfile
 import time
 import random
+import concurrent.futures as futures
 
-from dht3k     import DHT
-from dht3k     import hashing
-from dht3k.log import l
+try:
+    import unittest.mock   as mock
+except ImportError:
+    import mock
+
+from dht3k           import DHT
+from dht3k           import hashing
+from dht3k.const     import Config
+from dht3k.shortlist import Shortlist
+from dht3k.log       import l
 
 
 class TestPyDht(object):
@@ -66,6 +77,183 @@ class TestPyDht(object):
             x += 1
             assert self.dht2[x] == x
 
+    def test_many(self):
+        """ Testing set_many and get_many """
+        self.dht1.set_many((x, x) for x in range(50))
+        time.sleep(0.5)
+        keys = list(range(50)) + [3, b"missing"]
+        assert self.dht2.get_many(keys, default=-1) == (
+            list(range(50)) + [3, -1]
+        )
+
+    def test_values(self):
+        """ Testing values of different senders under one key """
+        self.dht1[b"service"] = b"a" * 500
+        self.dht2[b"service"] = b"b" * 500
+        hashed_key = self.dht1._hash_key(b"service")
+        self.dht1.data.store(hashed_key, b"c" * 500, sender=b"c" * 32)
+        time.sleep(0.1)
+        # Two values fit into a page, the third is requested with the cursor
+        assert sorted(self.dht2.get_values(b"service")) == [
+            b"a" * 500,
+            b"b" * 500,
+            b"c" * 500,
+        ]
+        assert len(self.dht2.get_values(b"service", limit=1)) == 1
+        assert self.dht2.get_values(b"blau") == []
+
+    def test_single_flight(self):
+        """ Testing concurrent gets of one key share one lookup """
+        self.dht1[b"hot"] = b"value"
+        time.sleep(0.1)
+        dht = self.dht2
+        dht.data = None
+        with mock.patch.object(
+            dht,
+            'iterative_find_value',
+            wraps=dht.iterative_find_value,
+        ) as find:
+            results = list(futures.ThreadPoolExecutor(10).map(
+                lambda _: dht[b"hot"],
+                range(10),
+            ))
+            assert results == [b"value"] * 10
+            assert find.call_count == 1
+            # Misses are cached too
+            for _ in range(2):
+                with pytest.raises(KeyError):
+                    dht[b"cold"]
+            assert find.call_count == 2
+
+    def test_path_cache(self):
+        """ Testing a found value is stored at the nearest peer that did
+        not have it """
+        hashed_key = self.dht2._hash_key(b"path")
+        sl = Shortlist(Config.K, hashed_key, self.dht2.peer.id)
+        peer1, = self.dht2.buckets.nearest_nodes(hashed_key)
+        sl.update([peer1])
+        sl.start(peer1, b"rpc")
+        sl.update([], b"rpc")
+        self.dht2._cache_on_path(sl, b"value")
+        time.sleep(0.1)
+        assert hashed_key not in self.dht1.data
+        self.dht2.path_cache = True
+        self.dht2._cache_on_path(sl, b"value")
+        time.sleep(0.1)
+        assert self.dht1.data[hashed_key] == b"value"
+        # The copy is not filed under the sender of the cache request
+        with pytest.raises(KeyError):
+            self.dht1.data.entry(hashed_key, self.dht2.peer.id)
+        assert self.dht1.data.values(hashed_key, 10) == []
+
+    def test_republish(self):
+        """ Testing values are stored again for their sender """
+        hashed_key = self.dht1._hash_key(b"republish")
+        sender = b"s" * Config.ID_BYTES
+        self.dht1._set_local(hashed_key, b"own")
+        self.dht1.data.store(hashed_key, b"held", sender=sender)
+        self.dht1.data.store(hashed_key, b"back", sender=self.dht2.peer.id)
+        assert self.dht1._republish_due(time.time()) == {}
+        due = self.dht1._republish_due(time.time() + Config.REPUBLISH)
+        assert sorted(due[hashed_key]) == sorted(
+            [b"", sender, self.dht2.peer.id]
+        )
+        self.dht1._republish(
+            hashed_key,
+            due[hashed_key],
+            self.dht1.buckets.nearest_nodes(hashed_key),
+        )
+        time.sleep(0.1)
+        # The value of dht2 is not stored on dht2 again
+        assert sorted(self.dht2.data.values(hashed_key, 10)) == sorted([
+            (self.dht1.peer.id, b"own"),
+            (sender, b"held"),
+        ])
+
+    def test_republished_by_other(self):
+        """ Testing a value republished by another holder is not due """
+        hashed_key = self.dht1._hash_key(b"republished")
+        sender = b"s" * Config.ID_BYTES
+        assert self.dht1.data.store(hashed_key, b"held", sender=sender)
+        time.sleep(0.05)
+        now = time.time()
+        due = self.dht1._republish_due(now + Config.REPUBLISH)
+        assert due[hashed_key] == [sender]
+        self.dht1.peer.store(
+            hashed_key,
+            b"held",
+            dht     = self.dht2,
+            peer_id = self.dht2.peer.id,
+            origin  = sender,
+        )
+        time.sleep(0.1)
+        assert self.dht1._republish_due(now + Config.REPUBLISH) == {}
+
+    def test_resend_ping(self):
+        """ Testing the RTT of a resent ping is measured from the resend """
+        pings = self.dht1._create_pings([self.dht2.peer])
+        _, _, hash_id = pings[0]
+        with self.dht1.rpc_states.shard(hash_id) as states:
+            states[hash_id][0] -= 10
+        self.dht1._send_pings(pings)
+        time.sleep(0.1)
+        assert self.dht1._pongs(hash_id)
+        rtt = self.dht1.buckets.latency(self.dht2.peer.id)
+        assert rtt is not None
+        assert rtt < 1
+        self.dht1._forget_pings(pings)
+
+    def test_refresh(self):
+        """ Testing stale buckets are refreshed by concurrent lookups """
+        dht = self.dht2
+        dht.buckets.activity = [0.0] * Config.ID_BITS
+        stale = dht.buckets.stale(time.time() - Config.BUCKET_REFRESH)
+        assert stale
+        with mock.patch.object(
+            dht,
+            '_lookup_many',
+            wraps=dht._lookup_many,
+        ) as lookup_many:
+            dht._refresh_buckets()
+        lookups, limit = lookup_many.call_args[0]
+        assert len(lookups) == len(stale)
+        assert limit == Config.REFRESH_BATCH
+        assert dht.buckets.stale(time.time() - Config.BUCKET_REFRESH) == []
+
+    def test_warm_start(self):
+        """ Testing a restarted node keeps its id and pings the peers of
+        the snapshot instead of bootstrapping """
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "snapshot")
+
+        def start(**kwargs):
+            """ Start the node using the snapshot """
+            return DHT(
+                4169,
+                u"127.0.0.1",
+                u"::1",
+                listen_hostv4 = u"127.0.0.1",
+                listen_hostv6 = u"::1",
+                snapshot_path = path,
+                port_map      = False,
+                **kwargs
+            )
+        try:
+            dht = start(boot_host=u"::1", boot_port=4165)
+            id_ = dht.peer.id
+            dht.close()
+            self.dht1[b"warm"] = b"value"
+            dht = start()
+            try:
+                assert dht.peer.id == id_
+                assert dht.boot_peer is not None
+                assert dht.firewalled
+                assert dht[b"warm"] == b"value"
+            finally:
+                dht.close()
+        finally:
+            shutil.rmtree(folder)
+
     def test_find_set_str(self):
         """ Testing init """
         self.dht1["huhu"] = b"haha"
@@ -79,6 +267,17 @@ class TestPyDht(object):
         with pytest.raises(KeyError):
             assert self.dht2[b"blau"] == b"haha"
 
+    def test_large_value(self):
+        """ Testing values larger than a datagram """
+        value = os.urandom(20000)
+        self.dht1[b"large"] = value
+        time.sleep(0.5)
+        assert self.dht2.data[self.dht2._hash_key(b"large")] == value
+        # Found values are fragmented too
+        hashed_key = self.dht1._hash_key(b"other")
+        self.dht1._set_local(hashed_key, value)
+        assert self.dht2.iterative_find_value(hashed_key) == value
+
     def test_null_key(self):
         """ Testing init """
         self.dht1[0] = b"haha"
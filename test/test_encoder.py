@@ -0,0 +1,143 @@
+"""
+Testing the message encoder
+"""
+
+import os
+import msgpack
+import pytest
+
+import dht3k.encoder       as encoder
+import dht3k.peer          as peer
+from dht3k.const           import Message, MinMax
+from dht3k.fragment        import Reassembly
+from dht3k.hashing         import hash_function, random_id
+
+
+class TestEncoder(object):
+    """ Testing the message encoder """
+
+    def setup(self):
+        """ Setup """
+        self.network_id = random_id()
+        self.peer_id = random_id()
+        self.encoder = encoder.MessageEncoder(self.network_id)
+
+    def teardown(self):
+        """ Teardown """
+
+    def check(self, message):
+        """ The encoded message is the message with the sender header """
+        expect = dict(message)
+        expect[Message.PEER_ID] = self.peer_id
+        expect[Message.NETWORK_ID] = hash_function(
+            self.peer_id + self.network_id
+        )
+        encoded = self.encoder.encode(message, self.peer_id)
+        assert msgpack.loads(encoded) == expect
+
+    def test_encode(self):
+        """ Testing messages with the cached header """
+        self.check({Message.MESSAGE_TYPE: Message.FW_PING})
+        self.check({
+            Message.MESSAGE_TYPE: Message.FIND_NODE,
+            Message.ID: random_id(),
+            Message.RPC_ID: random_id(),
+        })
+        assert len(self.encoder.headers) == 1
+
+    def test_fragments(self):
+        """ Large values are split and reassembled """
+        value = os.urandom(20000)
+        message = {
+            Message.MESSAGE_TYPE: Message.STORE,
+            Message.ID: random_id(),
+            Message.VALUE: value,
+        }
+        datagrams = self.encoder.datagrams(message, self.peer_id)
+        chunk = self.encoder.chunk_size(self.peer_id)
+        assert len(datagrams) == (len(value) + chunk - 1) // chunk
+        assert all(len(x) <= MinMax.MAX_MSG_SIZE for x in datagrams)
+        reassembly = Reassembly()
+        results = [
+            reassembly.add(msgpack.loads(x)) for x in reversed(datagrams)
+        ]
+        assert results[:-1] == [None] * (len(datagrams) - 1)
+        assert results[-1][Message.VALUE] == value
+        assert Message.FRAGMENT not in results[-1]
+        assert len(reassembly) == 0
+        assert reassembly.size == 0
+        message[Message.MESSAGE_TYPE] = Message.FOUND_NODES
+        with pytest.raises(encoder.MaxSizeException):
+            self.encoder.datagrams(message, self.peer_id)
+        message[Message.MESSAGE_TYPE] = Message.STORE
+        message[Message.VALUE] = os.urandom(100000)
+        with pytest.raises(encoder.MaxSizeException):
+            self.encoder.datagrams(message, self.peer_id)
+
+    def test_fragment_limit(self):
+        """ A value stored with the largest fields can be returned """
+        size = self.encoder.max_value_size(self.peer_id)
+        store = {
+            Message.MESSAGE_TYPE: Message.STORE,
+            Message.ID: random_id(),
+            Message.VALUE: os.urandom(size),
+            Message.TTL: 2 ** 40,
+            Message.ORIGIN: random_id(),
+        }
+        found = {
+            Message.MESSAGE_TYPE: Message.FOUND_VALUE,
+            Message.ID: random_id(),
+            Message.RPC_ID: random_id(),
+            Message.VALUE: store[Message.VALUE],
+        }
+        for message in (store, found):
+            datagrams = self.encoder.datagrams(message, self.peer_id)
+            assert len(datagrams) == MinMax.MAX_FRAGMENTS
+            assert all(len(x) <= MinMax.MAX_MSG_SIZE for x in datagrams)
+            message[Message.VALUE] += b"x"
+            with pytest.raises(encoder.MaxSizeException):
+                self.encoder.datagrams(message, self.peer_id)
+
+    def test_large(self):
+        """ Messages with more than 15 items are packed completely """
+        message = dict((x, x) for x in range(100, 120))
+        self.check(message)
+        assert Message.PEER_ID not in message
+
+
+class TestCompactNodes(object):
+    """ Testing the compact node records """
+
+    def setup(self):
+        """ Setup """
+        self.peers = [
+            peer.Peer(4000, random_id(), hostv4=u"127.0.0.1"),
+            peer.Peer(4001, random_id(), hostv6=u"::1"),
+            peer.Peer(4002, random_id(), u"10.0.0.1", u"fe80::1"),
+        ]
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_roundtrip(self):
+        """ Packed peers are unpacked to the same peers """
+        packed = encoder.pack_nodes(self.peers)
+        assert len(packed) == 3 * encoder._NODE.size + 2 * 4 + 2 * 16
+        assert [
+            p.astuple() for p in encoder.unpack_nodes(packed)
+        ] == [
+            p.astuple() for p in self.peers
+        ]
+        assert encoder.unpack_nodes(b"") == []
+
+    def test_malformed(self):
+        """ Malformed records raise ValueError """
+        packed = encoder.pack_nodes(self.peers)
+        with pytest.raises(ValueError):
+            encoder.unpack_nodes(packed[:-1])
+        with pytest.raises(ValueError):
+            encoder.unpack_nodes(packed[:10])
+        with pytest.raises(ValueError):
+            encoder.unpack_nodes(encoder.pack_nodes([
+                peer.Peer(80, random_id(), hostv4=u"127.0.0.1"),
+            ]))
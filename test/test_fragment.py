@@ -0,0 +1,70 @@
+"""
+Testing the reassembly of fragments
+"""
+
+from dht3k.fragment        import Reassembly
+from dht3k.const           import Message
+
+
+def fragment(peer_id, frag_id, index, count, chunk=b"xxxx"):
+    """ Create a fragment """
+    return {
+        Message.MESSAGE_TYPE: Message.STORE,
+        Message.PEER_ID: peer_id,
+        Message.VALUE: chunk,
+        Message.FRAGMENT: (frag_id, index, count),
+    }
+
+
+class TestReassembly(object):
+    """ Testing the reassembly buffer """
+
+    def setup(self):
+        """ Setup """
+        self.reassembly = Reassembly(limit=10, timeout=5, overhead=0)
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_duplicates(self):
+        """ Duplicate and inconsistent fragments are ignored """
+        add = self.reassembly.add
+        assert add(fragment(b"a", b"1", 0, 2, b"ab"), 0) is None
+        assert add(fragment(b"a", b"1", 0, 2, b"zz"), 0) is None
+        assert add(fragment(b"a", b"1", 1, 3, b"zz"), 0) is None
+        # Same fragment id from another sender
+        assert add(fragment(b"b", b"1", 1, 2, b"zz"), 0) is None
+        message = add(fragment(b"a", b"1", 1, 2, b"cd"), 0)
+        assert message[Message.VALUE] == b"abcd"
+        assert len(self.reassembly) == 1
+
+    def test_limit(self):
+        """ The oldest messages are dropped if the limit is reached """
+        add = self.reassembly.add
+        add(fragment(b"a", b"1", 0, 2), 0)
+        add(fragment(b"a", b"2", 0, 2), 1)
+        add(fragment(b"a", b"3", 0, 2), 2)
+        assert len(self.reassembly) == 2
+        assert self.reassembly.size == 8
+        assert add(fragment(b"a", b"1", 1, 2), 3) is None
+        assert add(fragment(b"a", b"3", 1, 2), 3) is not None
+
+    def test_overhead(self):
+        """ Every message is charged the overhead, so many messages with
+        small chunks are bounded too """
+        reassembly = Reassembly(limit=4 * 257, timeout=5, overhead=256)
+        for x in range(100):
+            reassembly.add(fragment(b"a", b"%d" % x, 0, 2, b"x"), 0)
+        assert len(reassembly) == 4
+        assert reassembly.size == 4 * 257
+        message = reassembly.add(fragment(b"a", b"99", 1, 2, b"y"), 0)
+        assert message[Message.VALUE] == b"xy"
+        assert reassembly.size == 3 * 257
+
+    def test_timeout(self):
+        """ Incomplete messages are dropped after the timeout """
+        add = self.reassembly.add
+        add(fragment(b"a", b"1", 0, 2), 0)
+        add(fragment(b"a", b"2", 0, 2), 3)
+        assert add(fragment(b"a", b"1", 1, 2), 6) is None
+        assert add(fragment(b"a", b"2", 1, 2), 6) is not None
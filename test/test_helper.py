@@ -0,0 +1,98 @@
+"""
+Testing the helpers
+"""
+
+import dht3k.helper        as helper
+
+
+class TestShardedDict(object):
+    """ Testing the sharded dict """
+
+    def setup(self):
+        """ Setup """
+        self.states = helper.ShardedDict(4)
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_shards(self):
+        """ A key is always found in the same shard """
+        for x in range(100):
+            key = b"%d" % x
+            with self.states.shard(key) as states:
+                states[key] = [x]
+        assert len(self.states) == 100
+        assert all(shard.dict_ for shard in self.states.shards)
+        with self.states.shard(b"42") as states:
+            assert states[b"42"] == [42]
+
+
+class TestTimerHeap(object):
+    """ Testing the timer heap """
+
+    def setup(self):
+        """ Setup """
+        self.timers = helper.TimerHeap()
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_expired(self):
+        """ Keys expire in the order of their deadline """
+        self.timers.schedule(20, b"b")
+        assert self.timers.changed.is_set()
+        self.timers.changed.clear()
+        self.timers.schedule(30, b"c")
+        assert not self.timers.changed.is_set()
+        self.timers.schedule(10, b"a")
+        assert self.timers.changed.is_set()
+        assert self.timers.next_timeout(5) == 5
+        assert self.timers.expired(5) == []
+        assert self.timers.expired(20) == [b"a", b"b"]
+        assert self.timers.next_timeout(40) == 0
+        assert self.timers.expired(40) == [b"c"]
+        assert len(self.timers) == 0
+
+
+class TestLRUCache(object):
+    """ Testing the LRU cache """
+
+    def setup(self):
+        """ Setup """
+        self.cache = helper.LRUCache(2)
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_lru(self):
+        """ The least recently used item is removed """
+        self.cache[b"a"] = 1
+        self.cache[b"b"] = 2
+        assert self.cache.get(b"a") == 1
+        self.cache[b"c"] = 3
+        assert len(self.cache) == 2
+        assert self.cache.get(b"b") is None
+        assert self.cache.get(b"a") == 1
+        assert self.cache.get(b"c") == 3
+
+
+class TestTTLCache(object):
+    """ Testing the TTL cache """
+
+    def setup(self):
+        """ Setup """
+        self.cache = helper.TTLCache(2)
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_ttl(self):
+        """ Expired items are not returned """
+        self.cache.set(b"a", 1, 100)
+        self.cache.set(b"b", 2, -1)
+        assert self.cache.get(b"a") == 1
+        assert self.cache.get(b"b") is None
+        assert len(self.cache) == 1
+        self.cache.discard(b"a")
+        self.cache.discard(b"a")
+        assert self.cache.get(b"a", 3) == 3
@@ -0,0 +1,164 @@
+"""
+Testing the request handler
+"""
+
+import time
+
+try:
+    import unittest.mock   as mock
+except ImportError:
+    import mock
+
+import dht3k.server        as server
+import dht3k.helper        as helper
+from dht3k.const           import Message
+from dht3k.hashing         import hash_function, random_id
+
+
+class TestVerify(object):
+    """ Testing the message verification """
+
+    def setup(self):
+        """ Setup """
+        self.server = mock.Mock()
+        self.server.dht.network_id = random_id()
+        self.server.dht.proofs = helper.LRUCache(10)
+        self.handler = server.DHTRequestHandler(
+            (b"", None),
+            ("127.0.0.1", 4000),
+            self.server,
+        )
+        self.peer_id = random_id()
+
+    def teardown(self):
+        """ Teardown """
+
+    def message(self, parts=None):
+        """ Create a find node message updated with parts """
+        message = {
+            Message.MESSAGE_TYPE: Message.FIND_NODE,
+            Message.ID: random_id(),
+            Message.RPC_ID: random_id(),
+            Message.PEER_ID: self.peer_id,
+            Message.NETWORK_ID: hash_function(
+                self.peer_id + self.server.dht.network_id
+            ),
+        }
+        if parts:
+            message.update(parts)
+        return message
+
+    def test_valid(self):
+        """ Valid messages are accepted and the proof is cached """
+        with mock.patch.object(
+            server,
+            'hash_function',
+            wraps=hash_function,
+        ) as mock_hash:
+            assert self.handler.verify_message(self.message())
+            assert self.handler.verify_message(self.message())
+            assert mock_hash.call_count == 1
+        assert self.server.dht.proofs.get(self.peer_id)
+
+    def test_fragment(self):
+        """ Fragments need a bytes value and a valid index and count """
+        verify = self.handler.verify_message
+
+        def store(value, fragment):
+            """ Create a fragment of a store message """
+            message = self.message({
+                Message.MESSAGE_TYPE: Message.STORE,
+                Message.VALUE: value,
+                Message.FRAGMENT: fragment,
+            })
+            del message[Message.RPC_ID]
+            return message
+        assert verify(store(b"a", (b"1", 0, 2)))
+        assert not verify(store(1, (b"1", 0, 2)))
+        assert not verify(store([b"a"], (b"1", 0, 2)))
+        assert not verify(store(b"a", 5))
+        assert not verify(store(b"a", (b"1", 2, 2)))
+        assert not verify(store(b"a", (b"1", b"0", 2)))
+        # Empty chunks would buffer messages for free
+        assert not verify(store(b"", (b"1", 0, 2)))
+
+    def test_cached(self):
+        """ Only stores may be marked as path cached copies """
+        message = self.message({
+            Message.MESSAGE_TYPE: Message.STORE,
+            Message.VALUE: b"a",
+            Message.CACHED: True,
+        })
+        del message[Message.RPC_ID]
+        assert self.handler.verify_message(message)
+        message[Message.CACHED] = 1
+        assert not self.handler.verify_message(message)
+        assert not self.handler.verify_message(
+            self.message({Message.CACHED: True})
+        )
+
+    def test_invalid(self):
+        """ Invalid messages are rejected """
+        verify = self.handler.verify_message
+        assert not verify(self.message({Message.MESSAGE_TYPE: 99}))
+        assert not verify(self.message({99: b"a"}))
+        assert not verify(self.message({Message.ID: b"short"}))
+        # Not allowed in find node
+        assert not verify(self.message({Message.VALUE: b"a"}))
+        assert not verify(self.message({Message.NETWORK_ID: random_id()}))
+        message = self.message()
+        del message[Message.NETWORK_ID]
+        assert not verify(message)
+
+
+class TestPong(object):
+    """ Testing the round trip time of pings """
+
+    def setup(self):
+        """ Setup """
+        self.server = mock.Mock()
+        self.server.dht.rpc_states = helper.ShardedDict()
+        self.handler = server.DHTRequestHandler(
+            (b"", None),
+            ("127.0.0.1", 4000),
+            self.server,
+        )
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_first_pong(self):
+        """ Only the first pong of a ping is measured """
+        hash_id = random_id()
+        with self.server.dht.rpc_states.shard(hash_id) as states:
+            states[hash_id] = [time.time() - 1]
+        message = {Message.RPC_ID: hash_id}
+        is_rpc_ping, rtt = self.handler.handle_pong(message)
+        assert is_rpc_ping
+        assert rtt >= 1
+        assert self.handler.handle_pong(message) == (True, None)
+        assert self.handler.handle_pong(
+            {Message.RPC_ID: random_id()}
+        ) == (False, None)
+
+
+class TestPage(object):
+    """ Testing the pages of FOUND_VALUE """
+
+    def setup(self):
+        """ Setup """
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_page(self):
+        """ Testing limit, size and cursor of a page """
+        entries = [(b"a", 1), (b"b", 2), (b"c", 3)]
+        assert server._page(entries, 3) == ([1, 2, 3], None)
+        assert server._page(entries, 2) == ([1, 2], b"b")
+        big = b"x" * 700
+        entries = [(b"a", big), (b"b", big), (b"c", 3)]
+        assert server._page(entries, 5) == ([big], b"a")
+        # Values larger than a page are skipped
+        entries = [(b"a", b"x" * 2000), (b"b", 2), (b"c", 3)]
+        assert server._page(entries, 2) == ([2, 3], b"c")
@@ -0,0 +1,156 @@
+"""
+Testing the shortlist
+"""
+
+import pytest
+
+import dht3k.shortlist     as shortlist
+import dht3k.peer          as peer
+from dht3k.const           import PeerState
+
+
+class TestShortlist(object):
+    """ Testing the shortlist """
+
+    def setup(self):
+        """ Setup """
+        self.sl = shortlist.Shortlist(3, b"\x00\x00", b"\xff\xff")
+
+    def teardown(self):
+        """ Teardown """
+
+    def test_order(self):
+        """ Nodes are kept sorted by distance and bounded by k """
+        self.sl.update([
+            peer.Peer(2000, b"\x00\x08"),
+            peer.Peer(2000, b"\x00\x01"),
+            peer.Peer(2000, b"\x00\x04"),
+            peer.Peer(2000, b"\x00\x02"),
+            peer.Peer(2000, b"\x00\x01"),
+        ])
+        assert [p.id for p in self.sl.results()] == [
+            b"\x00\x01",
+            b"\x00\x02",
+            b"\x00\x04",
+        ]
+
+    def test_in_flight(self):
+        """ Only alpha RPCs are in flight """
+        self.sl.update([
+            peer.Peer(2000, b"\x00\x01"),
+            peer.Peer(2000, b"\x00\x02"),
+            peer.Peer(2000, b"\x00\x04"),
+        ])
+        first = self.sl.get_next_iteration(2)
+        assert [p.id for p in first] == [b"\x00\x01", b"\x00\x02"]
+        self.sl.start(first[0], b"rpc1")
+        self.sl.start(first[1], b"rpc2")
+        assert self.sl.get_next_iteration(2) == []
+        self.sl.update([], b"rpc1")
+        second = self.sl.get_next_iteration(2)
+        assert [p.id for p in second] == [b"\x00\x04"]
+        assert not self.sl.complete()
+
+    def test_complete(self):
+        """ Failed peers are dropped, complete when all responded """
+        self.sl.update([
+            peer.Peer(2000, b"\x00\x01"),
+            peer.Peer(2000, b"\x00\x02"),
+        ])
+        one, two = self.sl.get_next_iteration(3)
+        self.sl.start(one, b"rpc1")
+        self.sl.start(two, b"rpc2")
+        self.sl.fail(b"rpc1")
+        self.sl.fail(b"rpc2")
+        assert self.sl.results() == []
+        # Failed peers are not added again
+        self.sl.update([peer.Peer(2000, b"\x00\x01")])
+        assert self.sl.results() == []
+        assert self.sl.complete()
+        self.sl.update([peer.Peer(2000, b"\x00\x04")])
+        assert not self.sl.complete()
+        three, = self.sl.get_next_iteration(3)
+        self.sl.start(three, b"rpc3")
+        assert self.sl.list[0].state == PeerState.IN_FLIGHT
+        self.sl.update([], b"rpc3")
+        assert self.sl.complete()
+
+    def test_evict(self):
+        """ Responded peers pushed out by nearer peers are not counted """
+        self.sl.update([
+            peer.Peer(2000, b"\x00\x08"),
+            peer.Peer(2000, b"\x00\x09"),
+            peer.Peer(2000, b"\x00\x0a"),
+        ])
+        for x, node in enumerate(self.sl.get_next_iteration(3)):
+            self.sl.start(node, x)
+            self.sl.update([], x)
+        assert self.sl.complete()
+        assert self.sl.responded() == 3
+        self.sl.update([peer.Peer(2000, b"\x00\x01")])
+        assert self.sl.responded() == 2
+        assert not self.sl.complete()
+        assert [p.id for p in self.sl.get_next_iteration(3)] == [b"\x00\x01"]
+
+    def test_value(self):
+        """ The first value wins """
+        with pytest.raises(KeyError):
+            self.sl.completion_result()
+        self.sl.set_complete(b"a")
+        self.sl.set_complete(b"b")
+        assert self.sl.complete()
+        assert self.sl.completion_result() == b"a"
+
+    def test_nearest_responded(self):
+        """ The nearest peer that answered with nodes is used for path
+        caching """
+        self.sl.update([
+            peer.Peer(2000, b"\x00\x01"),
+            peer.Peer(2000, b"\x00\x02"),
+            peer.Peer(2000, b"\x00\x04"),
+        ])
+        assert self.sl.nearest_responded() == (None, 0)
+        one, two, four = self.sl.get_next_iteration(3)
+        self.sl.start(one, b"rpc1")
+        self.sl.start(two, b"rpc2")
+        self.sl.start(four, b"rpc4")
+        self.sl.update([], b"rpc4")
+        self.sl.update([], b"rpc2")
+        self.sl.set_complete(b"value")
+        assert self.sl.nearest_responded() == (two, 1)
+
+    def test_latency(self):
+        """ Faster peers are preferred at the same log distance """
+        self.sl.update([
+            peer.Peer(2000, b"\x00\x02"),
+            peer.Peer(2000, b"\x00\x03"),
+            peer.Peer(2000, b"\x00\x08"),
+        ])
+        rtts = {
+            b"\x00\x02": 0.5,
+            b"\x00\x03": 0.01,
+            b"\x00\x08": 0.001,
+        }
+        first, = self.sl.get_next_iteration(1, rtts.get)
+        assert first.id == b"\x00\x03"
+        # Unknown peers are assumed to have the default RTT
+        del rtts[b"\x00\x03"]
+        assert self.sl.get_next_iteration(1, rtts.get) == [first]
+        self.sl.start(first, b"rpc1")
+        # Nearer peers are still asked first
+        second, = self.sl.get_next_iteration(2, rtts.get)
+        assert second.id == b"\x00\x02"
+
+    def test_latency_failed(self):
+        """ Peers that timed out are skipped while there are others """
+        self.sl.update([
+            peer.Peer(2000, b"\x00\x02"),
+            peer.Peer(2000, b"\x00\x08"),
+        ])
+        rtts = {b"\x00\x02": float("inf")}
+        first, = self.sl.get_next_iteration(1, rtts.get)
+        assert first.id == b"\x00\x08"
+        self.sl.start(first, b"rpc1")
+        # Only the failed peer is left
+        last, = self.sl.get_next_iteration(2, rtts.get)
+        assert last.id == b"\x00\x02"
@@ -0,0 +1,72 @@
+"""
+Testing the routing table snapshot
+"""
+
+import os
+import shutil
+import tempfile
+import msgpack
+
+from dht3k          import snapshot
+from dht3k.const    import Config
+from dht3k.hashing  import random_id
+from dht3k.peer     import Peer
+
+
+class TestSnapshot(object):
+    """ Testing save and load """
+
+    def setup(self):
+        """ Setup """
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "snapshot")
+
+    def teardown(self):
+        """ Teardown """
+        shutil.rmtree(self.folder)
+
+    def test_roundtrip(self):
+        """ Testing the id and the peers are restored """
+        id_ = random_id()
+        peer1 = Peer(4000, random_id(), u"127.0.0.1", u"::1")
+        peer1.last_seen = 123.5
+        peer2 = Peer(4002, random_id(), None, u"::1")
+        snapshot.save(self.path, Config.NETWORK_ID, id_, [peer1, peer2])
+        assert not os.path.exists(self.path + ".tmp")
+        loaded_id, peers = snapshot.load(self.path, Config.NETWORK_ID)
+        assert loaded_id == id_
+        assert [p.astuple() for p in peers] == [
+            peer1.astuple(),
+            peer2.astuple(),
+        ]
+        assert peers[0].last_seen == 123.5
+
+    def test_invalid(self):
+        """ Testing missing, broken and foreign snapshots are ignored """
+        assert snapshot.load(self.path, Config.NETWORK_ID) == (None, [])
+        with open(self.path, "wb") as f:
+            f.write(b"\xc1broken")
+        assert snapshot.load(self.path, Config.NETWORK_ID) == (None, [])
+        snapshot.save(self.path, b"other", random_id(), [])
+        assert snapshot.load(self.path, Config.NETWORK_ID) == (None, [])
+        # Valid msgpack with the wrong shape
+        for content in (
+                (snapshot.VERSION, Config.NETWORK_ID, 7, []),
+                (snapshot.VERSION, Config.NETWORK_ID, random_id(), None),
+                (snapshot.VERSION, Config.NETWORK_ID, random_id(), 3),
+                (snapshot.VERSION, Config.NETWORK_ID),
+                None,
+        ):
+            with open(self.path, "wb") as f:
+                f.write(msgpack.dumps(content))
+            assert snapshot.load(self.path, Config.NETWORK_ID) == (None, [])
+        # Broken records are skipped
+        id_ = random_id()
+        with open(self.path, "wb") as f:
+            f.write(msgpack.dumps((
+                snapshot.VERSION,
+                Config.NETWORK_ID,
+                id_,
+                [None, 5, (4000, 7, None, None, False, 0), (1, 2)],
+            )))
+        assert snapshot.load(self.path, Config.NETWORK_ID) == (id_, [])
@@ -0,0 +1,253 @@
+"""
+Testing the storage backends
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import msgpack
+import pytest
+
+import dht3k.storage as storage
+from dht3k.const     import Storage, Config
+
+
+class TestStorage(object):
+    """ Testing the storage backends """
+
+    def setup(self):
+        """ Setup """
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "test.sqlite")
+
+    def teardown(self):
+        """ Teardown """
+        shutil.rmtree(self.folder)
+
+    def check_backend(self, data):
+        """ Test the interface of a backend """
+        assert len(data) == 0
+        assert b"a" not in data
+        with pytest.raises(KeyError):
+            data[b"a"]
+        data[b"a"] = b"value"
+        data[b"b"] = 0
+        assert b"a" in data
+        assert data[b"a"] == b"value"
+        assert data[b"b"] == 0
+        assert len(data) == 2
+        assert sorted(data.keys()) == [b"a", b"b"]
+        del data[b"a"]
+        with pytest.raises(KeyError):
+            del data[b"a"]
+        assert data.keys() == [b"b"]
+
+    def check_limits(self, data):
+        """ Test TTL, budget and quota of a backend with limit 30 and
+        quota 20 """
+        assert data.store(b"a", b"x" * 8, ttl=1e-9)
+        assert b"a" not in data
+        # Each value takes 10 bytes (key + packed value)
+        assert data.store(b"b", b"x" * 8, sender=b"peer1")
+        assert data.store(b"c", b"x" * 8, sender=b"peer1")
+        data[b"b"]
+        # Quota of peer1 is full, its least recently used value is evicted
+        assert data.store(b"d", b"x" * 8, sender=b"peer1")
+        assert b"c" not in data
+        assert sorted(data.keys()) == [b"b", b"d"]
+        assert not data.store(b"e", b"x" * 30, sender=b"peer2")
+        # Budget is full, the least recently used value is evicted
+        data[b"b"]
+        assert data.store(b"e", b"x" * 8, sender=b"peer2")
+        assert data.store(b"f", b"x" * 8)
+        assert sorted(data.keys()) == [b"b", b"e", b"f"]
+        assert not data.store(b"g", b"x" * 40)
+        assert data.size == 30
+
+    def check_payer(self, data):
+        """ Test republished values of a backend with limit 30 and quota
+        20 """
+        assert data.store(b"a", b"x" * 8, sender=b"peer1")
+        _, expires = data.entry(b"a", b"peer1")
+        before = time.time()
+        # A value of the origin is not replaced or extended
+        assert not data.store(
+            b"a",
+            b"y" * 8,
+            sender = b"peer1",
+            payer  = b"peer2",
+        )
+        assert data.entry(b"a", b"peer1") == (b"x" * 8, expires)
+        # But it was received again, so it is not due for republishing
+        assert data.due(before) == []
+        # Forged origins are charged to the peer that sent them
+        assert data.store(b"b", b"x" * 8, sender=b"peer3", payer=b"peer2")
+        assert data.store(b"c", b"x" * 8, sender=b"peer4", payer=b"peer2")
+        assert data.store(b"d", b"x" * 8, sender=b"peer5", payer=b"peer2")
+        assert sorted(data.keys()) == [b"a", b"c", b"d"]
+        # The origin can replace the republished value
+        assert data.store(b"c", b"z" * 8, sender=b"peer4")
+        assert data[b"c"] == b"z" * 8
+
+    def check_values(self, data):
+        """ Test the values of different senders under one key """
+        data[b"a"] = 1
+        assert data.store(b"a", 2, sender=b"peer2")
+        assert data.store(b"a", 3, sender=b"peer1")
+        # The last stored value is returned
+        assert data[b"a"] == 3
+        assert data.store(b"a", 4, sender=b"peer2")
+        assert data[b"a"] == 4
+        assert len(data) == 3
+        assert data.keys() == [b"a"]
+        assert data.values(b"a", 10) == [
+            (b"", 1),
+            (b"peer1", 3),
+            (b"peer2", 4),
+        ]
+        assert data.values(b"a", 2) == [(b"", 1), (b"peer1", 3)]
+        assert data.values(b"a", 2, b"peer1") == [(b"peer2", 4)]
+        assert data.values(b"b", 2) == []
+        assert sorted(data.due(time.time())) == [
+            (b"a", b""),
+            (b"a", b"peer1"),
+            (b"a", b"peer2"),
+        ]
+        assert data.due(time.time() - 100) == []
+        value, expires = data.entry(b"a", b"peer1")
+        assert value == 3
+        assert expires > time.time()
+        with pytest.raises(KeyError):
+            data.entry(b"a", b"peer3")
+        del data[b"a"]
+        assert b"a" not in data
+        assert len(data) == 0
+
+    def check_cached(self, data):
+        """ Test path cached copies of a backend with limit 30 and quota
+        20 """
+        assert data.store(b"a", b"x" * 8, sender=b"peer1")
+        assert data.store(b"a", b"x" * 8, sender=storage.CACHED)
+        assert data.store(b"b", b"y" * 8, sender=storage.CACHED)
+        assert data[b"b"] == b"y" * 8
+        # Cached copies are neither paged nor republished
+        assert data.values(b"a", 10) == [(b"peer1", b"x" * 8)]
+        assert data.values(b"b", 10) == []
+        assert data.due(time.time()) == [(b"a", b"peer1")]
+        # They share one quota, apart from the quota of peer1
+        assert data.store(b"c", b"z" * 8, sender=storage.CACHED)
+        assert b"a" in data
+        assert b"c" in data
+        assert data.values(b"a", 10) == [(b"peer1", b"x" * 8)]
+
+    def check_max_values(self, data):
+        """ Test the limit of values per key """
+        max_values = Config.MAX_VALUES
+        for x in range(max_values + 2):
+            assert data.store(b"a", x, sender=b"peer%03d" % x)
+        assert len(data) == max_values
+        # The oldest values are dropped
+        assert [value for _, value in data.values(b"a", 100)] == list(
+            range(2, max_values + 2)
+        )
+
+    def test_memory(self):
+        """ Testing the memory backend """
+        self.check_backend(storage.create_storage(Storage.MEMORY, 4000))
+
+    def test_memory_values(self):
+        """ Testing the values of the memory backend """
+        self.check_values(storage.MemoryStorage())
+        self.check_max_values(storage.MemoryStorage())
+
+    def test_disk_values(self):
+        """ Testing the values of the disk backend """
+        data = storage.DiskStorage(self.path)
+        self.check_values(data)
+        self.check_max_values(data)
+        data.close()
+
+    def test_memory_limits(self):
+        """ Testing the limits of the memory backend """
+        self.check_limits(storage.MemoryStorage(limit=30, quota=20))
+
+    def test_memory_payer(self):
+        """ Testing republished values in the memory backend """
+        self.check_payer(storage.MemoryStorage(limit=30, quota=20))
+
+    def test_memory_cached(self):
+        """ Testing path cached copies in the memory backend """
+        self.check_cached(storage.MemoryStorage(limit=30, quota=20))
+
+    def test_disk_cached(self):
+        """ Testing path cached copies in the disk backend """
+        data = storage.DiskStorage(self.path, limit=30, quota=20)
+        self.check_cached(data)
+        data.close()
+
+    def test_disk_payer(self):
+        """ Testing republished values in the disk backend """
+        data = storage.DiskStorage(self.path, limit=30, quota=20)
+        self.check_payer(data)
+        data.close()
+
+    def test_disk_limits(self):
+        """ Testing the limits of the disk backend """
+        data = storage.DiskStorage(self.path, limit=30, quota=20)
+        self.check_limits(data)
+        data.close()
+        data = storage.DiskStorage(self.path, limit=30, quota=20)
+        assert data.size == 30
+        data.close()
+
+    def test_disk(self):
+        """ Testing the disk backend and persistence """
+        data = storage.create_storage(Storage.DISK, 4000, self.path)
+        self.check_backend(data)
+        data.close()
+        data = storage.create_storage(Storage.DISK, 4000, self.path)
+        assert data[b"b"] == 0
+        data.close()
+
+    def test_disk_migrate(self):
+        """ Testing the migration of the single value table """
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE data (key BLOB PRIMARY KEY, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, expires REAL NOT NULL, sender BLOB, "
+            "atime INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO data VALUES (?, ?, ?, ?, ?, ?)",
+            (b"a", msgpack.dumps(1), 2, time.time() + 100, None, 1),
+        )
+        conn.commit()
+        conn.close()
+        data = storage.DiskStorage(self.path)
+        assert data[b"a"] == 1
+        assert data.size == 2
+        data.close()
+
+    def test_disk_migrate_first(self):
+        """ Testing the migration of the first key value table """
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE data (key BLOB PRIMARY KEY, value BLOB NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO data VALUES (?, ?)",
+            (b"a", msgpack.dumps(b"value")),
+        )
+        conn.commit()
+        conn.close()
+        data = storage.DiskStorage(self.path)
+        assert data[b"a"] == b"value"
+        assert data.size == 1 + len(msgpack.dumps(b"value"))
+        assert data.values(b"a", 10) == [(b"", b"value")]
+        data.close()
+
+    def test_none(self):
+        """ Testing no storage """
+        assert storage.create_storage(Storage.NONE, 4000) is None